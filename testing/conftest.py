@@ -5,6 +5,7 @@ __revision__ = "$Format:%H$"
 
 import pytest
 
+from .http_server import StandInServer
 from .utilities import get_qgis_app
 from ..tools.custom_logging import setup_logger
 from ..tools.resources import plugin_name
@@ -24,3 +25,13 @@ def new_project() -> None:
 @pytest.fixture(scope='session')
 def initialize_logger():
     setup_logger(plugin_name(), IFACE)
+
+
+@pytest.fixture
+def http_server() -> StandInServer:
+    """
+    Local HTTP server for offline network tests. See testing/http_server.py
+    """
+    server = StandInServer().start()
+    yield server
+    server.stop()
@@ -0,0 +1,272 @@
+__copyright__ = "Copyright 2020, Gispo Ltd"
+__license__ = "GPL version 3"
+__email__ = "info@gispo.fi"
+__revision__ = "$Format:%H$"
+
+import base64
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+import urllib.request
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Dict, Optional, List, Tuple
+
+CASSETTE_DIR = Path(__file__).parent / "cassettes"
+# Size of the writes of bandwidth limited responses
+WRITE_SIZE = 8 * 1024
+
+
+class Route:
+    """ Response served by StandInServer for one path """
+
+    def __init__(self, body: bytes = b'', status: int = 200,
+                 headers: Optional[Dict[str, str]] = None, filename: Optional[str] = None,
+                 etag: bool = True, ranges: bool = True, gzip_body: bool = False,
+                 redirect_to: Optional[str] = None, delay: float = 0.0,
+                 bandwidth: Optional[int] = None, fail_times: int = 0, fail_status: int = 503,
+                 retry_after: Optional[int] = None, drop_connection: bool = False):
+        """
+        :param body: Response body
+        :param status: Status code of the successful response
+        :param headers: Extra response headers
+        :param filename: File name sent in Content-Disposition header
+        :param etag: Send ETag and Last-Modified headers and answer conditional requests with 304
+        :param ranges: Accept Range requests
+        :param gzip_body: Compress the body with gzip if the client accepts it
+        :param redirect_to: Path or url to redirect to with 302
+        :param delay: Seconds to wait before sending the response headers
+        :param bandwidth: Maximum sending rate of the body in bytes per second
+        :param fail_times: Number of first requests answered with fail_status
+        :param fail_status: Status code of the injected failures
+        :param retry_after: Retry-After header of the injected failures in seconds
+        :param drop_connection: Close the connection in the middle of the body on the injected
+            failures instead of sending fail_status
+        """
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+        self.filename = filename
+        self.etag = etag
+        self.ranges = ranges
+        self.gzip_body = gzip_body
+        self.redirect_to = redirect_to
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.fail_times = fail_times
+        self.fail_status = fail_status
+        self.retry_after = retry_after
+        self.drop_connection = drop_connection
+        self.last_modified = formatdate(usegmt=True)
+
+    @property
+    def etag_value(self) -> str:
+        return '"{}"'.format(hashlib.sha1(self.body).hexdigest())
+
+    def take_failure(self) -> bool:
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            return True
+        return False
+
+
+class RecordedRequest:
+    """ Request received by StandInServer """
+
+    def __init__(self, method: str, path: str, headers: Dict[str, str]):
+        self.method = method
+        self.path = path
+        self.headers = headers
+
+    def __repr__(self) -> str:
+        return f"RecordedRequest({self.method} {self.path})"
+
+
+class StandInServer:
+    """
+    Local HTTP server serving deterministic responses for the network tests. Use the
+    http_server fixture, add the routes and request server.url(path).
+    """
+
+    def __init__(self):
+        self.routes: Dict[str, Route] = {}
+        self.requests: List[RecordedRequest] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self) -> 'StandInServer':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def base_url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def url(self, path: str) -> str:
+        return self.base_url + path
+
+    def add(self, path: str, body: bytes = b'', **kwargs) -> Route:
+        """
+        Serves the body at the path. See Route for the other arguments
+        :return: the route which can be modified later
+        """
+        route = Route(body, **kwargs)
+        with self._lock:
+            self.routes[path] = route
+        return route
+
+    def add_recorded(self, path: str, upstream_url: str, cassette: Optional[Path] = None,
+                     record: bool = False) -> Route:
+        """
+        Serves a real response recorded from upstream_url. The response is fetched once
+        and stored to the cassette file, later runs replay it without network access.
+        :param cassette: Path to the cassette file. Defaults to
+            testing/cassettes/<sha1 of the url>.json
+        :param record: Fetch and store the response even if the cassette exists
+        """
+        if cassette is None:
+            url_hash = hashlib.sha1(upstream_url.encode()).hexdigest()
+            cassette = CASSETTE_DIR / "{}.json".format(url_hash)
+        if record or not cassette.exists():
+            with urllib.request.urlopen(upstream_url) as response:
+                recording = {
+                    "url": upstream_url,
+                    "status": response.status,
+                    "headers": {name: value for name, value in response.headers.items()
+                                if name.lower() in ("content-type", "content-disposition",
+                                                    "cache-control")},
+                    "body": base64.b64encode(response.read()).decode("ascii"),
+                }
+            cassette.parent.mkdir(parents=True, exist_ok=True)
+            cassette.write_text(json.dumps(recording, indent=2), encoding="utf-8")
+        recording = json.loads(cassette.read_text(encoding="utf-8"))
+        return self.add(path, base64.b64decode(recording["body"]), status=recording["status"],
+                        headers=recording["headers"])
+
+    def requests_to(self, path: str) -> List[RecordedRequest]:
+        with self._lock:
+            return [request for request in self.requests if request.path == path]
+
+    def _record(self, request: RecordedRequest) -> Optional[Route]:
+        with self._lock:
+            self.requests.append(request)
+            return self.routes.get(request.path.split('?')[0])
+
+
+def _make_handler(server: StandInServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            self._respond(send_body=True)
+
+        def do_HEAD(self) -> None:
+            self._respond(send_body=False)
+
+        def _respond(self, send_body: bool) -> None:
+            route = server._record(RecordedRequest(self.command, self.path,
+                                                   dict(self.headers.items())))
+            if route is None:
+                self._send_status(404)
+                return
+            if route.delay:
+                time.sleep(route.delay)
+            if route.redirect_to is not None:
+                self._send_status(302, {'Location': route.redirect_to})
+                return
+
+            failure = route.take_failure()
+            if failure and not route.drop_connection:
+                headers = ({'Retry-After': str(route.retry_after)}
+                           if route.retry_after is not None else {})
+                self._send_status(route.fail_status, headers)
+                return
+
+            headers = dict(route.headers)
+            if route.filename is not None:
+                headers['Content-Disposition'] = 'attachment; filename="{}"'.format(route.filename)
+            if route.etag:
+                headers['ETag'] = route.etag_value
+                headers['Last-Modified'] = route.last_modified
+                if self.headers.get('If-None-Match') == route.etag_value:
+                    self._send_status(304, headers)
+                    return
+
+            status, body = route.status, route.body
+            if route.ranges:
+                headers['Accept-Ranges'] = 'bytes'
+                if_range = self.headers.get('If-Range')
+                # The whole body is sent if the resource has changed since the validator was
+                # received
+                validators = (None, headers.get('ETag'), headers.get('Last-Modified'))
+                range_header = self.headers.get('Range') if if_range in validators else None
+                byte_range = _parse_range(range_header, len(body))
+                if byte_range == (-1, -1):
+                    self._send_status(416, {'Content-Range': 'bytes */{}'.format(len(body))})
+                    return
+                if byte_range is not None:
+                    start, end = byte_range
+                    status, body = 206, body[start:end + 1]
+                    headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(route.body))
+            accepts_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+            if route.gzip_body and accepts_gzip and status == 200:
+                body = gzip.compress(body)
+                headers['Content-Encoding'] = 'gzip'
+
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self._write_body(body[:len(body) // 2] if failure else body, route.bandwidth)
+            if failure:
+                self.close_connection = True
+
+        def _write_body(self, body: bytes, bandwidth: Optional[int]) -> None:
+            if bandwidth is None:
+                self.wfile.write(body)
+                return
+            for i in range(0, len(body), WRITE_SIZE):
+                self.wfile.write(body[i:i + WRITE_SIZE])
+                self.wfile.flush()
+                time.sleep(min(WRITE_SIZE, len(body) - i) / bandwidth)
+
+        def _send_status(self, status: int, headers: Optional[Dict[str, str]] = None) -> None:
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    return Handler
+
+
+def _parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """ Returns inclusive byte range, None if not requested and (-1, -1) if not satisfiable """
+    match = re.match(r'bytes=(\d*)-(\d*)$', (header or '').strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first == '':
+        if last == '':
+            return None
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return -1, -1
+    return start, end
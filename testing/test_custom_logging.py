@@ -0,0 +1,254 @@
+__copyright__ = "Copyright 2020, Gispo Ltd"
+__license__ = "GPL version 3"
+__email__ = "info@gispo.fi"
+__revision__ = "$Format:%H$"
+
+import json
+import logging
+import time
+
+from qgis.core import Qgis
+
+from .conftest import IFACE
+from ..tools import custom_logging
+from ..tools.custom_logging import (setup_logger, teardown_logger, bar_msg, QueueLoggingHandler,
+                                    QgsLogHandler, QgsMessageBarHandler, QgsMessageBarFilter,
+                                    LogTarget, get_log_level, get_log_level_name, set_log_level,
+                                    enable_log_sampling, disable_log_sampling,
+                                    JsonLinesFormatter)
+from ..tools.resources import plugin_name
+
+
+def test_setup_logger_with_queue():
+    teardown_logger(plugin_name())
+    try:
+        logger = setup_logger(plugin_name(), use_queue=True)
+        assert len(logger.handlers) == 1
+        handler = logger.handlers[0]
+        assert isinstance(handler, QueueLoggingHandler)
+        assert any(isinstance(h, QgsLogHandler) for h in handler.handlers)
+        assert setup_logger(plugin_name(), use_queue=True).handlers == [handler]
+
+        logger.warning('queued message')
+    finally:
+        teardown_logger(plugin_name())
+        setup_logger(plugin_name(), IFACE)
+
+    assert handler.listener is None
+    assert handler.queue.empty()
+
+
+def test_setup_logger_switches_handler_mode():
+    teardown_logger(plugin_name())
+    try:
+        logger = setup_logger(plugin_name(), IFACE)
+        direct_types = sorted(type(h).__name__ for h in logger.handlers)
+        logger = setup_logger(plugin_name(), IFACE, use_queue=True)
+        assert len(logger.handlers) == 1
+        queue_handler = logger.handlers[0]
+        assert isinstance(queue_handler, QueueLoggingHandler)
+
+        logger = setup_logger(plugin_name(), IFACE)
+        assert sorted(type(h).__name__ for h in logger.handlers) == direct_types
+        assert queue_handler.listener is None
+    finally:
+        teardown_logger(plugin_name())
+        setup_logger(plugin_name(), IFACE)
+
+
+def test_queue_logging_handler_keeps_exception():
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    queue_handler = QueueLoggingHandler([handler])
+    logger = logging.getLogger('test_queue_exception')
+    logger.propagate = False
+    logger.addHandler(queue_handler)
+    try:
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception('Division failed')
+    finally:
+        logger.removeHandler(queue_handler)
+        queue_handler.close()
+
+    fields = json.loads(JsonLinesFormatter().format(records[0]))
+    assert fields['message'] == 'Division failed'
+    assert 'ZeroDivisionError' in fields['exc']
+
+
+def test_message_bar_handler_coalesces_repeats():
+    handler = QgsMessageBarHandler(IFACE, max_messages=2)
+    handler.addFilter(QgsMessageBarFilter())
+    logger = logging.getLogger('test_message_bar_coalescing')
+    logger.propagate = False
+    logger.addHandler(handler)
+    messages = IFACE.messageBar().get_messages(Qgis.Warning)
+    count_before = len(messages)
+    try:
+        for i in range(100):
+            logger.warning('Repeated', extra=bar_msg(i))
+        for i in range(3):
+            logger.warning(f'Other {i}', extra=bar_msg(i))
+        assert messages[count_before:] == ['Repeated:0', 'Other 0:0']
+
+        handler.flush_pending()
+        assert messages[count_before + 2:] == ['Repeated (repeated 99 times):99', 'Other 1:1',
+                                               '1 more messages:See the log for details']
+    finally:
+        logger.removeHandler(handler)
+
+
+def test_qgs_log_handler_batches_records(monkeypatch):
+    messages = []
+
+    class MessageLog:
+        @staticmethod
+        def logMessage(message, tag, level):
+            messages.append(message)
+
+    monkeypatch.setattr(custom_logging, 'QgsMessageLog', MessageLog)
+    handler = QgsLogHandler(batch_interval=60, batch_size=10)
+    logger = logging.getLogger('test_qgs_log_batching')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    try:
+        logger.debug('first')
+        logger.debug('second')
+        logger.warning('third')
+        assert messages == []
+
+        logger.error('failure')
+        assert messages == ['first\nsecond', 'third', 'failure']
+
+        logger.info('buffered')
+        handler.close()
+        assert messages[-1] == 'buffered'
+    finally:
+        logger.removeHandler(handler)
+
+
+def test_set_log_level_updates_handlers_in_place():
+    logger = setup_logger(plugin_name(), IFACE)
+    bar_handler = next(h for h in logger.handlers if isinstance(h, QgsMessageBarHandler))
+    original_bar_level = get_log_level_name(LogTarget.BAR)
+    original_file_level = get_log_level_name(LogTarget.FILE)
+    try:
+        set_log_level(LogTarget.BAR, 'ERROR')
+        set_log_level(LogTarget.FILE, 'DEBUG')
+        assert get_log_level(LogTarget.BAR) == logging.ERROR
+        assert bar_handler.level == logging.ERROR
+        assert logger.level == logging.DEBUG
+        assert logging.getLogger(plugin_name()).handlers == logger.handlers
+    finally:
+        set_log_level(LogTarget.BAR, original_bar_level)
+        set_log_level(LogTarget.FILE, original_file_level)
+
+
+def test_log_sampling_per_call_site():
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger = logging.getLogger('test_log_sampling')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    enable_log_sampling('test_log_sampling', max_records=3, interval=60)
+    try:
+        for i in range(100):
+            logger.debug('Feature %d', i)
+        for i in range(5):
+            logger.info('Bar message', extra=bar_msg(i))
+        logger.error('Error')
+        logger.error('Error')
+        assert [r.getMessage() for r in records] == ['Feature 0', 'Feature 1', 'Feature 2',
+                                                     'Bar message', 'Bar message', 'Bar message',
+                                                     'Error', 'Error']
+        assert [r.details for r in records[3:6]] == ['0', '1', '2']
+
+        disable_log_sampling('test_log_sampling')
+        assert logger.filters == []
+        assert [r.getMessage().split()[0] for r in records[8:]] == ['97', '2']
+    finally:
+        disable_log_sampling('test_log_sampling')
+        logger.removeHandler(handler)
+
+
+def test_message_bar_handler_pops_only_own_items():
+    class Item:
+        def __init__(self, title):
+            self.title = title
+
+        def setLevel(self, level):
+            pass
+
+        def setDuration(self, duration):
+            pass
+
+    class MessageBar:
+        def __init__(self):
+            self.visible = [Item('QGIS message')]
+
+        def items(self):
+            return list(self.visible)
+
+        def createMessage(self, title, text):
+            return Item(title)
+
+        def pushItem(self, item):
+            self.visible.append(item)
+
+        def popWidget(self, item):
+            self.visible.remove(item)
+
+    class Iface:
+        message_bar = MessageBar()
+
+        def messageBar(self):
+            return self.message_bar
+
+    iface = Iface()
+    handler = QgsMessageBarHandler(iface, coalesce_interval=0, max_messages=2)
+    logger = logging.getLogger('test_message_bar_items')
+    logger.propagate = False
+    handler.addFilter(QgsMessageBarFilter())
+    logger.addHandler(handler)
+    try:
+        for i in range(4):
+            logger.warning(f'Message {i}', extra=bar_msg())
+    finally:
+        logger.removeHandler(handler)
+    assert [item.title for item in iface.message_bar.visible] == ['QGIS message', 'Message 2',
+                                                                  'Message 3']
+
+
+def test_log_sampling_reports_summaries_periodically():
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger = logging.getLogger('test_log_sampling_summaries')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    sampling_filter = enable_log_sampling('test_log_sampling_summaries', max_records=1,
+                                          interval=0.05)
+    try:
+        for i in range(10):
+            logger.debug('Hot loop %d', i)
+        time.sleep(0.1)
+        # Any record sweeps the expired call sites
+        logger.info('Other call site')
+        assert [r.getMessage().split(' in ')[0] for r in records] == [
+            'Hot loop 0', '9 similar messages suppressed', 'Other call site']
+
+        for i in range(10):
+            logger.debug('Hot loop %d', i)
+        time.sleep(0.1)
+        # The timer reports the summary after the logging has stopped
+        sampling_filter._timer_fired()
+        assert records[-1].getMessage().startswith('9 similar messages suppressed')
+    finally:
+        disable_log_sampling('test_log_sampling_summaries')
+        logger.removeHandler(handler)
@@ -0,0 +1,53 @@
+__copyright__ = "Copyright 2020, Gispo Ltd"
+__license__ = "GPL version 3"
+__email__ = "info@gispo.fi"
+__revision__ = "$Format:%H$"
+
+from pathlib import Path
+
+from PyQt5.QtCore import QEventLoop, QTimer
+
+from ..tools.download_manager import DownloadManager, DownloadStatus
+
+
+def test_download_manager_priority_and_dedupe(tmpdir):
+    manager = DownloadManager(max_concurrent=0)
+    low = manager.enqueue('https://example.com/a.zip', Path(tmpdir))
+    high = manager.enqueue('https://example.com/b.zip', Path(tmpdir), priority=5)
+    duplicate = manager.enqueue('https://example.com/a.zip', Path(tmpdir), priority=10)
+
+    assert duplicate is low
+    assert manager.queued_items() == [low, high]
+
+    assert manager.cancel(high.id)
+    assert high.status == DownloadStatus.Cancelled
+    assert manager.queued_items() == [low]
+
+
+def test_download_manager_dedupe_key_with_string_directory(tmpdir):
+    manager = DownloadManager(max_concurrent=0)
+    all_finished = []
+    manager.all_finished.connect(lambda: all_finished.append(True))
+    item = manager.enqueue('https://example.com/a.zip', str(tmpdir) + '/')
+    assert manager.enqueue('https://example.com/a.zip', Path(tmpdir)) is item
+
+    manager.cancel(item.id)
+    assert all_finished == [True]
+    assert manager.enqueue('https://example.com/a.zip', str(tmpdir) + '/') is not item
+
+
+def test_download_manager_downloads(new_project, http_server, tmpdir):
+    http_server.add('/a', b'a')
+    http_server.add('/b', b'b')
+    manager = DownloadManager(max_concurrent=1)
+    finished = []
+    manager.item_finished.connect(lambda item_id, path: finished.append(path))
+    loop = QEventLoop()
+    manager.all_finished.connect(loop.quit)
+    manager.enqueue(http_server.url('/a'), Path(tmpdir), 'a.html')
+    manager.enqueue(http_server.url('/b'), Path(tmpdir), 'b.html', priority=1)
+    # Do not hang if the downloads never finish
+    QTimer.singleShot(10000, loop.quit)
+    loop.exec_()
+
+    assert sorted(Path(path).name for path in finished) == ['a.html', 'b.html']
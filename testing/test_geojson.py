@@ -0,0 +1,55 @@
+__copyright__ = "Copyright 2020, Gispo Ltd"
+__license__ = "GPL version 3"
+__email__ = "info@gispo.fi"
+__revision__ = "$Format:%H$"
+
+import json
+
+import pytest
+
+from ..tools.exceptions import QgsPluginException
+from ..tools.geojson import (iter_geojson_features, iter_geojson_features_from_file,
+                             iter_geojson_features_from_url, geojson_to_memory_layer)
+
+FEATURES = [{"type": "Feature", "properties": {"id": i, "name": 'a "quoted" }{[ name'},
+             "geometry": {"type": "Point", "coordinates": [i, i]}} for i in range(100)]
+COLLECTION = {"type": "FeatureCollection", "name": "features",
+              "crs": {"properties": {"name": "features"}}, "bbox": [0, 0, 99, 99],
+              "features": FEATURES}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1024])
+def test_iter_geojson_features(chunk_size):
+    data = json.dumps(COLLECTION).encode()
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    assert list(iter_geojson_features(chunks)) == FEATURES
+
+
+def test_iter_geojson_features_incomplete():
+    data = json.dumps(COLLECTION).encode()
+    with pytest.raises(QgsPluginException):
+        list(iter_geojson_features([data[:len(data) // 2]]))
+
+
+def test_iter_geojson_features_from_file(tmpdir):
+    path = tmpdir.join('features.geojson')
+    path.write_text(json.dumps(COLLECTION), encoding='utf-8')
+    assert list(iter_geojson_features_from_file(path)) == FEATURES
+
+
+@pytest.mark.parametrize('use_requests', [True, False])
+def test_iter_geojson_features_from_gzipped_url_offline(new_project, http_server, use_requests):
+    http_server.add('/features.geojson', json.dumps(COLLECTION).encode(), gzip_body=True,
+                    headers={'Content-Type': 'application/geo+json'})
+    features = iter_geojson_features_from_url(http_server.url('/features.geojson'),
+                                              use_requests_if_available=use_requests)
+    assert list(features) == FEATURES
+    # The body was actually sent compressed
+    assert 'gzip' in http_server.requests_to('/features.geojson')[0].headers['Accept-Encoding']
+
+
+def test_geojson_to_memory_layer(new_project):
+    layer = geojson_to_memory_layer(iter(FEATURES), 'points', batch_size=30)
+    assert layer.isValid()
+    assert layer.featureCount() == 100
+    assert layer.fields().names() == ['id', 'name']
@@ -0,0 +1,45 @@
+__copyright__ = "Copyright 2020, Gispo Ltd"
+__license__ = "GPL version 3"
+__email__ = "info@gispo.fi"
+__revision__ = "$Format:%H$"
+
+import logging
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+from ..tools.custom_logging import JsonLinesFormatter, log_fields
+from ..tools.log_reader import log_files, read_log_records, summarize_elapsed
+
+
+def test_read_rotated_json_log_files(tmpdir):
+    log_file = Path(tmpdir, 'plugin.jsonl')
+    handler = RotatingFileHandler(str(log_file), maxBytes=1000, backupCount=5, encoding='utf-8')
+    handler.setFormatter(JsonLinesFormatter())
+    logger = logging.getLogger('test_json_lines')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    try:
+        for i in range(20):
+            task = 'load' if i % 2 else 'save'
+            logger.info('Loaded %d', i, extra=log_fields(elapsed=i / 10, task=task))
+        logger.error('Failed')
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    with open(log_file, 'a', encoding='utf-8') as f:
+        f.write('{"time": 1')
+
+    files = log_files(log_file)
+    assert len(files) > 1
+    assert files[-1] == log_file
+
+    records = list(read_log_records(log_file))
+    assert [r['message'] for r in records] == [f'Loaded {i}' for i in range(20)] + ['Failed']
+    assert records[0]['module'] == 'test_log_reader'
+    assert [r['message'] for r in read_log_records(tmpdir, min_level='ERROR')] == ['Failed']
+    assert len(list(read_log_records(log_file, min_elapsed=1.5))) == 5
+
+    summary = summarize_elapsed(read_log_records(log_file, task='load'))
+    assert summary['load']['count'] == 10
+    assert summary['load']['max'] == 1.9
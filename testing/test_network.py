@@ -3,17 +3,55 @@ __license__ = "GPL version 3"
 __email__ = "info@gispo.fi"
 __revision__ = "$Format:%H$"
 
+import hashlib
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+from pathlib import Path
+
 import pytest
+from PyQt5.QtCore import QEventLoop
+from qgis.core import QgsFeedback
+
+from ..tools import network
+from ..tools.exceptions import (QgsPluginNetworkException, QgsPluginCircuitOpenException,
+                                QgsPluginNetworkCancelledException,
+                                QgsPluginChecksumMismatchException)
+from ..tools.network import (fetch, download_to_file, enable_http_cache, disable_http_cache,
+                             download_many, download_with_digests, HttpCache, SessionPool,
+                             RetryPolicy, CircuitBreaker, MetricsRegistry, RequestMetrics,
+                             REQUEST_METRICS, RateLimiter, TokenBucket, RequestCoalescer,
+                             fetch_pages, fetch_offset_pages, fetch_to_layer, start_fetch,
+                             requests, _StreamResponse, _StreamReader, _TransferProgress,
+                             _extract_tar)
+
+PAYLOAD = bytes(range(256)) * 1024
+# Live network tests are run only if QGIS_PLUGIN_TOOLS_LIVE_TESTS=1
+live = pytest.mark.skipif(os.environ.get('QGIS_PLUGIN_TOOLS_LIVE_TESTS', '0') != '1',
+                          reason='live network tests are not enabled')
 
-from ..tools.exceptions import QgsPluginNetworkException
-from ..tools.network import fetch, download_to_file
 
+@pytest.fixture
+def aq_small_url(http_server) -> str:
+    http_server.add('/data/aq_small.nc', PAYLOAD)
+    return http_server.url('/data/aq_small.nc')
 
-def test_fetch(new_project):
+
+@live
+def test_fetch_live(new_project):
     data_model = fetch('https://www.gispo.fi/')
     assert len(data_model) > 10000
 
 
+def test_fetch(new_project, http_server):
+    http_server.add('/page.html', b'<html>' + b'a' * 20000 + b'</html>')
+    data_model = fetch(http_server.url('/page.html'))
+    assert len(data_model) > 10000
+
+
 def test_fetch_invalid_url(new_project):
     with pytest.raises(QgsPluginNetworkException):
         fetch('invalidurl')
@@ -35,14 +73,20 @@ def test_download_to_file_without_requests(new_project, tmpdir):
     assert path_to_file.is_file()
 
 
-def test_download_to_file_with_name(new_project, tmpdir):
-    path_to_file = download_to_file(
-        'https://raw.githubusercontent.com/GispoCoding/FMI2QGIS/master/FMI2QGIS/test/data/aq_small.nc', tmpdir)
+def test_download_to_file_with_name(new_project, tmpdir, aq_small_url):
+    path_to_file = download_to_file(aq_small_url, tmpdir)
     assert path_to_file.exists()
     assert path_to_file.is_file()
     assert path_to_file.name == 'aq_small.nc'
 
 
+def test_download_to_file_with_name_without_requests(new_project, tmpdir, aq_small_url):
+    path_to_file = download_to_file(aq_small_url, tmpdir, use_requests_if_available=False)
+    assert path_to_file.exists()
+    assert path_to_file.name == 'aq_small.nc'
+    assert path_to_file.stat().st_size > 0
+
+
 def test_download_to_file_invalid_url(new_project, tmpdir):
     with pytest.raises(QgsPluginNetworkException):
         download_to_file('invalidurl', tmpdir)
@@ -51,3 +95,606 @@ def test_download_to_file_invalid_url(new_project, tmpdir):
 def test_download_to_file_invalid_url_without_requests(new_project, tmpdir):
     with pytest.raises(QgsPluginNetworkException):
         download_to_file('invalidurl', tmpdir)
+
+
+def test_download_many(new_project, tmpdir, aq_small_url):
+    url = aq_small_url
+    results = download_many([url, 'invalidurl'], tmpdir, max_workers=2)
+    assert list(results.keys()) == [url, 'invalidurl']
+    assert results[url].ok
+    assert results[url].path.name == 'aq_small.nc'
+    assert not results['invalidurl'].ok
+    assert isinstance(results['invalidurl'].error, QgsPluginNetworkException)
+
+
+def test_download_many_without_requests(new_project, tmpdir, aq_small_url):
+    url = aq_small_url
+    results = download_many([url, url], tmpdir, use_requests_if_available=False)
+    assert len(results) == 1
+    assert results[url].path.exists()
+
+
+def test_http_cache_store_and_lookup(tmpdir):
+    cache = HttpCache(tmpdir)
+    key = cache.key('https://example.com/a.json', {'Accept': 'application/json'})
+    cache.store(key, 'https://example.com/a.json', b'{}', 'a.json',
+                {'Cache-Control': 'max-age=60', 'ETag': '"1"'})
+    entry = cache.lookup(key)
+    assert entry['etag'] == '"1"'
+    assert cache.is_fresh(entry)
+    assert cache.body(key) == b'{}'
+    assert HttpCache(tmpdir).lookup(key) is not None
+
+
+def test_http_cache_respects_no_store_and_evicts(tmpdir):
+    cache = HttpCache(tmpdir, max_size=10)
+    cache.store('a', 'a', b'12345', '', {'Cache-Control': 'no-store', 'ETag': '"a"'})
+    assert cache.lookup('a') is None
+    cache.store('b', 'b', b'123456', '', {'ETag': '"b"'})
+    cache.store('c', 'c', b'123456', '', {'ETag': '"c"'})
+    assert cache.lookup('b') is None
+    entry = cache.lookup('c')
+    assert entry is not None
+    assert not cache.is_fresh(entry)
+
+
+def _leave_part_file(http_server, tmpdir, name: str) -> None:
+    Path(tmpdir, name + '.part').write_bytes(PAYLOAD[:1000])
+    Path(tmpdir, name + '.part.validator').write_text(
+        http_server.routes['/data/aq_small.nc'].etag_value)
+
+
+def test_download_to_file_resume(new_project, http_server, tmpdir, aq_small_url):
+    _leave_part_file(http_server, tmpdir, 'resumed.nc')
+    path_to_file = download_to_file(aq_small_url, tmpdir, 'resumed.nc', resume=True)
+    assert path_to_file.read_bytes() == PAYLOAD
+    assert http_server.requests_to('/data/aq_small.nc')[-1].headers['Range'] == 'bytes=1000-'
+
+
+def test_download_to_file_resume_without_requests(new_project, http_server, tmpdir,
+                                                  aq_small_url):
+    _leave_part_file(http_server, tmpdir, 'resumed.nc')
+    path_to_file = download_to_file(aq_small_url, tmpdir, 'resumed.nc',
+                                    use_requests_if_available=False, resume=True, segments=2)
+    assert path_to_file.read_bytes() == PAYLOAD
+
+
+@pytest.mark.skipif(requests is None, reason='requests is not installed')
+def test_session_pool_reuses_sessions_per_host():
+    pool = SessionPool()
+    pool.configure('example.com', pool_size=2, keep_alive=False)
+    session = pool.session('https://example.com/a')
+    assert pool.session('https://example.com/b') is session
+    assert pool.session('https://example.org/a') is not session
+    assert session.headers['Connection'] == 'close'
+    pool.close()
+    assert pool.session('https://example.com/a') is not session
+
+
+def test_retry_policy_delay():
+    policy = RetryPolicy(backoff_factor=1, max_backoff=3, jitter=False)
+    assert [policy.delay(attempt) for attempt in range(1, 5)] == [1, 2, 3, 3]
+    assert policy.delay(1, QgsPluginNetworkException(status_code=429, retry_after=7)) == 7
+    assert policy.delay(1, QgsPluginNetworkException(status_code=429, retry_after=1000)) is None
+    assert not policy.is_retryable(QgsPluginNetworkException(status_code=404))
+    assert policy.is_retryable(QgsPluginNetworkException(status_code=503))
+
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    breaker.before_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(QgsPluginCircuitOpenException):
+        breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_fetch_invalid_url_with_retries(new_project):
+    with pytest.raises(QgsPluginNetworkException):
+        fetch('invalidurl',
+              retry_policy=RetryPolicy(max_attempts=2, backoff_factor=0, failure_threshold=None))
+
+
+@pytest.mark.parametrize('use_requests', [True, False])
+def test_download_to_file_reports_progress(new_project, tmpdir, aq_small_url, use_requests):
+    feedback = QgsFeedback()
+    path_to_file = download_to_file(aq_small_url, tmpdir, use_requests_if_available=use_requests,
+                                    feedback=feedback)
+    assert path_to_file.exists()
+    assert feedback.progress() == 100
+
+
+@pytest.mark.parametrize('use_requests', [True, False])
+def test_download_to_file_cancelled(new_project, tmpdir, aq_small_url, use_requests):
+    feedback = QgsFeedback()
+    feedback.cancel()
+    with pytest.raises(QgsPluginNetworkCancelledException):
+        download_to_file(aq_small_url, tmpdir, use_requests_if_available=use_requests,
+                         feedback=feedback)
+    assert not Path(tmpdir, 'aq_small.nc').exists()
+
+
+def test_fetch_cancelled(new_project, http_server):
+    http_server.add('/page.html', b'<html></html>')
+    feedback = QgsFeedback()
+    feedback.cancel()
+    with pytest.raises(QgsPluginNetworkCancelledException):
+        fetch(http_server.url('/page.html'), feedback=feedback)
+
+
+@pytest.mark.parametrize('use_requests', [True, False])
+def test_download_with_digests(new_project, tmpdir, aq_small_url, use_requests):
+    path_to_file, digests = download_with_digests(aq_small_url, tmpdir, ('sha256', 'md5'),
+                                                  use_requests_if_available=use_requests)
+    assert path_to_file.read_bytes() == PAYLOAD
+    assert digests == {'sha256': hashlib.sha256(PAYLOAD).hexdigest(),
+                       'md5': hashlib.md5(PAYLOAD).hexdigest()}
+
+
+def test_download_to_file_checksum_mismatch(new_project, tmpdir, aq_small_url):
+    with pytest.raises(QgsPluginChecksumMismatchException):
+        download_to_file(aq_small_url, tmpdir, expected_hash='sha256:' + '0' * 64)
+    assert not Path(tmpdir, 'aq_small.nc').exists()
+
+
+def test_metrics_registry_summary():
+    registry = MetricsRegistry(max_records=3)
+    for i in range(4):
+        metrics = RequestMetrics(f'https://example.com/{i}', 'qt')
+        metrics.response_started()
+        metrics.bytes = 10
+        metrics.finish(200)
+        registry.record(metrics)
+    failed = RequestMetrics('https://example.org/', 'requests')
+    failed.finish(error='Request failed')
+    registry.record(failed)
+    assert len(registry.records()) == 3
+    summary = registry.summary()
+    assert summary['example.com']['count'] == 2
+    assert summary['example.com']['bytes'] == 20
+    assert summary['example.com']['duration_p50'] is not None
+    assert summary['example.org']['errors'] == 1
+
+
+def test_download_to_file_records_metrics(new_project, http_server, tmpdir, aq_small_url):
+    REQUEST_METRICS.clear()
+    path_to_file = download_to_file(aq_small_url, tmpdir)
+    records = REQUEST_METRICS.records(http_server.base_url.split('//')[1])
+    assert len(records) == 1
+    assert records[0].bytes == path_to_file.stat().st_size
+    assert records[0].ttfb <= records[0].duration
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_token_bucket_reserve_does_not_block():
+    bucket = TokenBucket(rate=10, capacity=1)
+    start = time.monotonic()
+    waits = [bucket.reserve() for _ in range(4)]
+    assert time.monotonic() - start < 0.05
+    assert waits == pytest.approx([0.0, 0.1, 0.2, 0.3], abs=0.02)
+
+
+def test_rate_limiter_pauses_after_throttling():
+    limiter = RateLimiter()
+    limiter.configure('example.com', 1000)
+    assert limiter.acquire('https://example.org/') == 0
+    limiter.throttled('https://example.com/a', retry_after=0.1)
+    assert limiter.acquire('https://example.com/b') >= 0.09
+
+
+def test_fetch_pages_follows_next_links(monkeypatch):
+    def fake_fetch_raw(url, encoding, retry_policy=None):
+        number = int(url.split('page=')[-1]) if 'page=' in url else 0
+        links = [{'rel': 'next', 'href': f'items?page={number + 1}'}] if number < 3 else []
+        return json.dumps({'features': [number], 'links': links}).encode(), ''
+
+    monkeypatch.setattr(network, 'fetch_raw', fake_fetch_raw)
+    pages = list(fetch_pages('https://example.com/collections/a/items', prefetch=2))
+    assert [page['features'] for page in pages] == [[0], [1], [2], [3]]
+
+
+def test_fetch_offset_pages(monkeypatch):
+    def fake_fetch_raw(url, encoding, retry_policy=None):
+        offset = int(url.split('resultOffset=')[1].split('&')[0])
+        return json.dumps({'features': list(range(offset, min(offset + 10, 25)))}).encode(), ''
+
+    monkeypatch.setattr(network, 'fetch_raw', fake_fetch_raw)
+    pages = list(fetch_offset_pages('https://example.com/query?f=json', 10,
+                                    offset_param='resultOffset',
+                                    limit_param='resultRecordCount'))
+    assert [len(page['features']) for page in pages] == [10, 10, 5]
+
+
+def test_request_coalescer_shares_in_flight_call():
+    coalescer = RequestCoalescer()
+    calls = []
+
+    def slow_call():
+        calls.append(1)
+        time.sleep(0.2)
+        return b'content'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(coalescer.call('url', slow_call)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [b'content'] * 4
+    assert len(calls) == 1
+    assert coalescer.coalesced == 3
+    coalescer.call('url', slow_call)
+    assert len(calls) == 2
+
+
+def test_request_coalescer_raises_own_error_per_waiter():
+    coalescer = RequestCoalescer()
+
+    def failing_call():
+        time.sleep(0.2)
+        raise QgsPluginNetworkException('Request failed', status_code=503)
+
+    errors = []
+
+    def call():
+        try:
+            coalescer.call('url', failing_call)
+        except QgsPluginNetworkException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert coalescer.coalesced == 2
+    assert len({id(error) for error in errors}) == 3
+    assert all(error.status_code == 503 for error in errors)
+
+
+def test_fetch_raw_does_not_share_calls_between_retry_policies(monkeypatch):
+    keys = []
+    monkeypatch.setattr(network.REQUEST_COALESCER, 'call', lambda key, func: keys.append(key))
+    for max_attempts in (2, 2, 5):
+        network.fetch_raw('https://example.com/a',
+                          retry_policy=RetryPolicy(max_attempts=max_attempts))
+    assert keys[0] == keys[1]
+    assert keys[1] != keys[2]
+
+
+def test_request_coalescer_does_not_block_main_thread():
+    coalescer = RequestCoalescer()
+    started = threading.Event()
+    calls = []
+
+    def slow_call():
+        calls.append(threading.current_thread())
+        started.set()
+        time.sleep(0.5)
+        return b'worker'
+
+    worker = threading.Thread(target=lambda: coalescer.call('url', slow_call))
+    worker.start()
+    started.wait()
+    start = time.monotonic()
+    assert coalescer.call('url', lambda: b'main') == b'main'
+    assert time.monotonic() - start < 0.4
+    worker.join()
+    assert coalescer.coalesced == 0
+
+
+def test_request_coalescer_memoization():
+    coalescer = RequestCoalescer(memo_ttl=60)
+    calls = []
+    coalescer.call('url', lambda: calls.append(1))
+    coalescer.call('url', lambda: calls.append(1))
+    assert len(calls) == 1
+
+
+def test_fetch_to_layer(new_project, http_server):
+    country = {"type": "FeatureCollection",
+               "features": [{"type": "Feature", "id": "FIN", "properties": {"name": "Finland"},
+                             "geometry": {"type": "Polygon",
+                                          "coordinates": [[[20.6, 59.8], [31.5, 62.9],
+                                                           [28.0, 70.1], [20.6, 59.8]]]}}]}
+    http_server.add('/countries/FIN.geo.json', json.dumps(country).encode())
+    layer = fetch_to_layer(http_server.url('/countries/FIN.geo.json'))
+    assert layer.isValid()
+    assert layer.source().startswith('/vsimem/')
+    assert layer.featureCount() == 1
+
+
+class _BytesResponse(_StreamResponse):
+
+    def __init__(self, content: bytes):
+        super().__init__(200, {'Content-Length': str(len(content))})
+        self.content = content
+
+    def _iter_chunks(self, chunk_size):
+        for i in range(0, len(self.content), 1000):
+            yield self.content[i:i + 1000]
+
+
+def test_extract_tar_stream(tmpdir):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for name in ('data/a.txt', 'data/b.csv', '../outside.txt'):
+            content = name.encode() * 1000
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+
+    reader = _StreamReader(_BytesResponse(buffer.getvalue()), _TransferProgress())
+    with tarfile.open(fileobj=reader, mode='r|*') as archive:
+        extracted = _extract_tar(archive, Path(tmpdir), lambda name: not name.endswith('.csv'),
+                                 _TransferProgress())
+
+    assert extracted == [Path(tmpdir, 'data', 'a.txt').resolve()]
+    assert extracted[0].read_bytes() == b'data/a.txt' * 1000
+    assert not Path(tmpdir, 'outside.txt').exists()
+
+
+def test_stream_response_detects_short_body():
+    response = _BytesResponse(b'a' * 5000)
+    response.headers['content-length'] = '6000'
+    with pytest.raises(QgsPluginNetworkException):
+        b''.join(response.iter_content())
+
+
+def test_start_fetch(new_project, http_server):
+    http_server.add('/page.html', b'<html>' + b'a' * 20000 + b'</html>')
+    contents = []
+    errors = []
+    loop = QEventLoop()
+    async_fetch = start_fetch(http_server.url('/page.html'),
+                              callback=lambda content, name: contents.append(content),
+                              error_callback=errors.append)
+    async_fetch.finished.connect(loop.quit)
+    async_fetch.failed.connect(loop.quit)
+    loop.exec_()
+
+    assert errors == []
+    assert async_fetch.is_finished
+    assert len(contents[0]) > 10000
+
+
+def test_download_to_file_content_disposition_offline(new_project, http_server, tmpdir):
+    http_server.add('/file', PAYLOAD, filename='data.bin')
+    path_to_file = download_to_file(http_server.url('/file'), tmpdir)
+    assert path_to_file.name == 'data.bin'
+    assert path_to_file.read_bytes() == PAYLOAD
+
+
+def test_download_to_file_in_segments_offline(new_project, http_server, tmpdir):
+    http_server.add('/file', PAYLOAD, filename='data.bin')
+    path_to_file = download_to_file(http_server.url('/file'), tmpdir, segments=4)
+    assert path_to_file.read_bytes() == PAYLOAD
+    assert not Path(tmpdir, 'data.bin.part').exists()
+    assert len([r for r in http_server.requests_to('/file') if 'Range' in r.headers]) == 4
+
+
+def test_download_to_file_in_segments_removes_part_files_on_failure_offline(new_project,
+                                                                            http_server, tmpdir):
+    # The size probe and two of the segments get a dropped connection
+    http_server.add('/file', PAYLOAD, filename='data.bin', fail_times=3, drop_connection=True)
+    with pytest.raises(QgsPluginNetworkException):
+        download_to_file(http_server.url('/file'), tmpdir, segments=4,
+                         retry_policy=RetryPolicy(max_attempts=1, failure_threshold=None))
+    assert list(Path(tmpdir).iterdir()) == []
+
+
+@pytest.mark.parametrize('use_requests', [True, False])
+def test_download_to_file_in_segments_from_gzip_server_offline(new_project, http_server, tmpdir,
+                                                               use_requests):
+    http_server.add('/file', PAYLOAD, filename='data.bin', gzip_body=True)
+    path_to_file = download_to_file(http_server.url('/file'), tmpdir, segments=4,
+                                    use_requests_if_available=use_requests)
+    assert path_to_file.read_bytes() == PAYLOAD
+    assert all(r.headers.get('Accept-Encoding') == 'identity'
+               for r in http_server.requests_to('/file'))
+
+
+@pytest.mark.parametrize('use_requests', [True, False])
+def test_fetch_to_layer_gzipped_geojson_offline(new_project, http_server, use_requests):
+    collection = {"type": "FeatureCollection",
+                  "features": [{"type": "Feature", "properties": {"id": 1},
+                                "geometry": {"type": "Point", "coordinates": [25.0, 60.0]}}]}
+    http_server.add('/points.geojson', json.dumps(collection).encode(), gzip_body=True)
+    layer = fetch_to_layer(http_server.url('/points.geojson'),
+                           use_requests_if_available=use_requests)
+    assert layer.isValid()
+    assert layer.featureCount() == 1
+
+
+def test_fetch_follows_redirects_offline(new_project, http_server):
+    http_server.add('/old', redirect_to='/new')
+    http_server.add('/new', b'moved')
+    assert fetch(http_server.url('/old')) == 'moved'
+
+
+def test_fetch_retries_injected_failures_offline(new_project, http_server):
+    http_server.add('/flaky', b'ok', fail_times=2, retry_after=0)
+    retry_policy = RetryPolicy(max_attempts=3, failure_threshold=None)
+    assert fetch(http_server.url('/flaky'), retry_policy=retry_policy) == 'ok'
+    assert len(http_server.requests_to('/flaky')) == 3
+
+
+def test_http_cache_revalidates_with_etag_offline(new_project, http_server, tmpdir):
+    http_server.add('/cached', b'{}', headers={'Cache-Control': 'no-cache'})
+    enable_http_cache(cache_dir=Path(tmpdir))
+    try:
+        assert fetch(http_server.url('/cached')) == '{}'
+        assert fetch(http_server.url('/cached')) == '{}'
+    finally:
+        disable_http_cache()
+    assert http_server.requests_to('/cached')[1].headers.get('If-None-Match') is not None
+
+
+@pytest.mark.parametrize('use_requests', [True, False])
+def test_download_to_file_cancelled_offline(new_project, http_server, tmpdir, use_requests):
+    http_server.add('/slow', PAYLOAD, filename='slow.bin', bandwidth=len(PAYLOAD))
+    feedback = QgsFeedback()
+    feedback.progressChanged.connect(lambda progress: feedback.cancel() if progress > 10 else None)
+    with pytest.raises(QgsPluginNetworkCancelledException):
+        download_to_file(http_server.url('/slow'), tmpdir, use_requests_if_available=use_requests,
+                         feedback=feedback)
+
+
+@pytest.mark.parametrize('use_requests', [True, False])
+def test_download_to_file_dropped_connection_offline(new_project, http_server, tmpdir,
+                                                     use_requests):
+    route = http_server.add('/dropped', PAYLOAD, filename='dropped.bin', fail_times=1,
+                            drop_connection=True)
+    with pytest.raises(QgsPluginNetworkException):
+        download_to_file(http_server.url('/dropped'), tmpdir,
+                         use_requests_if_available=use_requests)
+    assert not Path(tmpdir, 'dropped.bin').exists()
+
+    route.fail_times = 1
+    path_to_file = download_to_file(http_server.url('/dropped'), tmpdir,
+                                    use_requests_if_available=use_requests,
+                                    retry_policy=RetryPolicy(max_attempts=2, backoff_factor=0,
+                                                             failure_threshold=None))
+    assert path_to_file.read_bytes() == PAYLOAD
+
+
+def test_circuit_breaker_counts_only_network_errors(monkeypatch):
+    monkeypatch.setattr(network, '_CIRCUIT_BREAKERS', {})
+    policy = RetryPolicy(max_attempts=1, failure_threshold=1, reset_timeout=0)
+    url = 'http://breaker.test/data'
+
+    def fail(error: Exception):
+        def func():
+            raise error
+        return func
+
+    with pytest.raises(QgsPluginNetworkException):
+        network._call_with_retries(url, fail(QgsPluginNetworkException(status_code=503)), policy)
+    breaker = network._CIRCUIT_BREAKERS['breaker.test']
+    assert (breaker.state, breaker.failures) == (CircuitBreaker.OPEN, 1)
+
+    # Local errors and cancels end the trial request without changing the counters
+    for error in (ValueError('unexpected'), QgsPluginNetworkCancelledException('cancelled')):
+        with pytest.raises(type(error)):
+            network._call_with_retries(url, fail(error), policy)
+        assert (breaker.state, breaker.failures) == (CircuitBreaker.OPEN, 1)
+
+    # A response with a non-retryable status tells that the host is up
+    with pytest.raises(QgsPluginNetworkException):
+        network._call_with_retries(url, fail(QgsPluginNetworkException(status_code=404)), policy)
+    assert (breaker.state, breaker.failures) == (CircuitBreaker.CLOSED, 0)
+    with pytest.raises(ValueError):
+        network._call_with_retries(url, fail(ValueError('unexpected')), policy)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_download_many_does_not_wait_for_busy_host():
+    started = []
+    slow_host_free = threading.Event()
+
+    def download(url):
+        started.append(url)
+        if url.startswith('http://slow.test'):
+            slow_host_free.wait(5)
+        else:
+            slow_host_free.set()
+        return network.DownloadResult(url)
+
+    urls = ['http://slow.test/1', 'http://slow.test/2', 'http://fast.test/1']
+    results = network._download_per_host(urls, download, max_workers=2, per_host_limit=1)
+    assert set(results) == set(urls)
+    # The second url of the slow host waits for the first one, the fast host does not
+    assert started[-1] == 'http://slow.test/2'
+
+
+def test_download_many_unique_names_and_errors_offline(new_project, http_server, tmpdir):
+    http_server.add('/a/data.bin', b'a' * 1000)
+    http_server.add('/b/data.bin', b'b' * 1000)
+    http_server.add('/dropped.bin', PAYLOAD, fail_times=1, drop_connection=True)
+    urls = [http_server.url(path) for path in ('/a/data.bin', '/b/data.bin', '/dropped.bin')]
+    results = download_many(urls, tmpdir)
+    assert results[urls[0]].path == Path(tmpdir, 'data.bin')
+    assert results[urls[1]].path != results[urls[0]].path
+    assert results[urls[0]].path.read_bytes() == b'a' * 1000
+    assert results[urls[1]].path.read_bytes() == b'b' * 1000
+    assert isinstance(results[urls[2]].error, QgsPluginNetworkException)
+    downloaded = [result.path.name for result in list(results.values())[:2]]
+    assert sorted(p.name for p in Path(tmpdir).iterdir()) == sorted(downloaded)
+
+
+def test_download_to_file_resume_validates_resource_offline(new_project, http_server, tmpdir):
+    route = http_server.add('/forecast', PAYLOAD, filename='forecast.bin', bandwidth=len(PAYLOAD))
+
+    def leave_part_file():
+        feedback = QgsFeedback()
+        feedback.progressChanged.connect(
+            lambda progress: feedback.cancel() if progress > 10 else None)
+        with pytest.raises(QgsPluginNetworkCancelledException):
+            download_to_file(http_server.url('/forecast'), tmpdir, resume=True, feedback=feedback)
+        assert Path(tmpdir, 'forecast.bin.part').exists()
+
+    leave_part_file()
+    route.bandwidth = None
+    path_to_file = download_to_file(http_server.url('/forecast'), tmpdir, resume=True)
+    assert path_to_file.read_bytes() == PAYLOAD
+    resumed = [r for r in http_server.requests_to('/forecast') if 'Range' in r.headers][-1]
+    assert resumed.headers['If-Range'] == route.etag_value
+
+    # The file is regenerated while the part file of the old version exists
+    route.bandwidth = len(PAYLOAD)
+    leave_part_file()
+    route.body = PAYLOAD[::-1]
+    route.bandwidth = None
+    path_to_file = download_to_file(http_server.url('/forecast'), tmpdir, resume=True)
+    assert path_to_file.read_bytes() == PAYLOAD[::-1]
+
+
+@pytest.mark.skipif(requests is None, reason='requests is not installed')
+def test_download_to_file_cancel_interrupts_stalled_read_offline(new_project, http_server, tmpdir):
+    http_server.add('/stalled', PAYLOAD, filename='stalled.bin', bandwidth=1024)
+    feedback = QgsFeedback()
+    timer = threading.Timer(0.5, feedback.cancel)
+    timer.start()
+    start = time.monotonic()
+    with pytest.raises(QgsPluginNetworkCancelledException):
+        download_to_file(http_server.url('/stalled'), tmpdir, use_requests_if_available=True,
+                         feedback=feedback)
+    timer.join()
+    assert time.monotonic() - start < 5
+    assert not Path(tmpdir, 'stalled.bin').exists()
+
+
+def test_start_fetch_honours_rate_limit_offline(new_project, http_server):
+    http_server.add('/limited', b'ok')
+    host = http_server.base_url.split('//')[1]
+    network.set_rate_limit(host, 10, burst=1)
+    try:
+        start = time.monotonic()
+        fetches = [start_fetch(http_server.url('/limited')) for _ in range(3)]
+        # Nothing blocks, the later requests are scheduled with timers
+        assert time.monotonic() - start < 0.05
+        loop = QEventLoop()
+        for async_fetch in fetches:
+            async_fetch.finished.connect(
+                lambda *args: loop.quit() if all(f.is_finished for f in fetches) else None)
+            async_fetch.failed.connect(loop.quit)
+        loop.exec_()
+    finally:
+        network.remove_rate_limit(host)
+    assert all(async_fetch.result()[0] == b'ok' for async_fetch in fetches)
+    assert time.monotonic() - start >= 0.18
@@ -0,0 +1,62 @@
+__copyright__ = "Copyright 2020, Gispo Ltd"
+__license__ = "GPL version 3"
+__email__ = "info@gispo.fi"
+__revision__ = "$Format:%H$"
+
+from osgeo import gdal
+
+from ..tools.remote_rasters import (vsicurl_uri, RemoteRasterPolicy, RemoteReadStats,
+                                    remote_read_stats, _thread_local_config_options)
+
+
+def test_vsicurl_uri():
+    url = 'https://example.com/dem.tif'
+    assert vsicurl_uri(url) == '/vsicurl/https://example.com/dem.tif'
+    assert vsicurl_uri(vsicurl_uri(url)) == vsicurl_uri(url)
+
+
+def test_vsicurl_uri_with_options():
+    uri = vsicurl_uri('https://example.com/dem.tif?token=a&b=c', max_retry=3, use_head=False)
+    assert uri == ('/vsicurl?max_retry=3&use_head=no'
+                   '&url=https%3A%2F%2Fexample.com%2Fdem.tif%3Ftoken%3Da%26b%3Dc')
+
+
+def test_vsicurl_uri_list_dir():
+    url = 'https://example.com/dem.tif'
+    assert vsicurl_uri(url, list_dir=False) == ('/vsicurl?list_dir=no'
+                                                '&url=https%3A%2F%2Fexample.com%2Fdem.tif')
+    assert 'list_dir=yes' in vsicurl_uri(url, list_dir=True)
+
+
+def test_remote_raster_policy_options():
+    policy = RemoteRasterPolicy(curl_cache_size_mb=128, merge_consecutive_ranges=False)
+    options = policy.config_options()
+    assert options['CPL_VSIL_CURL_CACHE_SIZE'] == str(128 * 1024 * 1024)
+    assert options['GDAL_HTTP_MERGE_CONSECUTIVE_RANGES'] == 'NO'
+    # Options affecting other datasets are only set while opening
+    assert 'GDAL_DISABLE_READDIR_ON_OPEN' not in options
+    assert 'CPL_VSIL_CURL_ALLOWED_EXTENSIONS' not in options
+    assert RemoteRasterPolicy().open_options()['GDAL_DISABLE_READDIR_ON_OPEN'] == 'EMPTY_DIR'
+
+
+def test_open_options_are_scoped():
+    key = 'CPL_VSIL_CURL_ALLOWED_EXTENSIONS'
+    original = gdal.GetConfigOption(key)
+    with _thread_local_config_options({key: '.tif'}):
+        assert gdal.GetConfigOption(key) == '.tif'
+    assert gdal.GetConfigOption(key) == original
+
+
+def test_remote_read_stats_not_collected(http_server):
+    http_server.add('/dem.tif', b'\0' * 1000)
+    key = 'CPL_VSIL_NETWORK_STATS_ENABLED'
+    with _thread_local_config_options({key: 'NO'}):
+        stats = remote_read_stats(http_server.url('/dem.tif'))
+    assert stats.bytes_fetched is None
+    assert stats.fraction is None
+    assert stats.file_size == 1000
+
+
+def test_remote_read_stats_fraction():
+    assert RemoteReadStats('url', 50, 1000, 2).fraction == 0.05
+    assert RemoteReadStats('url', None, 1000, None).fraction is None
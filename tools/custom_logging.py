@@ -1,12 +1,19 @@
 """Setting up logging using QGIS, file, Sentry..."""
 
+import copy
+import json
 import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from enum import Enum, unique
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from pathlib import Path
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Dict, List, Tuple, Callable, Iterator
 
-from PyQt5.QtCore import QSettings
+from PyQt5.QtCore import QSettings, QObject, QTimer, pyqtSignal, pyqtSlot
 from qgis.core import QgsMessageLog, Qgis
 from qgis.gui import QgisInterface
 
@@ -15,6 +22,11 @@ from .resources import plugin_name, plugin_path
 from .settings import setting_key
 
 PLUGIN_NAME = plugin_name()
+# Seconds the QGIS log messages are buffered in the batching mode
+LOG_BATCH_INTERVAL = 0.2
+LOG_FILE_MAX_BYTES = 1024 * 1024 * 2
+# Number of rotated JSON lines log files kept
+JSON_LOG_BACKUP_COUNT = 5
 
 __copyright__ = "Copyright 2020, Gispo Ltd"
 __license__ = "GPL version 3"
@@ -38,6 +50,13 @@ class LogTarget(Enum):
         return self.value['default']
 
 
+# Log levels of the targets cached from the settings
+_LOG_LEVELS: Dict[LogTarget, int] = {}
+_LOG_LEVEL_NAMES: Dict[LogTarget, str] = {}
+# Names of the loggers set up by this module and the targets their levels are derived from
+_CONFIGURED_LOGGERS: Dict[str, Tuple[LogTarget, ...]] = {}
+
+
 def qgis_level(logging_level):
     """Check for the corresponding QGIS Level according to Logging Level.
 
@@ -82,11 +101,98 @@ def bar_msg(details: Any = "", duration: Optional[int] = None, success: bool = F
     return args
 
 
+def log_fields(elapsed: Optional[float] = None, task: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Helper function to construct extra arguments for the fields of the JSON lines log file
+
+    :param elapsed: Duration of the logged operation in seconds
+    :param task: Name of the task or operation the message belongs to
+    """
+    args: Dict[str, Any] = {}
+    if elapsed is not None:
+        args['elapsed'] = elapsed
+    if task is not None:
+        args['task'] = task
+    return args
+
+
+@contextmanager
+def log_elapsed(logger: logging.Logger, msg: str, level: int = logging.DEBUG,
+                task: Optional[str] = None) -> Iterator[None]:
+    """
+    Logs the message with the time elapsed in the block
+
+    Example:
+        with log_elapsed(LOGGER, 'Loaded features', task='load'):
+            ...
+
+    :param logger: Logger to log with
+    :param msg: Message logged after the block
+    :param level: Logging level of the message
+    :param task: Name of the task or operation
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        # Report the line of the with statement instead of this function
+        logger.log(level, tr('{} in {:.3f} s', msg, elapsed), extra=log_fields(elapsed, task),
+                   stacklevel=3)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats the records as one JSON object per line with the fields time (seconds since epoch),
+    level, logger, module, line, thread and message. Fields task and elapsed are added if they
+    are given with log_fields and exc if the record has exception info.
+    """
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=str)
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'line': record.lineno,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        task = getattr(record, 'task', None)
+        if task is not None:
+            fields['task'] = task
+        elapsed = getattr(record, 'elapsed', None)
+        if elapsed is not None:
+            fields['elapsed'] = elapsed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            # Records passed through QueueLoggingHandler have only the formatted exception
+            fields['exc'] = record.exc_text
+        return self._encoder.encode(fields)
+
+
 class QgsLogHandler(logging.Handler):
-    """A logging handler that will log messages to the QGIS logging console."""
+    """
+    A logging handler that will log messages to the QGIS logging console.
 
-    def __init__(self, level=logging.NOTSET):
+    In batching mode the records are buffered and consecutive records of the same level are
+    delivered to QgsMessageLog as one message when the batch interval has passed, when the
+    buffer is full or immediately with ERROR and CRITICAL records.
+    """
+
+    def __init__(self, level=logging.NOTSET, batch_interval: float = 0.0, batch_size: int = 200):
+        """
+        :param batch_interval: Maximum time in seconds records are buffered. 0 disables batching
+        :param batch_size: Number of buffered records which triggers the delivery
+        """
         logging.Handler.__init__(self)
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+        self._buffer: List[Tuple[str, Any]] = []
+        self._buffer_started = 0.0
+        self._flush_timer = _FlushTimer(self.flush) if batch_interval > 0 else None
 
     def emit(self, record):
         """Try to log the message to QGIS if available, otherwise do nothing.
@@ -94,11 +200,43 @@ class QgsLogHandler(logging.Handler):
         :param record: logging record containing whatever info needs to be
                 logged.
         """
+        if self._flush_timer is None:
+            self._log_message(record.getMessage(), qgis_level(record.levelname))
+            return
+
+        with self.lock:
+            start_timer = not self._buffer
+            if start_timer:
+                self._buffer_started = time.monotonic()
+            self._buffer.append((record.getMessage(), qgis_level(record.levelname)))
+            flush_now = (len(self._buffer) >= self.batch_size or record.levelno >= logging.ERROR
+                         or time.monotonic() - self._buffer_started >= self.batch_interval)
+        if flush_now:
+            self.flush()
+        elif start_timer:
+            self._flush_timer.start(self.batch_interval)
+
+    def flush(self):
+        """ Delivers the buffered records in order """
+        # The lock is held while delivering, so that concurrent flushes cannot reorder the batches
+        with self.lock:
+            buffer, self._buffer = self._buffer, []
+            messages: List[str] = []
+            for i, (message, level) in enumerate(buffer):
+                messages.append(message)
+                if i + 1 == len(buffer) or buffer[i + 1][1] != level:
+                    self._log_message("\n".join(messages), level)
+                    messages = []
+
+    def close(self):
+        self.flush()
+        logging.Handler.close(self)
+
+    @staticmethod
+    def _log_message(message: str, level: Any):
         try:
             # noinspection PyCallByClass,PyTypeChecker
-            QgsMessageLog.logMessage(
-                record.getMessage(), PLUGIN_NAME, qgis_level(record.levelname)
-            )
+            QgsMessageLog.logMessage(message, PLUGIN_NAME, level)
         except MemoryError:
             message = tr(
                 "Due to memory limitations on this machine, the plugin {} can not "
@@ -151,12 +289,164 @@ class QgsMessageBarFilter(logging.Filter):
         return 4
 
 
+class _CallSite:
+    """ Sampling state of one logging call """
+
+    def __init__(self, now: float, record: logging.LogRecord):
+        self.window_start = now
+        self.passed = 0
+        self.seen = 0
+        self.suppressed = 0
+        self.last_suppressed = now
+        self.logger_name = record.name
+        self.level = record.levelno
+
+
+class SamplingFilter(logging.Filter):
+    """
+    A logging filter that samples the records of each call site (file and line). At most
+    max_records records per interval and/or every one_in:th record are passed. Suppressed records
+    are never formatted. The number of suppressed records of each call site is reported with a
+    summary record every interval, also after the logging has stopped. Records above max_level
+    are always passed.
+
+    Add it to the logger, not to a handler, so that it works with all the handlers and bar_msg
+    extras. See enable_log_sampling.
+    """
+
+    def __init__(self, max_records: Optional[int] = 10, interval: float = 10.0,
+                 one_in: Optional[int] = None, max_level: int = logging.INFO):
+        """
+        :param max_records: Maximum number of records passed per call site per interval. None for
+            no limit
+        :param interval: Length of the sampling window and the summary period in seconds
+        :param one_in: Pass only every one_in:th record of a call site. None passes all
+        :param max_level: Records of higher level are not sampled
+        """
+        super().__init__()
+        self.max_records = max_records
+        self.interval = interval
+        self.one_in = one_in
+        self.max_level = max_level
+        self._lock = threading.Lock()
+        self._sites: Dict[Tuple[str, int], _CallSite] = {}
+        self._next_sweep = time.monotonic() + interval
+        self._timer_started = False
+        # Reports the summaries when the sampled logging stops
+        self._flush_timer = _FlushTimer(self._timer_fired)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'sampling_summary', False):
+            return True
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._emit_summaries(self._expired_summaries(now))
+        if record.levelno > self.max_level:
+            return True
+
+        start_timer = False
+        summary = None
+        with self._lock:
+            site = self._sites.get((record.pathname, record.lineno))
+            if site is None:
+                site = self._sites[(record.pathname, record.lineno)] = _CallSite(now, record)
+            elif now - site.window_start >= self.interval:
+                summary = self._take_summary(record.pathname, record.lineno, site, now)
+            passed = ((self.one_in is None or site.seen % self.one_in == 0)
+                      and (self.max_records is None or site.passed < self.max_records))
+            site.seen += 1
+            if passed:
+                site.passed += 1
+            else:
+                site.suppressed += 1
+                site.last_suppressed = now
+                site.logger_name, site.level = record.name, record.levelno
+                start_timer = not self._timer_started
+                self._timer_started = True
+
+        if summary is not None:
+            self._emit_summaries([summary])
+        if start_timer:
+            self._flush_timer.start(self.interval)
+        return passed
+
+    def flush_summaries(self) -> None:
+        """ Reports the suppressed records of all call sites and starts new windows """
+        self._emit_summaries(self._expired_summaries(time.monotonic(), force=True))
+
+    def _timer_fired(self) -> None:
+        self._emit_summaries(self._expired_summaries(time.monotonic()))
+        with self._lock:
+            restart = any(site.suppressed for site in self._sites.values())
+            self._timer_started = restart
+        if restart:
+            self._flush_timer.start(self.interval)
+
+    def _expired_summaries(self, now: float, force: bool = False) -> List[Tuple[Any, ...]]:
+        summaries = []
+        with self._lock:
+            self._next_sweep = now + self.interval
+            for (pathname, lineno), site in self._sites.items():
+                if force or now - site.window_start >= self.interval:
+                    summary = self._take_summary(pathname, lineno, site, now)
+                    if summary is not None:
+                        summaries.append(summary)
+        return summaries
+
+    @staticmethod
+    def _take_summary(pathname: str, lineno: int, site: _CallSite,
+                      now: float) -> Optional[Tuple[Any, ...]]:
+        """
+        Starts a new window of the call site and returns the summary of the old one, if anything
+        was suppressed
+        """
+        summary = None
+        if site.suppressed:
+            summary = (pathname, lineno, site.suppressed, site.last_suppressed - site.window_start,
+                       site.logger_name, site.level)
+        site.window_start, site.passed, site.suppressed = now, 0, 0
+        return summary
+
+    def _emit_summaries(self, summaries: List[Tuple[Any, ...]]) -> None:
+        for pathname, lineno, suppressed, seconds, logger_name, level in summaries:
+            logger = logging.getLogger(logger_name)
+            record = logger.makeRecord(logger_name, level, pathname, lineno,
+                                       tr('{} similar messages suppressed in {:.1f} s',
+                                          suppressed, seconds),
+                                       (), None, extra={'sampling_summary': True})
+            logger.handle(record)
+
+
 class QgsMessageBarHandler(logging.Handler):
-    """A logging handler that will log messages to the QGIS message bar."""
+    """
+    A logging handler that will log messages to the QGIS message bar.
+
+    To keep the message bar usable when the same message is logged repeatedly, the first
+    message with a title is shown immediately and the repeats within coalesce_interval are
+    collapsed into one message with a repeat count shown when the interval ends. At most
+    max_messages new messages are shown per interval, the rest are summarized.
+    """
 
-    def __init__(self, iface: Optional[QgisInterface]):
+    def __init__(self, iface: Optional[QgisInterface], coalesce_interval: float = 1.0,
+                 max_messages: int = 5):
+        """
+        :param iface: QGIS interface
+        :param coalesce_interval: Length of the coalescing window in seconds. 0 shows every message
+        :param max_messages: Maximum number of messages shown per window and visible at once
+        """
         self.iface = iface
+        self.coalesce_interval = coalesce_interval
+        self.max_messages = max_messages
         logging.Handler.__init__(self)
+        self._bar_lock = threading.Lock()
+        self._window_open = False
+        self._window_started = 0.0
+        self._shown_in_window = set()
+        # (title, level) -> [latest record, count]
+        self._pending: 'OrderedDict[Tuple[str, Any], List[Any]]' = OrderedDict()
+        self._flush_timer = _FlushTimer(self.flush_pending) if coalesce_interval > 0 else None
+        # Message bar items pushed by this handler, oldest first
+        self._items: List[Any] = []
 
     def emit(self, record: logging.LogRecord):
         """
@@ -165,17 +455,190 @@ class QgsMessageBarHandler(logging.Handler):
 
         :param record: logging record enriched with extra information from QgsMessageBarFilter
         """
+        if self._flush_timer is None:
+            self._push(record.getMessage(), record.details, record.qgis_level, record.duration)
+            return
+
+        if self._window_open and time.monotonic() - self._window_started >= self.coalesce_interval:
+            # The timer has not fired, for example without a running event loop
+            self.flush_pending()
+
+        key = (record.getMessage(), record.qgis_level)
+        with self._bar_lock:
+            start_window = not self._window_open
+            if start_window:
+                self._window_open = True
+                self._window_started = time.monotonic()
+                self._shown_in_window = set()
+            show_now = (key not in self._shown_in_window
+                        and len(self._shown_in_window) < self.max_messages)
+            if show_now:
+                self._shown_in_window.add(key)
+            else:
+                self._pending.setdefault(key, [record, 0])
+                self._pending[key][0] = record
+                self._pending[key][1] += 1
+        if start_window:
+            self._flush_timer.start(self.coalesce_interval)
+        if show_now:
+            self._push(key[0], record.details, record.qgis_level, record.duration)
+
+    def flush_pending(self):
+        """
+        Shows the collapsed messages of the ended window. Called by the timer in the main thread
+        """
+        with self._bar_lock:
+            pending, self._pending = self._pending, OrderedDict()
+            self._shown_in_window = set(list(pending.keys())[:self.max_messages])
+            # Keep the window open while messages keep coming
+            self._window_open = bool(pending)
+            self._window_started = time.monotonic()
+        if not pending:
+            return
+
+        items = list(pending.values())
+        for record, count in items[:self.max_messages]:
+            title = record.getMessage()
+            if count > 1:
+                title = tr('{} (repeated {} times)', title, count)
+            self._push(title, record.details, record.qgis_level, record.duration)
+        skipped = items[self.max_messages:]
+        if skipped:
+            self._push(tr('{} more messages', sum(count for _, count in skipped)),
+                       tr('See the log for details'), Qgis.Warning,
+                       max(record.duration for record, _ in skipped))
+        self._flush_timer.start(self.coalesce_interval)
+
+    def _push(self, title: str, text: str, level: Any, duration: int):
         try:
             # noinspection PyUnresolvedReferences
             if self.iface is not None:
-                self.iface.messageBar().pushMessage(title=record.message,
-                                                    text=record.details,
-                                                    level=record.qgis_level,
-                                                    duration=record.duration)
+                message_bar = self.iface.messageBar()
+                if not hasattr(message_bar, 'items'):
+                    message_bar.pushMessage(title=title, text=text, level=level, duration=duration)
+                    return
+
+                # QgsMessageBar.items is available in QGIS >= 3.14. Only the items pushed by
+                # this handler are removed, messages of QGIS and other plugins stay
+                visible = message_bar.items()
+                self._items = [item for item in self._items if item in visible]
+                excess = max(len(self._items) - self.max_messages + 1, 0)
+                for item in self._items[:excess]:
+                    message_bar.popWidget(item)
+                del self._items[:excess]
+                item = message_bar.createMessage(title, text)
+                item.setLevel(level)
+                item.setDuration(duration)
+                message_bar.pushItem(item)
+                self._items.append(item)
         except MemoryError:
             pass  # This is handled in QgsLogHandler
 
 
+class _FlushTimer(QObject):
+    """
+    Single shot timer which can be started from any thread. The callback is run in the main
+    thread
+    """
+    start_requested = pyqtSignal(float)
+
+    def __init__(self, callback: Callable[[], None]):
+        super().__init__()
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(callback)
+        self.start_requested.connect(self._start)
+
+    def start(self, seconds: float):
+        self.start_requested.emit(seconds)
+
+    @pyqtSlot(float)
+    def _start(self, seconds: float):
+        self._timer.start(int(seconds * 1000))
+
+
+class _RecordEmitter(QObject):
+    record_emitted = pyqtSignal(object)
+
+    def __init__(self, handler: logging.Handler):
+        super().__init__()
+        self.handler = handler
+        # Queued connection when emitted from other threads since the emitter lives in the main
+        # thread
+        self.record_emitted.connect(self._emit)
+
+    @pyqtSlot(object)
+    def _emit(self, record: logging.LogRecord):
+        self.handler.emit(record)
+
+
+class MainThreadHandler(logging.Handler):
+    """
+    A logging handler that passes the records to the wrapped handler in the main (GUI) thread.
+    Use with handlers that touch widgets, such as QgsMessageBarHandler, when logging from other
+    threads.
+    Must be created in the main thread.
+    """
+
+    def __init__(self, handler: logging.Handler):
+        logging.Handler.__init__(self, handler.level)
+        self.handler = handler
+        self._emitter = _RecordEmitter(handler)
+
+    def emit(self, record: logging.LogRecord):
+        # Filters of the wrapped handler are run here so that only the passing records are
+        # marshalled
+        if self.handler.filter(record):
+            self._emitter.record_emitted.emit(record)
+
+    def close(self):
+        self.handler.close()
+        logging.Handler.close(self)
+
+
+class QueueLoggingHandler(QueueHandler):
+    """
+    A logging handler that puts the records to a queue. The actual handlers are run
+    in the thread of a QueueListener, so logging does not block on I/O.
+    """
+
+    def __init__(self, handlers: List[logging.Handler]):
+        QueueHandler.__init__(self, queue.SimpleQueue())
+        self.handlers = handlers
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Unlike QueueHandler.prepare, keeps the formatted exception in exc_text instead of
+        appending it to the message, so that the formatters of the handlers can write it
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            # The traceback and its frames are not passed to the listener thread
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def close(self):
+        """ Processes the queued records, stops the listener thread and closes the handlers """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            for handler in self.handlers:
+                handler.flush()
+                handler.close()
+        QueueHandler.close(self)
+
+
+# Handlers added by setup_logger without use_queue. RotatingFileHandler is a StreamHandler
+_DIRECT_HANDLER_TYPES = (logging.StreamHandler, QgsLogHandler, QgsMessageBarHandler)
+
+
 def add_logging_handler_once(logger, handler) -> bool:
     """A helper to add a handler to a logger, ensuring there are no duplicates.
 
@@ -204,20 +667,92 @@ def get_log_level_key(target: LogTarget) -> str:
 
 
 def get_log_level_name(target: LogTarget) -> str:
-    """Finds the log level name of the target """
-    return QSettings().value(get_log_level_key(target), target.default_level, str)
+    """
+    Finds the log level name of the target. The settings are read only once, see set_log_level
+    """
+    name = _LOG_LEVEL_NAMES.get(target)
+    if name is None:
+        name = QSettings().value(get_log_level_key(target), target.default_level, str)
+        _LOG_LEVELS[target] = logging.getLevelName(name)
+        _LOG_LEVEL_NAMES[target] = name
+    return name
 
 
 def get_log_level(target: LogTarget) -> int:
     """Finds log level of the target """
-    return logging.getLevelName(get_log_level_name(target))
+    level = _LOG_LEVELS.get(target)
+    if level is None:
+        get_log_level_name(target)
+        level = _LOG_LEVELS[target]
+    return level
+
 
+def set_log_level(target: LogTarget, level_name: str) -> None:
+    """Saves the log level of the target and updates the levels of the configured loggers in place
 
-def setup_logger(logger_name: str, iface: Optional[QgisInterface] = None) -> logging.Logger:
+    :param target: Log target
+    :param level_name: Name of the level, e.g. 'DEBUG'
+    """
+    QSettings().setValue(get_log_level_key(target), level_name)
+    _LOG_LEVELS[target] = logging.getLevelName(level_name)
+    _LOG_LEVEL_NAMES[target] = level_name
+    apply_log_levels()
+
+
+def reload_log_levels() -> None:
+    """Reads the log levels from the settings again and updates the configured loggers.
+    Call this if the settings were changed without set_log_level """
+    _LOG_LEVELS.clear()
+    _LOG_LEVEL_NAMES.clear()
+    apply_log_levels()
+
+
+def apply_log_levels() -> None:
+    """
+    Sets the cached log levels to the loggers and handlers configured with setup_logger or
+    setup_task_logger
+    """
+    for logger_name, logger_targets in list(_CONFIGURED_LOGGERS.items()):
+        logger = logging.getLogger(logger_name)
+        logger.setLevel(min(get_log_level(target) for target in logger_targets))
+        for target, handler in _target_handlers(logger.handlers):
+            handler.setLevel(get_log_level(target))
+
+
+def _target_handlers(handlers: List[logging.Handler]) -> List[Tuple[LogTarget, logging.Handler]]:
+    """
+    Finds the handlers whose levels are set from the log targets, also inside the wrapping
+    handlers
+    """
+    target_handlers: List[Tuple[LogTarget, logging.Handler]] = []
+    for handler in handlers:
+        if isinstance(handler, QueueLoggingHandler):
+            target_handlers += _target_handlers(handler.handlers)
+        elif isinstance(handler, MainThreadHandler):
+            if isinstance(handler.handler, QgsMessageBarHandler):
+                target_handlers += [(LogTarget.BAR, handler), (LogTarget.BAR, handler.handler)]
+        elif isinstance(handler, QgsMessageBarHandler):
+            target_handlers.append((LogTarget.BAR, handler))
+        elif isinstance(handler, RotatingFileHandler):
+            target_handlers.append((LogTarget.FILE, handler))
+        elif isinstance(handler, logging.StreamHandler):
+            target_handlers.append((LogTarget.STREAM, handler))
+    return target_handlers
+
+
+def setup_logger(logger_name: str, iface: Optional[QgisInterface] = None, use_queue: bool = False,
+                 batch_log_messages: bool = False, json_log_file: bool = False) -> logging.Logger:
     """Run once when the module is loaded and enable logging.
 
     :param logger_name: The logger name that we want to set up.
     :param iface: QGIS Interface. Add this to enable message bar support
+    :param use_queue: Run the handlers in a background thread with a QueueListener so that
+        logging does not block the calling thread on I/O. Message bar records are passed back to
+        the main thread. Call teardown_logger to flush the queue and stop the thread.
+    :param batch_log_messages: Deliver the messages to the QGIS Log Messages panel in batches.
+        ERROR and CRITICAL messages flush the batch immediately
+    :param json_log_file: Write the log file as JSON lines (logs/<logger_name>.jsonl) instead of
+        text. The files can be queried with tools.log_reader
 
     Borrowed heavily from this:
     http://docs.python.org/howto/logging-cookbook.html
@@ -236,27 +771,40 @@ def setup_logger(logger_name: str, iface: Optional[QgisInterface] = None) -> log
 
     logger = logging.getLogger(logger_name)
     logger.setLevel(min(stream_level, file_level))
+    if use_queue and any(isinstance(handler, QueueLoggingHandler) for handler in logger.handlers):
+        return logger
+    # The handlers of the other mode are removed so that the records are not handled twice
+    _remove_handlers(logger, _DIRECT_HANDLER_TYPES if use_queue else (QueueLoggingHandler,))
+    target = logging.Logger(logger_name) if use_queue else logger
 
     if logger_name != 'test_plugin':
         file_formatter = logging.Formatter("%(asctime)s - [%(levelname)-7s] - %(filename)s:%(lineno)d : %(message)s",
                                            "%d.%m.%Y %H:%M:%S")
         log_dir = Path(plugin_path("logs"))
         log_dir.mkdir(exist_ok=True)
-        file_handler = RotatingFileHandler(str(log_dir / Path(f"{logger_name}.log")), maxBytes=1024 * 1024 * 2)
+        if json_log_file:
+            file_handler = RotatingFileHandler(str(log_dir / Path(f"{logger_name}.jsonl")),
+                                               maxBytes=LOG_FILE_MAX_BYTES,
+                                               backupCount=JSON_LOG_BACKUP_COUNT,
+                                               encoding="utf-8")
+            file_formatter = JsonLinesFormatter()
+        else:
+            file_handler = RotatingFileHandler(str(log_dir / Path(f"{logger_name}.log")),
+                                               maxBytes=LOG_FILE_MAX_BYTES)
         file_handler.setFormatter(file_formatter)
         file_handler.setLevel(file_level)
-        add_logging_handler_once(logger, file_handler)
+        add_logging_handler_once(target, file_handler)
 
     console_handler = logging.StreamHandler()
     console_handler.setLevel(stream_level)
     console_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", "%d.%m.%Y %H:%M:%S")
     console_handler.setFormatter(console_formatter)
-    add_logging_handler_once(logger, console_handler)
+    add_logging_handler_once(target, console_handler)
 
-    qgis_handler = QgsLogHandler()
+    qgis_handler = QgsLogHandler(batch_interval=LOG_BATCH_INTERVAL if batch_log_messages else 0.0)
     qgis_formatter = logging.Formatter("[%(levelname)-7s]- %(message)s")
     qgis_handler.setFormatter(qgis_formatter)
-    add_logging_handler_once(logger, qgis_handler)
+    add_logging_handler_once(target, qgis_handler)
 
     if iface is None:
         try:
@@ -268,11 +816,26 @@ def setup_logger(logger_name: str, iface: Optional[QgisInterface] = None) -> log
         qgis_msg_bar_handler = QgsMessageBarHandler(iface)
         qgis_msg_bar_handler.addFilter(QgsMessageBarFilter())
         qgis_msg_bar_handler.setLevel(bar_level)
-        add_logging_handler_once(logger, qgis_msg_bar_handler)
+        bar_handler = (MainThreadHandler(qgis_msg_bar_handler) if use_queue
+                       else qgis_msg_bar_handler)
+        add_logging_handler_once(target, bar_handler)
 
+    if use_queue:
+        # The handlers were collected to the unregistered target logger
+        add_logging_handler_once(logger, QueueLoggingHandler(target.handlers))
+
+    _CONFIGURED_LOGGERS[logger_name] = (LogTarget.STREAM, LogTarget.FILE)
     return logger
 
 
+def _remove_handlers(logger: logging.Logger, handler_types: Tuple[type, ...]) -> None:
+    for handler in logger.handlers[:]:
+        if isinstance(handler, handler_types):
+            logger.removeHandler(handler)
+            handler.flush()
+            handler.close()
+
+
 def setup_task_logger(logger_name: str) -> logging.Logger:
     """ Run once when the module is loaded and enable logging during tasks.
 
@@ -289,14 +852,49 @@ def setup_task_logger(logger_name: str) -> logging.Logger:
     qgis_handler.setFormatter(qgis_formatter)
     add_logging_handler_once(logger, qgis_handler)
 
+    _CONFIGURED_LOGGERS[logger.name] = (LogTarget.STREAM,)
     return logger
 
 
+def enable_log_sampling(logger_name: str, max_records: Optional[int] = 10, interval: float = 10.0,
+                        one_in: Optional[int] = None,
+                        max_level: int = logging.INFO) -> SamplingFilter:
+    """ Samples the records of the logger per call site. See SamplingFilter for the parameters.
+
+    Example:
+        enable_log_sampling(plugin_name(), max_records=5, interval=1.0)
+        for feature in layer.getFeatures():
+            LOGGER.debug('Processing %s', feature.id())  # at most 5 per second
+
+    :return: the filter added to the logger
+    """
+    disable_log_sampling(logger_name)
+    sampling_filter = SamplingFilter(max_records, interval, one_in, max_level)
+    logging.getLogger(logger_name).addFilter(sampling_filter)
+    return sampling_filter
+
+
+def disable_log_sampling(logger_name: str) -> None:
+    """ Removes the sampling of the logger and reports the suppressed records """
+    logger = logging.getLogger(logger_name)
+    for log_filter in logger.filters[:]:
+        if isinstance(log_filter, SamplingFilter):
+            logger.removeFilter(log_filter)
+            log_filter.flush_summaries()
+
+
 def teardown_logger(logger_name: str) -> None:
-    """ Remove all handlers from the logger
+    """ Remove all handlers and the sampling from the logger. Buffered and queued records are
+    written and the listener thread is stopped if the logger was set up with use_queue
 
     :param logger_name: The logger name that we want to tear down.
     """
+    disable_log_sampling(logger_name)
     logger = logging.getLogger(logger_name)
+    _CONFIGURED_LOGGERS.pop(logger_name, None)
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
+        if isinstance(handler, QueueLoggingHandler):
+            handler.close()
+        else:
+            handler.flush()
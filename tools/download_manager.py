@@ -0,0 +1,272 @@
+__copyright__ = "Copyright 2020, Gispo Ltd"
+__license__ = "GPL version 3"
+__email__ = "info@gispo.fi"
+__revision__ = "$Format:%H$"
+
+import enum
+import heapq
+import itertools
+import logging
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple, Any
+from urllib.parse import urlparse
+
+from PyQt5.QtCore import QObject, pyqtSignal
+from qgis.core import QgsTask, QgsApplication, QgsFeedback, QgsTaskManager
+
+from .exceptions import QgsPluginNetworkCancelledException
+from .i18n import tr
+from .network import download_to_file
+from .resources import plugin_name
+
+LOGGER = logging.getLogger(plugin_name())
+
+
+@enum.unique
+class DownloadStatus(enum.Enum):
+    Queued = 'queued'
+    Running = 'running'
+    Finished = 'finished'
+    Failed = 'failed'
+    Cancelled = 'cancelled'
+
+    @property
+    def is_active(self) -> bool:
+        return self in (DownloadStatus.Queued, DownloadStatus.Running)
+
+
+class DownloadItem:
+    """ Download request handled by DownloadManager """
+
+    def __init__(self, item_id: int, url: str, output_dir: Path, output_name: Optional[str],
+                 priority: int, download_kwargs: Dict[str, Any]):
+        self.id = item_id
+        self.url = url
+        self.output_dir = output_dir
+        self.output_name = output_name
+        self.priority = priority
+        self.download_kwargs = download_kwargs
+        self.status = DownloadStatus.Queued
+        self.progress = 0.0
+        self.path: Optional[Path] = None
+        self.error: Optional[Exception] = None
+        self.task: Optional['DownloadTask'] = None
+
+    @property
+    def host(self) -> str:
+        return urlparse(self.url).netloc.lower()
+
+    @property
+    def key(self) -> Tuple[str, str, Optional[str]]:
+        return _download_key(self.url, self.output_dir, self.output_name)
+
+    def __repr__(self) -> str:
+        return f"DownloadItem({self.id}, {self.url}, {self.status.value})"
+
+
+def _download_key(url: str, output_dir: Path,
+                  output_name: Optional[str]) -> Tuple[str, str, Optional[str]]:
+    """
+    Key identifying the same download. The directory is normalized,
+    so '/tmp/out/' equals Path('/tmp/out')
+    """
+    return url, str(Path(output_dir)), output_name
+
+
+class DownloadTask(QgsTask):
+    """ QgsTask downloading one item with download_to_file """
+
+    def __init__(self, item: DownloadItem, on_finished):
+        super().__init__(tr('Downloading {}', item.url), QgsTask.CanCancel)
+        self.item = item
+        self.path: Optional[Path] = None
+        self.exception: Optional[Exception] = None
+        self._on_finished = on_finished
+        self._feedback = QgsFeedback()
+        self._feedback.progressChanged.connect(self.setProgress)
+
+    def run(self) -> bool:
+        try:
+            item = self.item
+            self.path = download_to_file(item.url, item.output_dir, item.output_name,
+                                         feedback=self._feedback, **item.download_kwargs)
+            return True
+        except Exception as e:
+            self.exception = e
+            return False
+
+    def cancel(self) -> None:
+        self._feedback.cancel()
+        super().cancel()
+
+    def finished(self, result: bool) -> None:
+        self._on_finished(self.item, result, self.path, self.exception)
+
+
+class DownloadManager(QObject):
+    """
+    Queue of background downloads run as QgsTasks. Downloads with higher priority are
+    started first and the number of concurrent transfers is capped globally and per host,
+    so that bulk downloads leave bandwidth for interactive requests. The manager should
+    be used from the main thread.
+    """
+    item_queued = pyqtSignal(int)
+    item_started = pyqtSignal(int)
+    # item id, progress 0-100
+    item_progress = pyqtSignal(int, float)
+    # item id, path to the file
+    item_finished = pyqtSignal(int, str)
+    # item id, exception
+    item_failed = pyqtSignal(int, object)
+    item_cancelled = pyqtSignal(int)
+    # Emitted when nothing is queued or running anymore
+    all_finished = pyqtSignal()
+
+    def __init__(self, max_concurrent: int = 4, per_host_limit: int = 2,
+                 task_manager: Optional[QgsTaskManager] = None):
+        """
+        :param max_concurrent: Maximum number of concurrent downloads
+        :param per_host_limit: Maximum number of concurrent downloads from one host
+        :param task_manager: Task manager running the downloads. Defaults to the global one
+        """
+        super().__init__()
+        self.max_concurrent = max_concurrent
+        self.per_host_limit = per_host_limit
+        self._task_manager = task_manager
+        self._items: Dict[int, DownloadItem] = {}
+        self._active_by_key: Dict[Tuple[str, str, Optional[str]], DownloadItem] = {}
+        self._queue: List[Tuple[int, int, DownloadItem]] = []
+        self._running: Dict[int, DownloadItem] = {}
+        self._ids = itertools.count(1)
+        self._sequence = itertools.count()
+
+    def enqueue(self, url: str, output_dir: Path, output_name: Optional[str] = None,
+                priority: int = 0, **download_kwargs) -> DownloadItem:
+        """
+        Queues a download. If the same download is already queued or running, it is returned
+        instead and its priority is raised to the given one.
+        :param url: Url of the file
+        :param output_dir: Path to the output directory
+        :param output_name: If given, use this as file name
+        :param priority: Downloads with higher priority are started first
+        :param download_kwargs: Other arguments of download_to_file, for example resume or
+            expected_hash
+        :return: queued download
+        """
+        key = _download_key(url, output_dir, output_name)
+        item = self._active_by_key.get(key)
+        if item is not None:
+            if item.status == DownloadStatus.Queued and priority > item.priority:
+                item.priority = priority
+                self._push(item)
+            return item
+
+        item = DownloadItem(next(self._ids), url, Path(output_dir), output_name, priority,
+                            download_kwargs)
+        self._items[item.id] = item
+        self._active_by_key[item.key] = item
+        self._push(item)
+        self.item_queued.emit(item.id)
+        self._schedule()
+        return item
+
+    def cancel(self, item_id: int) -> bool:
+        """
+        Cancels a queued or running download
+        :return: whether the download was active
+        """
+        item = self._items.get(item_id)
+        if item is None or not item.status.is_active:
+            return False
+        if item.status == DownloadStatus.Running:
+            item.task.cancel()
+        else:
+            # Removed from the heap lazily when it is popped
+            self._set_done(item, DownloadStatus.Cancelled)
+            self.item_cancelled.emit(item.id)
+            self._check_all_finished()
+        return True
+
+    def cancel_all(self) -> None:
+        for item in list(self._items.values()):
+            self.cancel(item.id)
+
+    def item(self, item_id: int) -> Optional[DownloadItem]:
+        return self._items.get(item_id)
+
+    def queued_items(self) -> List[DownloadItem]:
+        """ :return: queued downloads in the order they will be started """
+        return [item for neg_priority, _, item in sorted(self._queue)
+                if item.status == DownloadStatus.Queued and -neg_priority == item.priority]
+
+    def running_items(self) -> List[DownloadItem]:
+        return list(self._running.values())
+
+    def clear_finished(self) -> None:
+        """ Forgets the finished, failed and cancelled downloads """
+        self._items = {item_id: item for item_id, item in self._items.items()
+                       if item.status.is_active}
+
+    def _push(self, item: DownloadItem) -> None:
+        # Older entries of the item with lower priority are skipped when popped
+        heapq.heappush(self._queue, (-item.priority, next(self._sequence), item))
+
+    def _schedule(self) -> None:
+        skipped = []
+        while self._queue and len(self._running) < self.max_concurrent:
+            neg_priority, sequence, item = heapq.heappop(self._queue)
+            if item.status != DownloadStatus.Queued or -neg_priority != item.priority:
+                continue
+            running_on_host = sum(1 for running in self._running.values()
+                                  if running.host == item.host)
+            if running_on_host >= self.per_host_limit:
+                skipped.append((neg_priority, sequence, item))
+                continue
+            self._start(item)
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+    def _start(self, item: DownloadItem) -> None:
+        item.status = DownloadStatus.Running
+        item.task = DownloadTask(item, self._task_finished)
+        item.task.progressChanged.connect(
+            lambda progress, item_id=item.id: self._progress_changed(item_id, progress))
+        self._running[item.id] = item
+        task_manager = self._task_manager or QgsApplication.taskManager()
+        task_manager.addTask(item.task)
+        self.item_started.emit(item.id)
+
+    def _progress_changed(self, item_id: int, progress: float) -> None:
+        item = self._items.get(item_id)
+        if item is not None and item.status == DownloadStatus.Running:
+            item.progress = progress
+            self.item_progress.emit(item_id, progress)
+
+    def _task_finished(self, item: DownloadItem, result: bool, path: Optional[Path],
+                       exception: Optional[Exception]) -> None:
+        self._running.pop(item.id, None)
+        if result:
+            item.path = path
+            item.progress = 100.0
+            self._set_done(item, DownloadStatus.Finished)
+            self.item_finished.emit(item.id, str(path))
+        elif exception is None or isinstance(exception, QgsPluginNetworkCancelledException):
+            self._set_done(item, DownloadStatus.Cancelled)
+            self.item_cancelled.emit(item.id)
+        else:
+            LOGGER.warning(tr('Download of {} failed: {}', item.url, exception))
+            item.error = exception
+            self._set_done(item, DownloadStatus.Failed)
+            self.item_failed.emit(item.id, exception)
+        self._schedule()
+        self._check_all_finished()
+
+    def _set_done(self, item: DownloadItem, status: DownloadStatus) -> None:
+        item.status = status
+        item.task = None
+        if self._active_by_key.get(item.key) is item:
+            del self._active_by_key[item.key]
+
+    def _check_all_finished(self) -> None:
+        if not self._active_by_key:
+            self.all_finished.emit()
@@ -24,7 +24,29 @@ class QgsPluginException(Exception):
 
 
 class QgsPluginNetworkException(QgsPluginException):
-    pass
+
+    def __init__(self, message: Optional[str] = None, bar_msg: Optional[Dict[str, str]] = None,
+                 status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        """
+        :param status_code: HTTP status code of the failed response if any
+        :param retry_after: Seconds to wait before retrying as requested by the server with
+            Retry-After header
+        """
+        super().__init__(message, bar_msg)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class QgsPluginNetworkCancelledException(QgsPluginNetworkException):
+    default_msg = 'Request was cancelled'
+
+
+class QgsPluginChecksumMismatchException(QgsPluginNetworkException):
+    default_msg = 'Checksum of the downloaded file does not match'
+
+
+class QgsPluginCircuitOpenException(QgsPluginNetworkException):
+    default_msg = 'Host is unavailable, skipping the request'
 
 
 class QgsPluginNotImplementedException(QgsPluginException):
@@ -0,0 +1,235 @@
+__copyright__ = "Copyright 2020, Gispo Ltd"
+__license__ = "GPL version 3"
+__email__ = "info@gispo.fi"
+__revision__ = "$Format:%H$"
+
+import codecs
+import json
+import re
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Any, Iterable, Iterator, List, Optional
+
+from qgis.core import QgsJsonUtils, QgsVectorLayer, QgsFields, QgsFeedback
+
+from .exceptions import QgsPluginException
+from .i18n import tr
+from .network import fetch_chunks, CHUNK_SIZE, ENCODING
+
+STRUCTURE_PATTERN = re.compile(r'[{}\[\]"]')
+# Brackets inside a feature are balanced, so only braces are needed to find its end
+FEATURE_STRUCTURE_PATTERN = re.compile(r'[{}"]')
+STRING_END_PATTERN = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+FEATURES_KEY = "features"
+_SCAN_PREFIX, _SCAN_FEATURES, _SCAN_DONE = range(3)
+
+
+class GeoJsonFeatureParser:
+    """
+    Incremental parser of a GeoJSON FeatureCollection (or a JSON array of features).
+    Bytes are fed in arbitrary chunks and complete features are returned as soon as their
+    closing brace arrives. Only the feature being parsed is kept in memory.
+    """
+
+    def __init__(self, encoding: str = ENCODING):
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._buffer = ''
+        self._position = 0
+        self._depth = 0
+        self._features_depth = 0
+        self._feature_start: Optional[int] = None
+        self._last_string = ''
+        self._state = _SCAN_PREFIX
+
+    @property
+    def done(self) -> bool:
+        """ :return: whether the end of the features array has been reached """
+        return self._state == _SCAN_DONE
+
+    def feed(self, chunk: bytes) -> List[Dict[str, Any]]:
+        """
+        :param chunk: next bytes of the document
+        :return: features completed by the chunk
+        """
+        if self.done:
+            return []
+        self._buffer += self._decoder.decode(chunk)
+        features = self._scan()
+
+        # Drop the parsed part of the buffer
+        keep_from = self._feature_start if self._feature_start is not None else self._position
+        self._buffer = self._buffer[keep_from:]
+        self._position -= keep_from
+        if self._feature_start is not None:
+            self._feature_start = 0
+        return features
+
+    def close(self) -> None:
+        """
+        Raises QgsPluginException if the document ended before the features array was complete
+        """
+        if not self.done:
+            raise QgsPluginException(tr('GeoJSON document ended unexpectedly'))
+
+    def _scan(self) -> List[Dict[str, Any]]:
+        features = []
+        buffer = self._buffer
+        while not self.done:
+            pattern = (STRUCTURE_PATTERN if self._feature_start is None
+                       else FEATURE_STRUCTURE_PATTERN)
+            match = pattern.search(buffer, self._position)
+            if match is None:
+                self._position = len(buffer)
+                break
+            char = match.group()
+            position = match.start()
+            if char == '"':
+                string_end = STRING_END_PATTERN.match(buffer, position + 1)
+                if string_end is None:
+                    # Wait for the rest of the string
+                    self._position = position
+                    break
+                if self._feature_start is None:
+                    self._last_string = buffer[position + 1:string_end.end() - 1]
+                self._position = string_end.end()
+                continue
+
+            self._position = position + 1
+            in_features = self._state == _SCAN_FEATURES
+            if char in '{[':
+                self._depth += 1
+                if char == '[' and self._state == _SCAN_PREFIX and (
+                        self._depth == 1
+                        or (self._depth == 2 and self._last_string == FEATURES_KEY)):
+                    self._state, self._features_depth = _SCAN_FEATURES, self._depth
+                elif char == '{' and in_features and self._depth == self._features_depth + 1:
+                    self._feature_start = position
+            else:
+                if (char == '}' and self._feature_start is not None
+                        and self._depth == self._features_depth + 1):
+                    features.append(json.loads(buffer[self._feature_start:position + 1]))
+                    self._feature_start = None
+                elif char == ']' and in_features and self._depth == self._features_depth:
+                    self._state = _SCAN_DONE
+                self._depth -= 1
+        return features
+
+
+def iter_geojson_features(chunks: Iterable[bytes],
+                          encoding: str = ENCODING) -> Iterator[Dict[str, Any]]:
+    """
+    Parses GeoJSON features one at a time from chunks of bytes
+    :param chunks: chunks of a GeoJSON FeatureCollection document
+    :param encoding: Encoding of the document
+    :return: iterator of the features as dictionaries
+    """
+    parser = GeoJsonFeatureParser(encoding)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if parser.done:
+            return
+    parser.close()
+
+
+def iter_geojson_features_from_url(url: str, use_requests_if_available: bool = True,
+                                   encoding: str = ENCODING,
+                                   feedback: Optional[QgsFeedback] = None
+                                   ) -> Iterator[Dict[str, Any]]:
+    """
+    Fetches GeoJSON document and yields the features while the response is downloaded
+    :param url: address of the GeoJSON document
+    :param use_requests_if_available: Use Python package requests if it is available in the
+        environment
+    :param encoding: Encoding of the document
+    :param feedback: Feedback to report progress to and to cancel the request with
+    """
+    chunks = fetch_chunks(url, use_requests_if_available=use_requests_if_available,
+                          encoding=encoding, feedback=feedback)
+    return iter_geojson_features(chunks, encoding)
+
+
+def iter_geojson_features_from_file(path: Path,
+                                    encoding: str = ENCODING) -> Iterator[Dict[str, Any]]:
+    """
+    Yields the features of a GeoJSON file, for example one written by download_to_file
+    :param path: Path to the file
+    :param encoding: Encoding of the file
+    """
+    with open(path, 'rb') as f:
+        yield from iter_geojson_features(iter(lambda: f.read(CHUNK_SIZE), b''), encoding)
+
+
+def add_features_in_batches(layer: QgsVectorLayer, features: Iterable[Dict[str, Any]],
+                            batch_size: int = 1000,
+                            feedback: Optional[QgsFeedback] = None) -> int:
+    """
+    Adds GeoJSON features to the data provider of the layer in batches. Only one batch
+    of features is held in memory at a time.
+    :param layer: Vector layer, for example a memory layer created with create_memory_layer
+    :param features: GeoJSON features as dictionaries
+    :param batch_size: Number of features added at once
+    :param feedback: Adding stops if the feedback is canceled
+    :return: number of features added
+    """
+    fields = layer.fields()
+    provider = layer.dataProvider()
+    features = iter(features)
+    count = 0
+    while feedback is None or not feedback.isCanceled():
+        batch = list(islice(features, batch_size))
+        if not batch:
+            break
+        qgs_features = QgsJsonUtils.stringToFeatureList(
+            json.dumps({"type": "FeatureCollection", "features": batch}), fields)
+        provider.addFeatures(qgs_features)
+        count += len(qgs_features)
+    layer.updateExtents()
+    return count
+
+
+def create_memory_layer(feature: Dict[str, Any], layer_name: str,
+                        crs: str = "EPSG:4326") -> QgsVectorLayer:
+    """
+    Creates a memory layer with the geometry type and fields of the GeoJSON feature
+    :param feature: Sample feature, usually the first one
+    :param layer_name: Name of the layer
+    :param crs: Coordinate reference system of the features. GeoJSON uses EPSG:4326
+    :return: empty memory layer
+    """
+    geometry_type = (feature.get("geometry") or {}).get("type", "None")
+    layer = QgsVectorLayer(f"{geometry_type}?crs={crs}", layer_name, "memory")
+    fields: QgsFields = QgsJsonUtils.stringToFields(json.dumps(feature))
+    layer.dataProvider().addAttributes(fields.toList())
+    layer.updateFields()
+    return layer
+
+
+def geojson_to_memory_layer(features: Iterable[Dict[str, Any]], layer_name: str,
+                            batch_size: int = 1000, crs: str = "EPSG:4326",
+                            feedback: Optional[QgsFeedback] = None) -> QgsVectorLayer:
+    """
+    Loads streamed GeoJSON features to a new memory layer in batches. The fields are
+    taken from the first feature.
+
+    Example:
+        layer = geojson_to_memory_layer(iter_geojson_features_from_url(url), 'roads')
+
+    :param features: GeoJSON features as dictionaries
+    :param layer_name: Name of the layer
+    :param batch_size: Number of features added at once
+    :param crs: Coordinate reference system of the features
+    :param feedback: Loading stops if the feedback is canceled
+    :return: memory layer
+    """
+    features = iter(features)
+    first = next(features, None)
+    if first is None:
+        raise QgsPluginException(tr('No features to load'))
+    layer = create_memory_layer(first, layer_name, crs)
+    add_features_in_batches(layer, _prepend(first, features), batch_size, feedback)
+    return layer
+
+
+def _prepend(first: Dict[str, Any], rest: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    yield first
+    yield from rest
@@ -0,0 +1,122 @@
+"""Reader of the JSON lines log files written by setup_logger(..., json_log_file=True).
+Does not depend on QGIS, so it can be used to query log files collected from the users."""
+
+import json
+import logging
+import os
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator, Dict, Any, List, Optional, Union, Callable
+
+__copyright__ = "Copyright 2020, Gispo Ltd"
+__license__ = "GPL version 3"
+__email__ = "info@gispo.fi"
+__revision__ = "$Format:%H$"
+
+LOG_FILE_PATTERN = re.compile(r'(?P<base>.+\.jsonl)(\.(?P<index>\d+))?$')
+
+
+def log_files(path: Union[Path, str]) -> List[Path]:
+    """
+    Finds the log file and its rotated files
+    :param path: Path to the log file (logs/plugin.jsonl) or to a directory of log files
+    :return: files in chronological order, the oldest rotated file first
+    """
+    path = Path(path)
+    if path.is_dir():
+        candidates = list(path.iterdir())
+    else:
+        candidates = [p for p in path.parent.glob(path.name + '*')
+                      if p == path or p.name.startswith(path.name + '.')]
+
+    files = []
+    for candidate in candidates:
+        match = LOG_FILE_PATTERN.match(candidate.name)
+        if match is not None and candidate.is_file():
+            files.append((match.group('base'), -int(match.group('index') or 0), candidate))
+    return [candidate for _, _, candidate in sorted(files)]
+
+
+def read_log_records(paths: Union[Path, str, Iterable[Path]], min_level: Optional[str] = None,
+                     since: Optional[datetime] = None, until: Optional[datetime] = None,
+                     module: Optional[str] = None, task: Optional[str] = None,
+                     min_elapsed: Optional[float] = None, contains: Optional[str] = None,
+                     where: Optional[Callable[[Dict[str, Any]], bool]] = None
+                     ) -> Iterator[Dict[str, Any]]:
+    """
+    Yields the matching log records one line at a time, so the files are never loaded to
+    memory.
+    Lines which are not valid JSON, for example one cut by a crash, are skipped.
+
+    Example:
+        slow = read_log_records('logs/plugin.jsonl', min_elapsed=2.0)
+
+    :param paths: Log file, directory or files. The rotated files of a log file are included
+    :param min_level: Minimum level name, e.g. 'WARNING'
+    :param since: Only records logged at or after this time
+    :param until: Only records logged before this time
+    :param module: Only records of this module
+    :param task: Only records of this task
+    :param min_elapsed: Only records with elapsed seconds of at least this
+    :param contains: Only lines containing this text. Checked before parsing the line
+    :param where: Additional predicate of the parsed record
+    :return: records as dictionaries
+    """
+    if isinstance(paths, (str, os.PathLike)):
+        paths = log_files(paths)
+    min_level_no = logging.getLevelName(min_level) if min_level is not None else None
+    since_time = since.timestamp() if since is not None else None
+    until_time = until.timestamp() if until is not None else None
+
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if contains is not None and contains not in line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if min_level_no is not None and _level_no(record.get('level')) < min_level_no:
+                    continue
+                if since_time is not None and record.get('time', 0) < since_time:
+                    continue
+                if until_time is not None and record.get('time', 0) >= until_time:
+                    continue
+                if module is not None and record.get('module') != module:
+                    continue
+                if task is not None and record.get('task') != task:
+                    continue
+                if min_elapsed is not None and record.get('elapsed', -1) < min_elapsed:
+                    continue
+                if where is not None and not where(record):
+                    continue
+                yield record
+
+
+def summarize_elapsed(records: Iterable[Dict[str, Any]],
+                      key: str = 'task') -> Dict[str, Dict[str, float]]:
+    """
+    Aggregates the elapsed times of the records without keeping the records in memory
+    :param records: records, for example from read_log_records
+    :param key: Field to group by, e.g. 'task', 'module' or 'message'
+    :return: for example {"load": {"count": 3, "total": 4.5, "mean": 1.5, "max": 3.0}}
+    """
+    summary: Dict[str, Dict[str, float]] = {}
+    for record in records:
+        elapsed = record.get('elapsed')
+        if elapsed is None:
+            continue
+        group = summary.setdefault(str(record.get(key)), {"count": 0, "total": 0.0, "max": 0.0})
+        group["count"] += 1
+        group["total"] += elapsed
+        group["max"] = max(group["max"], elapsed)
+    for group in summary.values():
+        group["mean"] = group["total"] / group["count"]
+    return summary
+
+
+def _level_no(level_name: Optional[str]) -> int:
+    level = logging.getLevelName(level_name)
+    return level if isinstance(level, int) else logging.NOTSET
@@ -1,24 +1,53 @@
+import asyncio
+import copy
+import hashlib
+import io
+import json
 import logging
-from pathlib import Path
-from typing import Tuple, Optional
+import os
+import queue
+import random
 import shutil
+import socket
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import (Tuple, Optional, Iterable, Iterator, Dict, Any, BinaryIO, Callable, TypeVar,
+                    Sequence, List, Deque, Union)
+from urllib.parse import urlparse, urljoin, urlencode, parse_qsl, urlunparse
+from uuid import uuid4
 import re
 
-from PyQt5.QtCore import QSettings, QUrl, QByteArray
+from PyQt5.QtCore import (QSettings, QUrl, QByteArray, QEventLoop, QObject, QTimer, Qt,
+                          QCoreApplication, QThread, pyqtSignal)
 from PyQt5.QtNetwork import QNetworkRequest, QNetworkReply
-from qgis.core import Qgis, QgsBlockingNetworkRequest, QgsNetworkReplyContent
+from osgeo import gdal
+from qgis.core import (Qgis, QgsBlockingNetworkRequest, QgsNetworkReplyContent,
+                       QgsNetworkAccessManager, QgsFeedback, QgsVectorLayer, QgsRasterLayer)
 
 from .custom_logging import bar_msg
-from ..tools.exceptions import QgsPluginNetworkException
+from ..tools.exceptions import (QgsPluginException, QgsPluginNetworkException,
+                                QgsPluginCircuitOpenException, QgsPluginNetworkCancelledException,
+                                QgsPluginChecksumMismatchException)
 from ..tools.i18n import tr
-from ..tools.resources import plugin_name
+from ..tools.resources import plugin_name, plugin_path
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
     from requests.exceptions import RequestException
+    from urllib3.exceptions import HTTPError as Urllib3HTTPError
+    from urllib3.util.retry import Retry
 except ImportError:
     requests = None
     RequestException = None
+    Urllib3HTTPError = None
 
 __copyright__ = "Copyright 2020, Gispo Ltd"
 __license__ = "GPL version 3"
@@ -29,29 +58,1352 @@ LOGGER = logging.getLogger(plugin_name())
 ENCODING = "utf-8"
 CONTENT_DISPOSITION_HEADER = "Content-Disposition"
 CONTENT_DISPOSITION_BYTE_HEADER = QByteArray(bytes(CONTENT_DISPOSITION_HEADER, ENCODING))
+CHUNK_SIZE = 64 * 1024
+PART_SUFFIX = ".part"
+SEGMENTS_SUFFIX = ".part.segments"
+# Sidecar of the part file storing the ETag or Last-Modified of the resource being downloaded
+VALIDATOR_SUFFIX = ".part.validator"
+VSIMEM_PREFIX = "/vsimem/"
+ZIP_SIGNATURE = b"PK\x03\x04"
+# Minimum size of the range requests used to read zip archives
+RANGE_READAHEAD = 1024 * 1024
+# Sent with range and size requests, since byte ranges and Content-Length must refer to the
+# unencoded file
+IDENTITY_ENCODING_HEADERS = {"Accept-Encoding": "identity"}
+# Minimum interval of progress updates in seconds
+PROGRESS_INTERVAL = 0.1
+# Connect and read timeouts of the requests backend in seconds. A stalled response fails
+# instead of blocking forever
+REQUESTS_TIMEOUT = (15.0, 60.0)
+# Request headers that change the representation of the resource and thus are part of the cache key
+CACHE_KEY_HEADERS = (b"Accept", b"Accept-Encoding", b"Accept-Language", b"Authorization")
+CACHE_MAX_AGE_PATTERN = re.compile(r"max-age\s*=\s*(\d+)")
+
+RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+
+_HTTP_CACHE: Optional['HttpCache'] = None
+_DEFAULT_RETRY_POLICY: Optional['RetryPolicy'] = None
+_CIRCUIT_BREAKERS: Dict[str, 'CircuitBreaker'] = {}
+_CIRCUIT_BREAKERS_LOCK = threading.Lock()
+T = TypeVar('T')
+
+
+class DownloadResult:
+    """ Outcome of a single download in a batch """
+
+    def __init__(self, url: str, path: Optional[Path] = None, error: Optional[Exception] = None):
+        self.url = url
+        self.path = path
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        return f"DownloadResult({self.url!r}, path={self.path!r}, error={self.error!r})"
+
+
+class HttpCache:
+    """
+    Size bounded on-disk cache for HTTP responses with LRU eviction.
+    Entries are revalidated with If-None-Match/If-Modified-Since once they are stale.
+    """
+    INDEX_FILE = "index.json"
+
+    def __init__(self, cache_dir: Path, max_size: int = 50 * 1024 * 1024):
+        """
+        :param cache_dir: Directory for the cached bodies and the index
+        :param max_size: Maximum total size of the cached bodies in bytes
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = threading.RLock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._index: 'OrderedDict[str, Dict[str, Any]]' = self._load_index()
+
+    @staticmethod
+    def key(url: str, headers: Optional[Dict[str, str]] = None) -> str:
+        """ Cache key of the url and the representation affecting request headers """
+        parts = [url] + [f"{name.lower()}:{value}"
+                         for name, value in sorted((headers or {}).items())]
+        return hashlib.sha256("\n".join(parts).encode(ENCODING)).hexdigest()
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """ Returns the cache entry and marks it as the most recently used """
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None and not self._body_path(key).exists():
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                entry["last_access"] = time.time()
+                self._index.move_to_end(key)
+            return entry
+
+    @staticmethod
+    def is_fresh(entry: Dict[str, Any]) -> bool:
+        expires = entry.get("expires")
+        return expires is not None and time.time() < expires
+
+    def body(self, key: str) -> bytes:
+        with open(self._body_path(key), "rb") as f:
+            return f.read()
+
+    def store(self, key: str, url: str, body: bytes, default_name: str,
+              headers: Dict[str, str]) -> None:
+        """
+        Stores the response if the response headers allow it
+        :param headers: Response headers (Cache-Control, Expires, ETag, Last-Modified)
+        """
+        cache_control = headers.get("Cache-Control", "").lower()
+        entry = {"url": url, "default_name": default_name, "size": len(body),
+                 "last_access": time.time()}
+        entry.update(self._validators(headers))
+        if "no-store" in cache_control or len(body) > self.max_size:
+            return
+        if entry["expires"] is None and entry["etag"] is None and entry["last_modified"] is None:
+            return
+        with self._lock:
+            tmp = self._body_path(key).with_suffix(".tmp")
+            with open(tmp, "wb") as f:
+                f.write(body)
+            os.replace(tmp, self._body_path(key))
+            self._index[key] = entry
+            self._index.move_to_end(key)
+            self._evict()
+            self._save_index()
+
+    def refresh(self, key: str, headers: Dict[str, str]) -> None:
+        """ Updates the validators and freshness of the entry after 304 Not Modified """
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return
+            validators = self._validators(headers)
+            entry["expires"] = validators["expires"]
+            for name in ("etag", "last_modified"):
+                if validators[name] is not None:
+                    entry[name] = validators[name]
+            self._save_index()
+
+    def record_hit(self, revalidated: bool = False) -> None:
+        with self._lock:
+            self.hits += 1
+            if revalidated:
+                self.revalidated += 1
+
+    def record_miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._index.keys()):
+                self._remove(key)
+            self.hits = self.misses = self.revalidated = 0
+            self._save_index()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "revalidated": self.revalidated,
+                    "entries": len(self._index),
+                    "size": sum(e["size"] for e in self._index.values())}
+
+    @staticmethod
+    def _validators(headers: Dict[str, str]) -> Dict[str, Any]:
+        cache_control = headers.get("Cache-Control", "").lower()
+        expires = None
+        max_age = CACHE_MAX_AGE_PATTERN.search(cache_control)
+        if "no-cache" in cache_control:
+            expires = None
+        elif max_age is not None:
+            expires = time.time() + int(max_age.group(1))
+        elif headers.get("Expires"):
+            try:
+                expires = parsedate_to_datetime(headers["Expires"]).timestamp()
+            except (TypeError, ValueError):
+                expires = None
+        return {"expires": expires, "etag": headers.get("ETag") or None,
+                "last_modified": headers.get("Last-Modified") or None}
+
+    def _body_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.bin"
+
+    def _remove(self, key: str) -> None:
+        self._index.pop(key, None)
+        try:
+            self._body_path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        total = sum(e["size"] for e in self._index.values())
+        while total > self.max_size and self._index:
+            key, entry = next(iter(self._index.items()))
+            total -= entry["size"]
+            self._remove(key)
+
+    def _load_index(self) -> 'OrderedDict[str, Dict[str, Any]]':
+        try:
+            with open(self.cache_dir / self.INDEX_FILE, encoding=ENCODING) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        return OrderedDict(sorted(entries.items(), key=lambda item: item[1].get("last_access", 0)))
+
+    def _save_index(self) -> None:
+        tmp = self.cache_dir / f"{self.INDEX_FILE}.tmp"
+        with open(tmp, "w", encoding=ENCODING) as f:
+            json.dump(self._index, f)
+        os.replace(tmp, self.cache_dir / self.INDEX_FILE)
+
+
+def enable_http_cache(max_size: int = 50 * 1024 * 1024,
+                      cache_dir: Optional[Path] = None) -> 'HttpCache':
+    """
+    Enables persistent response cache for fetch and fetch_raw
+    :param max_size: Maximum size of the cache in bytes
+    :param cache_dir: Cache directory. Defaults to cache/http in the plugin directory
+    :return: the cache
+    """
+    global _HTTP_CACHE
+    if cache_dir is None:
+        cache_dir = Path(plugin_path("cache"), "http")
+    _HTTP_CACHE = HttpCache(cache_dir, max_size)
+    return _HTTP_CACHE
+
+
+def disable_http_cache() -> None:
+    """ Disables the response cache. Cached files are left on the disk """
+    global _HTTP_CACHE
+    _HTTP_CACHE = None
+
+
+def http_cache_stats() -> Dict[str, int]:
+    """ Returns hit and miss counters of the response cache """
+    if _HTTP_CACHE is None:
+        return {"hits": 0, "misses": 0, "revalidated": 0, "entries": 0, "size": 0}
+    return _HTTP_CACHE.stats()
+
+
+class RequestMetrics:
+    """
+    Timing of a single request. Time to first byte includes name resolution, connection setup
+    and server processing time since the backends do not expose them separately.
+    """
+
+    def __init__(self, url: str, backend: str):
+        """
+        :param url: Url of the request
+        :param backend: "requests", "qt" or "cache"
+        """
+        self.url = url
+        self.host = urlparse(url).netloc.lower()
+        self.backend = backend
+        self.cache_status = "bypass"
+        self.started = time.time()
+        self.ttfb: Optional[float] = None
+        self.duration: Optional[float] = None
+        self.bytes = 0
+        self.status_code: Optional[int] = None
+        self.error: Optional[str] = None
+        self._start = time.perf_counter()
+
+    def response_started(self) -> None:
+        if self.ttfb is None:
+            self.ttfb = time.perf_counter() - self._start
+
+    def finish(self, status_code: Optional[int] = None, error: Optional[str] = None) -> None:
+        self.duration = time.perf_counter() - self._start
+        self.status_code = status_code if status_code is not None else self.status_code
+        self.error = error if error is not None else self.error
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """ Bytes per second of the body transfer """
+        if self.duration is None or self.bytes == 0:
+            return None
+        transfer_time = self.duration - (self.ttfb or 0.0)
+        return self.bytes / transfer_time if transfer_time > 0 else None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"url": self.url, "host": self.host, "backend": self.backend,
+                "cache_status": self.cache_status, "started": self.started, "ttfb": self.ttfb,
+                "duration": self.duration, "bytes": self.bytes, "throughput": self.throughput,
+                "status_code": self.status_code, "error": self.error}
+
+    def __repr__(self) -> str:
+        return f"RequestMetrics({self.url!r}, backend={self.backend!r}, duration={self.duration})"
+
+
+class MetricsRegistry:
+    """ Thread safe in-process registry of the latest request metrics """
+
+    def __init__(self, max_records: int = 1000):
+        self._records: Deque[RequestMetrics] = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+        self.log_level: Optional[int] = None
+
+    def record(self, metrics: RequestMetrics) -> None:
+        with self._lock:
+            self._records.append(metrics)
+        if self.log_level is not None:
+            LOGGER.log(self.log_level,
+                       tr('{} {} {} in {:.3f} s (ttfb {:.3f} s, {} bytes, cache {})',
+                          metrics.backend, metrics.status_code or metrics.error, metrics.url,
+                          metrics.duration or 0.0, metrics.ttfb or 0.0, metrics.bytes,
+                          metrics.cache_status))
+
+    def records(self, host: Optional[str] = None) -> List[RequestMetrics]:
+        with self._lock:
+            return [m for m in self._records if host is None or m.host == host.lower()]
+
+    def summary(self, percentiles: Sequence[int] = (50, 90, 99)) -> Dict[str, Dict[str, Any]]:
+        """
+        Summarizes the records per host
+        :return: for example {"example.com": {"count": 3, "errors": 0, "bytes": 10,
+            "ttfb_p50": 0.1, "duration_p50": 0.2, "throughput_p50": 1000, ...}}
+        """
+        by_host: Dict[str, List[RequestMetrics]] = {}
+        for metrics in self.records():
+            by_host.setdefault(metrics.host, []).append(metrics)
+        summary = {}
+        for host, records in by_host.items():
+            host_summary = {"count": len(records),
+                            "errors": sum(1 for m in records if m.error is not None),
+                            "bytes": sum(m.bytes for m in records),
+                            "cache_hits": sum(1 for m in records
+                                              if m.cache_status in ("hit", "revalidated"))}
+            for name in ("ttfb", "duration", "throughput"):
+                values = sorted(v for v in (getattr(m, name) for m in records) if v is not None)
+                for percentile in percentiles:
+                    host_summary[f"{name}_p{percentile}"] = _percentile(values, percentile)
+            summary[host] = host_summary
+        return summary
+
+    def clear(self) -> None:
+        with self._lock:
+            self._records.clear()
+
+
+REQUEST_METRICS = MetricsRegistry()
+
+
+def enable_metrics_logging(level: int = logging.DEBUG) -> None:
+    """ Logs metrics of every request with the plugin logger """
+    REQUEST_METRICS.log_level = level
+
+
+def disable_metrics_logging() -> None:
+    REQUEST_METRICS.log_level = None
+
+
+def _percentile(sorted_values: List[float], percentile: int) -> Optional[float]:
+    """ Nearest-rank percentile """
+    if not sorted_values:
+        return None
+    rank = max(int(-(-percentile * len(sorted_values) // 100)), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class TokenBucket:
+    """ Thread safe token bucket allowing rate requests per second with bursts up to capacity """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        :param rate: Number of tokens added per second
+        :param capacity: Maximum number of tokens. Defaults to max(rate, 1)
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Takes one token, blocking until it is available
+        :return: seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def reserve(self) -> float:
+        """
+        Takes one token without blocking. If none is available, the token is borrowed from
+        the future and later callers wait longer
+        :return: seconds to wait before using the token
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = max(self._paused_until - now, 0.0)
+            if self._tokens < 0:
+                wait = max(wait, -self._tokens / self.rate)
+            return wait
+
+    def pause(self, seconds: float) -> None:
+        """ Stops handing out tokens for the given time and empties the bucket """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RateLimiter:
+    """
+    Per-host rate limits shared by all threads. Requests to hosts without
+    a configured limit are not delayed.
+    """
+    # Pause after 429 Too Many Requests without Retry-After header in seconds
+    DEFAULT_PAUSE = 1.0
+
+    def __init__(self):
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, host: str, requests_per_second: float,
+                  burst: Optional[int] = None) -> None:
+        """
+        :param host: Host (netloc) of the urls, for example "example.com:8080"
+        :param requests_per_second: Sustained request rate
+        :param burst: Number of requests that can be sent at once after idle time
+        """
+        with self._lock:
+            self._buckets[host.lower()] = TokenBucket(requests_per_second, burst)
+
+    def remove(self, host: str) -> None:
+        with self._lock:
+            self._buckets.pop(host.lower(), None)
+
+    def acquire(self, url: str) -> float:
+        """ Blocks until the request to the url is allowed. Returns seconds waited """
+        bucket = self._bucket(url)
+        return bucket.acquire() if bucket is not None else 0.0
+
+    def reserve(self, url: str) -> float:
+        """
+        Reserves a request to the url without blocking, for callers that must not sleep,
+        such as the Qt event loop
+        :return: seconds to wait before sending the request
+        """
+        bucket = self._bucket(url)
+        return bucket.reserve() if bucket is not None else 0.0
+
+    def throttled(self, url: str, retry_after: Optional[float] = None) -> None:
+        """ Pauses requests to the host after 429 Too Many Requests response """
+        bucket = self._bucket(url)
+        if bucket is not None:
+            bucket.pause(retry_after if retry_after is not None else self.DEFAULT_PAUSE)
+
+    def _bucket(self, url: str) -> Optional[TokenBucket]:
+        with self._lock:
+            return self._buckets.get(urlparse(url).netloc.lower())
+
+
+RATE_LIMITER = RateLimiter()
+
+
+def set_rate_limit(host: str, requests_per_second: float, burst: Optional[int] = None) -> None:
+    """
+    Limits the request rate to the host for all fetch and download helpers
+    :param host: Host (netloc) of the urls, for example "example.com:8080"
+    :param requests_per_second: Sustained request rate
+    :param burst: Number of requests that can be sent at once after idle time
+    """
+    RATE_LIMITER.configure(host, requests_per_second, burst)
+
+
+def remove_rate_limit(host: str) -> None:
+    RATE_LIMITER.remove(host)
+
+
+def _rate_limited(url: str, error: QgsPluginNetworkException) -> None:
+    if error.status_code == 429:
+        RATE_LIMITER.throttled(url, error.retry_after)
+
+
+class SessionPool:
+    """
+    Thread safe pool of keep-alive requests sessions, one session per host.
+    Connections to the same host are reused across calls and threads.
+    """
+    DEFAULT_HOST = "*"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, 'requests.Session'] = {}
+        self._configs: Dict[str, Dict[str, Any]] = {
+            self.DEFAULT_HOST: {"pool_size": 10, "keep_alive": True, "retries": 0,
+                                "backoff_factor": 0.0}}
+
+    def configure(self, host: Optional[str] = None, pool_size: int = 10, keep_alive: bool = True,
+                  retries: int = 0, backoff_factor: float = 0.0) -> None:
+        """
+        Configures sessions for the host
+        :param host: Host (netloc) of the urls, for example "example.com:8080". If None,
+            configures the default
+        :param pool_size: Maximum number of kept connections to the host
+        :param keep_alive: Whether to keep the connections open between requests
+        :param retries: Number of retries on connection errors by the HTTP adapter
+        :param backoff_factor: Backoff factor of the adapter retries in seconds
+        """
+        host = (host or self.DEFAULT_HOST).lower()
+        with self._lock:
+            self._configs[host] = {"pool_size": pool_size, "keep_alive": keep_alive,
+                                   "retries": retries, "backoff_factor": backoff_factor}
+            # Configuration is applied to new sessions
+            for session_host in [h for h in self._sessions if host in (self.DEFAULT_HOST, h)]:
+                self._sessions.pop(session_host).close()
+
+    def session(self, url: str) -> 'requests.Session':
+        """ Returns the shared session of the host of the url """
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                config = self._configs.get(host, self._configs[self.DEFAULT_HOST])
+                session = self._create_session(config)
+                self._sessions[host] = session
+            return session
+
+    def close(self) -> None:
+        """ Closes all sessions and their connections """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    @staticmethod
+    def _create_session(config: Dict[str, Any]) -> 'requests.Session':
+        session = requests.Session()
+        retries = Retry(total=config["retries"], backoff_factor=config["backoff_factor"],
+                        raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config["pool_size"],
+                              max_retries=retries)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not config["keep_alive"]:
+            session.headers["Connection"] = "close"
+        return session
+
+
+SESSION_POOL = SessionPool()
+
+
+def configure_session(host: Optional[str] = None, pool_size: int = 10, keep_alive: bool = True,
+                      retries: int = 0, backoff_factor: float = 0.0) -> None:
+    """
+    Configures the pooled requests sessions used by the download and fetch helpers.
+    See SessionPool.configure for the parameters.
+    """
+    SESSION_POOL.configure(host, pool_size, keep_alive, retries, backoff_factor)
+
+
+def close_sessions() -> None:
+    """ Closes pooled connections. Call this when the plugin is unloaded """
+    SESSION_POOL.close()
+
+
+class RetryPolicy:
+    """
+    Retry policy with exponential backoff and jitter. Retry-After header of the
+    response is honoured. Optionally uses a per-host circuit breaker.
+    """
+
+    def __init__(self, max_attempts: int = 3, backoff_factor: float = 0.5,
+                 max_backoff: float = 30.0, jitter: bool = True,
+                 retry_statuses: Tuple[int, ...] = RETRY_STATUSES,
+                 respect_retry_after: bool = True, max_retry_after: float = 120.0,
+                 failure_threshold: Optional[int] = 5, reset_timeout: float = 30.0):
+        """
+        :param max_attempts: Maximum number of attempts including the first one
+        :param backoff_factor: Delay before the first retry in seconds, doubled on each retry
+        :param max_backoff: Maximum delay between the attempts in seconds
+        :param jitter: Randomize the delays ("full jitter") to spread retries of concurrent callers
+        :param retry_statuses: HTTP status codes which are retried. Connection errors are always
+            retried
+        :param respect_retry_after: Wait for the time requested by the server with Retry-After
+            header
+        :param max_retry_after: Maximum accepted Retry-After in seconds. Longer waits fail
+            immediately
+        :param failure_threshold: Number of consecutive failures after which the circuit of the
+            host opens. If None, circuit breaker is not used
+        :param reset_timeout: Seconds after which an open circuit lets a trial request through
+        """
+        self.max_attempts = max(max_attempts, 1)
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self.respect_retry_after = respect_retry_after
+        self.max_retry_after = max_retry_after
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    def is_retryable(self, error: QgsPluginNetworkException) -> bool:
+        if isinstance(error, (QgsPluginCircuitOpenException, QgsPluginNetworkCancelledException,
+                              QgsPluginChecksumMismatchException)):
+            return False
+        return error.status_code is None or error.status_code in self.retry_statuses
+
+    def delay(self, attempt: int,
+              error: Optional[QgsPluginNetworkException] = None) -> Optional[float]:
+        """
+        :param attempt: Number of the failed attempt starting from 1
+        :return: Seconds to wait before the next attempt or None if the request should not be
+            retried
+        """
+        if error is not None and error.retry_after is not None and self.respect_retry_after:
+            return error.retry_after if error.retry_after <= self.max_retry_after else None
+        backoff = min(self.max_backoff, self.backoff_factor * 2 ** (attempt - 1))
+        return random.uniform(0, backoff) if self.jitter else backoff
+
+
+class CircuitBreaker:
+    """
+    Fails requests to a host fast after consecutive failures. After reset_timeout
+    one trial request is let through, and its outcome closes or reopens the circuit.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_request(self, host: str = '') -> None:
+        """ Raises QgsPluginCircuitOpenException if the request should not be sent """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            reset = time.monotonic() - self._opened_at >= self.reset_timeout
+            if self.state == self.OPEN and reset:
+                self.state = self.HALF_OPEN
+                return
+        raise QgsPluginCircuitOpenException(
+            tr('Host {} is unavailable, skipping the request', host),
+            bar_msg=bar_msg(tr('Too many failed requests')))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """ Ends the trial request without an outcome. The next request is let through instead """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_error(self, error: BaseException, retryable: bool) -> None:
+        """
+        Records a failed request. Only retryable network errors count as failures, a response
+        with another error status tells that the host is up. Cancels and local errors release
+        the trial request.
+        """
+        if retryable:
+            self.record_failure()
+        elif isinstance(error, QgsPluginNetworkException) and error.status_code is not None:
+            self.record_success()
+        else:
+            self.release()
+
+
+def set_default_retry_policy(policy: Optional[RetryPolicy]) -> None:
+    """
+    Sets retry policy used by fetch and download helpers when no policy is passed.
+    None disables retries, which is the default.
+    """
+    global _DEFAULT_RETRY_POLICY
+    _DEFAULT_RETRY_POLICY = policy
+
+
+def circuit_breaker(host: str, policy: RetryPolicy) -> Optional[CircuitBreaker]:
+    """ Returns the shared circuit breaker of the host or None if the policy does not use one """
+    if policy.failure_threshold is None:
+        return None
+    with _CIRCUIT_BREAKERS_LOCK:
+        breaker = _CIRCUIT_BREAKERS.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(policy.failure_threshold, policy.reset_timeout)
+            _CIRCUIT_BREAKERS[host] = breaker
+        return breaker
+
+
+def _call_with_retries(url: str, func: Callable[[], T], retry_policy: Optional[RetryPolicy]) -> T:
+    policy = retry_policy or _DEFAULT_RETRY_POLICY
+    if policy is None:
+        return func()
+    host = urlparse(url).netloc.lower()
+    breaker = circuit_breaker(host, policy)
+    attempt = 0
+    while True:
+        attempt += 1
+        if breaker is not None:
+            breaker.before_request(host)
+        try:
+            result = func()
+        except QgsPluginNetworkException as e:
+            retryable = policy.is_retryable(e)
+            if breaker is not None:
+                breaker.record_error(e, retryable)
+            can_retry = retryable and attempt < policy.max_attempts
+            delay = policy.delay(attempt, e) if can_retry else None
+            if delay is None:
+                raise
+            LOGGER.debug(tr('Retrying {} in {:.1f} s ({})', url, delay, e))
+            time.sleep(delay)
+            continue
+        except BaseException as e:
+            # Local errors, for example in extracting the content, must end the trial of a
+            # half-open circuit too
+            if breaker is not None:
+                breaker.record_error(e, retryable=False)
+            raise
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """ Parses Retry-After header given either in seconds or as HTTP date """
+    value = (value or '').strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
 
+class _InFlight:
+    def __init__(self):
+        self.owner = threading.get_ident()
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
 
-def fetch(url: str, encoding: str = ENCODING) -> str:
+
+def _in_main_thread() -> bool:
+    app = QCoreApplication.instance()
+    if app is None:
+        return threading.current_thread() is threading.main_thread()
+    return QThread.currentThread() == app.thread()
+
+
+class RequestCoalescer:
+    """
+    Shares the result of one in-flight request with all concurrent callers
+    asking for the same resource. Successful results can additionally be
+    memoized for a short time.
+    """
+
+    def __init__(self, memo_ttl: float = 0.0, max_memoized: int = 100):
+        """
+        :param memo_ttl: Seconds to reuse a completed result. 0 disables memoization
+        :param max_memoized: Maximum number of memoized results
+        """
+        self.memo_ttl = memo_ttl
+        self.max_memoized = max_memoized
+        self.coalesced = 0
+        self._in_flight: Dict[Any, _InFlight] = {}
+        self._memo: 'OrderedDict[Any, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, memo_ttl: float, max_memoized: int = 100) -> None:
+        with self._lock:
+            self.memo_ttl = memo_ttl
+            self.max_memoized = max_memoized
+            self._memo.clear()
+
+    def call(self, key: Any, func: Callable[[], T]) -> T:
+        """
+        Calls func unless a call with the same key is already running, in
+        which case waits for it and returns its result or raises a copy of its error
+        """
+        with self._lock:
+            memoized = self._memo.get(key)
+            if memoized is not None:
+                if memoized[0] > time.monotonic():
+                    self._memo.move_to_end(key)
+                    self.coalesced += 1
+                    return memoized[1]
+                del self._memo[key]
+            call = self._in_flight.get(key)
+            # Waiting on a call started by the same thread (re-entrant event loop) would never
+            # return. The main thread does not wait for workers either: it would freeze the UI
+            # and deadlock if the worker needed the main thread, for example for an
+            # authentication or SSL prompt
+            owner = call is None or call.owner == threading.get_ident() or _in_main_thread()
+            if owner:
+                call = _InFlight()
+                self._in_flight[key] = call
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            call.done.wait()
+            if call.error is not None:
+                # Raising the same instance in several threads would mix up its traceback
+                raise _copy_error(call.error) from call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        else:
+            self._memoize(key, call.result)
+            return call.result
+        finally:
+            with self._lock:
+                if self._in_flight.get(key) is call:
+                    del self._in_flight[key]
+            call.done.set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memo.clear()
+            self.coalesced = 0
+
+    def _memoize(self, key: Any, result: Any) -> None:
+        with self._lock:
+            if self.memo_ttl <= 0:
+                return
+            self._memo[key] = (time.monotonic() + self.memo_ttl, result)
+            self._memo.move_to_end(key)
+            while len(self._memo) > self.max_memoized:
+                self._memo.popitem(last=False)
+
+
+def _copy_error(error: BaseException) -> BaseException:
+    if isinstance(error, QgsPluginException):
+        # Keeps the type, message, bar_msg and status code
+        return copy.copy(error)
+    return QgsPluginNetworkException(tr('Request failed'), bar_msg=bar_msg(error))
+
+
+REQUEST_COALESCER = RequestCoalescer()
+
+
+def set_request_memoization(seconds: float, max_entries: int = 100) -> None:
+    """
+    Reuses completed fetch results for the given time. Concurrent identical
+    fetches are always coalesced regardless of this setting.
+    :param seconds: Seconds to reuse a result. 0 disables memoization
+    :param max_entries: Maximum number of memoized responses
+    """
+    REQUEST_COALESCER.configure(seconds, max_entries)
+
+
+def fetch(url: str, encoding: str = ENCODING, use_cache: bool = True,
+          retry_policy: Optional['RetryPolicy'] = None, feedback: Optional[QgsFeedback] = None,
+          coalesce: bool = True) -> str:
     """
     Fetch resource from the internet. Similar to requests.get(url) but is
     recommended way of handling requests in QGIS plugin
     :param url: address of the web resource
     :param encoding: Encoding which will be used to decode the bytes
+    :param use_cache: Use the response cache if it is enabled with enable_http_cache
+    :param retry_policy: Retry policy. Defaults to the one set with set_default_retry_policy
+    :param feedback: Feedback to report progress to and to cancel the request with
+    :param coalesce: Share the response with concurrent fetches of the same url. Not used with
+        feedback
     :return: encoded string of the content
     """
-    content, _ = fetch_raw(url, encoding)
+    content, _ = fetch_raw(url, encoding, use_cache=use_cache, retry_policy=retry_policy,
+                           feedback=feedback, coalesce=coalesce)
     return content.decode(ENCODING)
 
 
-def fetch_raw(url: str, encoding: str = ENCODING) -> Tuple[bytes, str]:
+def fetch_raw(url: str, encoding: str = ENCODING, use_cache: bool = True,
+              retry_policy: Optional['RetryPolicy'] = None, feedback: Optional[QgsFeedback] = None,
+              coalesce: bool = True) -> Tuple[bytes, str]:
     """
     Fetch resource from the internet. Similar to requests.get(url) but is
     recommended way of handling requests in QGIS plugin
     :param url: address of the web resource
     :param encoding: Encoding which will be used to decode the bytes
+    :param use_cache: Use the response cache if it is enabled with enable_http_cache
+    :param retry_policy: Retry policy. Defaults to the one set with set_default_retry_policy
+    :param feedback: Feedback to report progress to and to cancel the request with
+    :param coalesce: Share the response with concurrent fetches of the same url. Not used with
+        feedback
+    :return: bytes of the content and default name of the file or empty string
+    """
+    if coalesce and feedback is None:
+        # Callers with different retry policies do not share the call
+        policy = retry_policy or _DEFAULT_RETRY_POLICY
+        policy_key = tuple(sorted(vars(policy).items())) if policy is not None else None
+        return REQUEST_COALESCER.call(
+            (url, encoding, use_cache, policy_key),
+            lambda: _call_with_retries(url, lambda: _fetch_raw(url, encoding, use_cache, None),
+                                       policy))
+    return _call_with_retries(url, lambda: _fetch_raw(url, encoding, use_cache, feedback),
+                              retry_policy)
+
+
+class AsyncFetch(QObject):
+    """
+    Fetch running in the Qt event loop without blocking it. Emits finished(content, default_name)
+    or failed(exception) when done. The fetch can also be awaited in an asyncio event loop running
+    on top of the Qt event loop (for example qasync). Create with start_fetch.
+    """
+    finished = pyqtSignal(bytes, str)
+    failed = pyqtSignal(object)
+
+    def __init__(self, url: str, encoding: str = ENCODING,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 feedback: Optional[QgsFeedback] = None):
+        super().__init__()
+        self.url = url
+        self.encoding = encoding
+        self.error: Optional[QgsPluginNetworkException] = None
+        self._host = urlparse(url).netloc.lower()
+        self._policy = retry_policy or _DEFAULT_RETRY_POLICY
+        self._breaker = (circuit_breaker(self._host, self._policy) if self._policy is not None
+                         else None)
+        self._progress = _TransferProgress(feedback)
+        self._attempt = 0
+        self._reply: Optional[QNetworkReply] = None
+        self._metrics: Optional[RequestMetrics] = None
+        self._result: Optional[Tuple[bytes, str]] = None
+        self._aborted = False
+        self._done = False
+        self._done_callbacks: List[Callable[[], None]] = []
+        if feedback is not None:
+            feedback.canceled.connect(self.abort)
+
+    @property
+    def is_finished(self) -> bool:
+        return self._done
+
+    def result(self) -> Tuple[bytes, str]:
+        """
+        :return: bytes of the content and default name of the file or empty string
+        :raises QgsPluginNetworkException: if the fetch failed
+        """
+        if not self._done:
+            raise QgsPluginNetworkException(tr('Request is not finished'))
+        if self.error is not None:
+            raise self.error
+        return self._result
+
+    def start(self) -> None:
+        """
+        Sends the request once the rate limit of the host allows it. Called again by the
+        retries
+        """
+        if self._done:
+            return
+        if self._aborted or self._progress.canceled:
+            self._finish(error=QgsPluginNetworkCancelledException(tr('Request was cancelled')))
+            return
+        wait = RATE_LIMITER.reserve(self.url)
+        if wait > 0:
+            QTimer.singleShot(int(wait * 1000), self._send)
+        else:
+            self._send()
+
+    def _send(self) -> None:
+        if self._done:
+            # Aborted while waiting for the rate limit
+            return
+        self._attempt += 1
+        if self._breaker is not None:
+            try:
+                self._breaker.before_request(self._host)
+            except QgsPluginNetworkException as e:
+                self._finish(error=e)
+                return
+        LOGGER.debug(self.url)
+        req = _build_request(self.url, self.encoding)
+        req.setAttribute(QNetworkRequest.FollowRedirectsAttribute, True)
+        self._metrics = RequestMetrics(self.url, "qt")
+        self._reply = QgsNetworkAccessManager.instance().get(req)
+        self._reply.downloadProgress.connect(self._progress.update)
+        self._reply.metaDataChanged.connect(self._metrics.response_started)
+        self._reply.finished.connect(self._reply_finished)
+
+    def abort(self) -> None:
+        """ Cancels the request. failed is emitted with QgsPluginNetworkCancelledException """
+        if self._done:
+            return
+        self._aborted = True
+        if self._reply is not None:
+            self._reply.abort()
+        else:
+            # Waiting for a retry
+            self.start()
+
+    def _reply_finished(self) -> None:
+        reply, metrics = self._reply, self._metrics
+        self._reply = None
+        status_code = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        try:
+            if self._aborted or self._progress.canceled:
+                raise QgsPluginNetworkCancelledException(tr('Request was cancelled'))
+            if reply.error() != QNetworkReply.NoError:
+                retry_after = bytes(reply.rawHeader(QByteArray(b"Retry-After"))).decode(
+                    self.encoding)
+                raise QgsPluginNetworkException(tr('Request failed'),
+                                                bar_msg=bar_msg(reply.errorString()),
+                                                status_code=status_code,
+                                                retry_after=_parse_retry_after(retry_after))
+            content = bytes(reply.readAll())
+            default_name = _default_name_from_header(
+                bytes(reply.rawHeader(CONTENT_DISPOSITION_BYTE_HEADER)).decode(self.encoding))
+        except QgsPluginNetworkException as e:
+            metrics.finish(status_code, str(e))
+            REQUEST_METRICS.record(metrics)
+            _rate_limited(self.url, e)
+            self._attempt_failed(e)
+        else:
+            metrics.bytes = len(content)
+            metrics.finish(status_code)
+            REQUEST_METRICS.record(metrics)
+            if self._breaker is not None:
+                self._breaker.record_success()
+            self._finish(result=(content, default_name))
+        finally:
+            reply.deleteLater()
+
+    def _attempt_failed(self, error: QgsPluginNetworkException) -> None:
+        policy = self._policy
+        if policy is None:
+            self._finish(error=error)
+            return
+        retryable = policy.is_retryable(error)
+        if self._breaker is not None:
+            self._breaker.record_error(error, retryable)
+        can_retry = retryable and self._attempt < policy.max_attempts
+        delay = policy.delay(self._attempt, error) if can_retry else None
+        if delay is None:
+            self._finish(error=error)
+            return
+        LOGGER.debug(tr('Retrying {} in {:.1f} s ({})', self.url, delay, error))
+        QTimer.singleShot(int(delay * 1000), self.start)
+
+    def _finish(self, result: Optional[Tuple[bytes, str]] = None,
+                error: Optional[QgsPluginNetworkException] = None) -> None:
+        self._done = True
+        self._result, self.error = result, error
+        _PENDING_FETCHES.discard(self)
+        if error is not None:
+            self.failed.emit(error)
+        else:
+            self.finished.emit(*result)
+        for callback in self._done_callbacks:
+            callback()
+        self._done_callbacks.clear()
+
+    def __await__(self):
+        future = asyncio.get_event_loop().create_future()
+
+        def resolve() -> None:
+            if future.done():
+                return
+            if self.error is not None:
+                future.set_exception(self.error)
+            else:
+                future.set_result(self._result)
+
+        if self._done:
+            resolve()
+        else:
+            self._done_callbacks.append(resolve)
+        # Cancelling the awaiting task aborts the request
+        future.add_done_callback(lambda f: self.abort() if f.cancelled() else None)
+        return future.__await__()
+
+
+# Keeps the running fetches alive even if the caller drops the reference
+_PENDING_FETCHES = set()
+
+
+def start_fetch(url: str, callback: Optional[Callable[[bytes, str], None]] = None,
+                error_callback: Optional[Callable[[QgsPluginNetworkException], None]] = None,
+                encoding: str = ENCODING, retry_policy: Optional[RetryPolicy] = None,
+                feedback: Optional[QgsFeedback] = None) -> AsyncFetch:
+    """
+    Starts fetching the resource without blocking the Qt event loop, so that the UI stays
+    responsive. Any number of fetches can be in flight at once.
+    :param url: address of the web resource
+    :param callback: Called with bytes of the content and default name of the file when the
+        fetch succeeds
+    :param error_callback: Called with the exception when the fetch fails. If not given, the
+        error is logged
+    :param encoding: Encoding which will be used to decode the bytes
+    :param retry_policy: Retry policy. Defaults to the one set with set_default_retry_policy.
+        The retries are scheduled with timers instead of sleeping
+    :param feedback: Feedback to report progress to and to cancel the request with
+    :return: running fetch which can be connected to or awaited
+    """
+    async_fetch = AsyncFetch(url, encoding, retry_policy, feedback)
+    if callback is not None:
+        async_fetch.finished.connect(callback)
+    if error_callback is not None:
+        async_fetch.failed.connect(error_callback)
+    else:
+        async_fetch.failed.connect(lambda e: LOGGER.warning(str(e), extra=e.bar_msg))
+    _PENDING_FETCHES.add(async_fetch)
+    async_fetch.start()
+    return async_fetch
+
+
+async def fetch_raw_async(url: str, encoding: str = ENCODING,
+                          retry_policy: Optional[RetryPolicy] = None,
+                          feedback: Optional[QgsFeedback] = None) -> Tuple[bytes, str]:
+    """
+    Awaitable version of fetch_raw for asyncio event loops integrated with the Qt event loop
     :return: bytes of the content and default name of the file or empty string
     """
+    return await start_fetch(url, error_callback=lambda e: None, encoding=encoding,
+                             retry_policy=retry_policy, feedback=feedback)
+
+
+async def fetch_async(url: str, encoding: str = ENCODING,
+                      retry_policy: Optional[RetryPolicy] = None,
+                      feedback: Optional[QgsFeedback] = None) -> str:
+    """
+    Awaitable version of fetch for asyncio event loops integrated with the Qt event loop
+    :return: encoded string of the content
+    """
+    content, _ = await fetch_raw_async(url, encoding, retry_policy, feedback)
+    return content.decode(encoding)
+
+
+def _fetch_raw(url: str, encoding: str, use_cache: bool,
+               feedback: Optional[QgsFeedback]) -> Tuple[bytes, str]:
     LOGGER.debug(url)
+    metrics = RequestMetrics(url, "qt")
+    try:
+        content, default_name = _fetch_raw_blocking(url, encoding, use_cache, feedback, metrics)
+    except QgsPluginNetworkException as e:
+        metrics.finish(e.status_code, str(e))
+        _rate_limited(url, e)
+        raise
+    else:
+        metrics.bytes = len(content)
+        metrics.finish(metrics.status_code)
+    finally:
+        REQUEST_METRICS.record(metrics)
+    return content, default_name
+
+
+def _fetch_raw_blocking(url: str, encoding: str, use_cache: bool, feedback: Optional[QgsFeedback],
+                        metrics: 'RequestMetrics') -> Tuple[bytes, str]:
+    req = _build_request(url, encoding)
+
+    cache = _HTTP_CACHE if use_cache else None
+    cache_key = entry = None
+    if cache is not None:
+        key_headers = {bytes(name).decode(encoding): bytes(req.rawHeader(name)).decode(encoding)
+                       for name in map(QByteArray, CACHE_KEY_HEADERS) if req.hasRawHeader(name)}
+        cache_key = cache.key(url, key_headers)
+        entry = cache.lookup(cache_key)
+        if entry is not None and cache.is_fresh(entry):
+            cache.record_hit()
+            metrics.backend, metrics.cache_status = "cache", "hit"
+            metrics.response_started()
+            return cache.body(cache_key), entry["default_name"]
+        if entry is not None:
+            if entry.get("etag"):
+                req.setRawHeader(b"If-None-Match", bytes(entry["etag"], encoding))
+            if entry.get("last_modified"):
+                req.setRawHeader(b"If-Modified-Since", bytes(entry["last_modified"], encoding))
+            # Do not let the Qt network cache answer the conditional request
+            req.setAttribute(QNetworkRequest.CacheLoadControlAttribute,
+                             QNetworkRequest.AlwaysNetwork)
+
+    request_blocking = QgsBlockingNetworkRequest()
+    progress = _TransferProgress(feedback)
+    if feedback is not None:
+        request_blocking.downloadProgress.connect(progress.update)
+    request_blocking.downloadProgress.connect(lambda *args: metrics.response_started())
+    RATE_LIMITER.acquire(url)
+    progress.check_canceled()
+    _ = request_blocking.get(req, False, feedback)
+    reply: QgsNetworkReplyContent = request_blocking.reply()
+    reply_error = reply.error()
+    metrics.status_code = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+    progress.check_canceled()
+    if reply_error != QNetworkReply.NoError:
+        retry_after = _parse_retry_after(_reply_header(reply, "Retry-After"))
+        raise QgsPluginNetworkException(tr('Request failed'), bar_msg=bar_msg(reply.errorString()),
+                                        status_code=metrics.status_code, retry_after=retry_after)
+
+    if cache is not None:
+        headers = {name: _reply_header(reply, name, encoding)
+                   for name in ("Cache-Control", "Expires", "ETag", "Last-Modified")}
+        if entry is not None and metrics.status_code == 304:
+            cache.record_hit(revalidated=True)
+            metrics.cache_status = "revalidated"
+            cache.refresh(cache_key, headers)
+            return cache.body(cache_key), entry["default_name"]
+        cache.record_miss()
+        metrics.cache_status = "miss"
+        content = bytes(reply.content())
+        default_name = _default_name_from_reply(reply, encoding)
+        cache.store(cache_key, url, content, default_name, headers)
+        return content, default_name
+
+    return bytes(reply.content()), _default_name_from_reply(reply, encoding)
+
+
+def fetch_chunks(url: str, chunk_size: int = CHUNK_SIZE, use_requests_if_available: bool = True,
+                 encoding: str = ENCODING,
+                 feedback: Optional[QgsFeedback] = None) -> Iterator[bytes]:
+    """
+    Fetches resource from the internet and yields the body in chunks as they arrive, so that the
+    whole body is never held in memory. The request is sent when the iteration starts.
+    :param url: address of the web resource
+    :param chunk_size: Maximum size of the chunks
+    :param use_requests_if_available: Use Python package requests if it is available in the
+        environment
+    :param encoding: Encoding which will be used to decode the bytes
+    :param feedback: Feedback to report progress to and to cancel the request with
+    :return: iterator of the body chunks
+    """
+    use_requests = use_requests_if_available and requests is not None
+    progress = _TransferProgress(feedback)
+    with _open_stream(url, {}, use_requests, encoding, chunk_size=chunk_size,
+                      feedback=feedback) as response:
+        progress.set_total(response.content_length)
+        try:
+            for chunk in response.iter_content(chunk_size):
+                progress.check_canceled()
+                progress.add(len(chunk))
+                yield chunk
+        except QgsPluginNetworkException:
+            progress.check_canceled()
+            raise
+
+
+def fetch_to_layer(url: str, layer_name: Optional[str] = None,
+                   use_requests_if_available: bool = True, encoding: str = ENCODING,
+                   retry_policy: Optional['RetryPolicy'] = None,
+                   feedback: Optional[QgsFeedback] = None
+                   ) -> Union[QgsVectorLayer, QgsRasterLayer]:
+    """
+    Fetches a GDAL/OGR readable file (GeoJSON, GeoTIFF, zipped Shapefile...) into a GDAL
+    /vsimem/ buffer and opens it as a layer without writing it to the disk. The chunks are
+    written to the buffer as they arrive. The buffer is released when the layer is deleted.
+    :param url: Url of the file
+    :param layer_name: Name of the layer. Defaults to the file name
+    :param use_requests_if_available: Use Python package requests if it is available in the
+        environment
+    :param encoding: Encoding which will be used to decode the bytes
+    :param retry_policy: Retry policy. Defaults to the one set with set_default_retry_policy
+    :param feedback: Feedback to report progress to and to cancel the request with
+    :return: QgsVectorLayer if the file contains vector data, otherwise QgsRasterLayer
+    """
+    use_requests = use_requests_if_available and requests is not None
+    path = _call_with_retries(url, lambda: _fetch_to_vsimem(url, use_requests, encoding,
+                                                            _TransferProgress(feedback)),
+                              retry_policy)
+    name = layer_name or Path(path).stem
+    source = path
+    with _VsiFile(path, 'rb') as f:
+        if f.read(len(ZIP_SIGNATURE)) == ZIP_SIGNATURE:
+            source = f"/vsizip/{path}"
+
+    layer: Union[QgsVectorLayer, QgsRasterLayer]
+    if gdal.OpenEx(source, gdal.OF_VECTOR) is not None:
+        layer = QgsVectorLayer(source, name, "ogr")
+    else:
+        layer = QgsRasterLayer(source, name, "gdal")
+    if not layer.isValid():
+        gdal.Unlink(path)
+        raise QgsPluginException(tr('Could not open the layer from {}', url),
+                                 bar_msg=bar_msg(layer.error().summary()))
+    layer.willBeDeleted.connect(lambda: gdal.Unlink(path))
+    return layer
+
+
+def _fetch_to_vsimem(url: str, use_requests: bool, encoding: str,
+                     progress: '_TransferProgress') -> str:
+    with _open_stream(url, {}, use_requests, encoding, feedback=progress.feedback) as response:
+        file_name = (_default_name_from_header(response.header(CONTENT_DISPOSITION_HEADER))
+                     or Path(urlparse(url).path).name or "data")
+        path = f"{VSIMEM_PREFIX}{plugin_name()}/{uuid4().hex}/{file_name}"
+        progress.set_total(response.content_length)
+        try:
+            with _VsiFile(path, 'wb') as f:
+                _copy_stream(response, f, progress)
+        except Exception:
+            gdal.Unlink(path)
+            raise
+    return path
+
+
+class _VsiFile:
+    """ Minimal binary file object for GDAL virtual file systems """
+
+    def __init__(self, path: str, mode: str):
+        self._handle = gdal.VSIFOpenL(path, mode)
+        if self._handle is None:
+            raise QgsPluginException(tr('Could not open {}', path))
+
+    def write(self, data: bytes) -> int:
+        written = gdal.VSIFWriteL(data, 1, len(data), self._handle)
+        if written != len(data):
+            raise QgsPluginException(tr('Could not write to the GDAL virtual file'))
+        return written
+
+    def read(self, size: int) -> bytes:
+        return gdal.VSIFReadL(1, size, self._handle) or b''
+
+    def close(self) -> None:
+        if self._handle is not None:
+            gdal.VSIFCloseL(self._handle)
+            self._handle = None
+
+    def __enter__(self) -> '_VsiFile':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def _build_request(url: str, encoding: str = ENCODING) -> QNetworkRequest:
     req = QNetworkRequest(QUrl(url))
     # http://osgeo-org.1560.x6.nabble.com/QGIS-Developer-Do-we-have-a-User-Agent-string-for-QGIS-td5360740.html
     user_agent = QSettings().value("/qgis/networkAndProxy/userAgent", "Mozilla/5.0")
@@ -61,13 +1413,15 @@ def fetch_raw(url: str, encoding: str = ENCODING) -> Tuple[bytes, str]:
     user_agent += f" {plugin_name()}"
     # https://www.riverbankcomputing.com/pipermail/pyqt/2016-May/037514.html
     req.setRawHeader(b"User-Agent", bytes(user_agent, encoding))
-    request_blocking = QgsBlockingNetworkRequest()
-    _ = request_blocking.get(req)
-    reply: QgsNetworkReplyContent = request_blocking.reply()
-    reply_error = reply.error()
-    if reply_error != QNetworkReply.NoError:
-        raise QgsPluginNetworkException(tr('Request failed'), bar_msg=bar_msg(reply.errorString()))
+    return req
 
+
+def _reply_header(reply: QgsNetworkReplyContent, name: str, encoding: str = ENCODING) -> str:
+    header = QByteArray(bytes(name, encoding))
+    return bytes(reply.rawHeader(header)).decode(encoding) if reply.hasRawHeader(header) else ''
+
+
+def _default_name_from_reply(reply: QgsNetworkReplyContent, encoding: str = ENCODING) -> str:
     # https://stackoverflow.com/a/39103880/10068922
     default_name = ''
     if reply.hasRawHeader(CONTENT_DISPOSITION_BYTE_HEADER):
@@ -75,12 +1429,15 @@ def fetch_raw(url: str, encoding: str = ENCODING) -> Tuple[bytes, str]:
         default_name = bytes(header).decode(encoding).split('filename=')[1]
         if default_name[0] in ['"', "'"]:
             default_name = default_name[1:-1]
-
-    return bytes(reply.content()), default_name
+    return default_name
 
 
 def download_to_file(url: str, output_dir: Path, output_name: Optional[str] = None,
-                     use_requests_if_available: bool = True, encoding: str = ENCODING) -> Path:
+                     use_requests_if_available: bool = True, encoding: str = ENCODING,
+                     resume: bool = False, segments: int = 1,
+                     retry_policy: Optional['RetryPolicy'] = None,
+                     feedback: Optional[QgsFeedback] = None,
+                     expected_hash: Optional[str] = None) -> Path:
     """
     Downloads a binary file to the file efficiently
     :param url: Url of the file
@@ -89,44 +1446,1143 @@ def download_to_file(url: str, output_dir: Path, output_name: Optional[str] = No
     Content-Disposition header or uses the url
     :param use_requests_if_available: Use Python package requests if it is available in the environment
     :param encoding: Encoding which will be used to decode the bytes
+    :param resume: Continue from the partial <file>.part left by an interrupted download using
+        HTTP Range requests. The part files are kept if the download fails, otherwise they are
+        removed once the retries are exhausted
+    :param segments: Fetch the file in this many byte ranges in parallel if the server accepts
+        ranges
+    :param retry_policy: Retry policy. Defaults to the one set with set_default_retry_policy
+    :param feedback: Feedback to report progress to. If it is canceled, the transfer is aborted
+        with QgsPluginNetworkCancelledException and the partial file is removed (kept with
+        resume=True)
+    :param expected_hash: Expected hex digest of the file, optionally prefixed with the
+        algorithm, for example "sha256:9f86d0...". The digest is computed while downloading.
+        On mismatch the file is removed and QgsPluginChecksumMismatchException is raised
     :return: Path to the file
     """
+    output, _ = download_with_digests(url, output_dir, (), expected_hash, output_name,
+                                      use_requests_if_available, encoding, resume, segments,
+                                      retry_policy, feedback)
+    return output
 
-    def get_output(default_filename) -> Path:
-        if output_name is None:
-            if default_filename != '':
-                out_name = default_filename
-            else:
-                out_name = url.replace('http://', '').replace('https://', '')
-                if len(out_name.split('/')[-1]) > 2:
-                    out_name = out_name.split('/')[-1]
-        else:
-            out_name = output_name
-        return Path(output_dir, out_name)
 
-    output = Path()
+def download_with_digests(url: str, output_dir: Path,
+                          hash_algorithms: Sequence[str] = ("sha256",),
+                          expected_hash: Optional[str] = None, output_name: Optional[str] = None,
+                          use_requests_if_available: bool = True, encoding: str = ENCODING,
+                          resume: bool = False, segments: int = 1,
+                          retry_policy: Optional['RetryPolicy'] = None,
+                          feedback: Optional[QgsFeedback] = None
+                          ) -> Tuple[Path, Dict[str, str]]:
+    """
+    Downloads a file like download_to_file and computes its digests incrementally while the
+    chunks are written. Segmented downloads are hashed after the segments are complete, since
+    the segments arrive out of order.
+    :param hash_algorithms: Names of the hashlib algorithms to compute
+    :param expected_hash: Expected hex digest, optionally prefixed with the algorithm, for
+        example "sha256:9f86d0...". Without the prefix the first of hash_algorithms (or sha256)
+        is used
+    :return: Path to the file and hex digests keyed by the algorithm
+    """
+    algorithms = list(hash_algorithms)
+    expected_algorithm, expected_digest = None, None
+    if expected_hash is not None:
+        expected_algorithm, _, expected_digest = expected_hash.rpartition(":")
+        default_algorithm = algorithms[0] if algorithms else "sha256"
+        expected_algorithm = (expected_algorithm or default_algorithm).lower()
+        if expected_algorithm not in algorithms:
+            algorithms.append(expected_algorithm)
+    digests = _Digests(algorithms) if algorithms else None
+
+    use_requests = use_requests_if_available and requests is not None
+    if resume or segments > 1:
+        outputs: List[Path] = []
+
+        def download_ranged() -> Path:
+            # Retries continue from the part file written by the previous attempt
+            return _download_ranged(url, output_dir, output_name, use_requests, encoding,
+                                    resume or bool(outputs), segments,
+                                    _TransferProgress(feedback), outputs, digests)
+
+        try:
+            output = _call_with_retries(url, download_ranged, retry_policy)
+        except BaseException:
+            # The part files are kept for resuming only if it was asked for
+            if not resume and outputs:
+                _remove_part_files(outputs[-1])
+            raise
+    else:
+        output = _call_with_retries(url, lambda: _download_to_file(url, output_dir, output_name,
+                                                                   use_requests, encoding,
+                                                                   _TransferProgress(feedback),
+                                                                   digests),
+                                    retry_policy)
+
+    hex_digests = digests.hexdigests() if digests is not None else {}
+    if (expected_digest is not None
+            and hex_digests[expected_algorithm] != expected_digest.strip().lower()):
+        output.unlink()
+        raise QgsPluginChecksumMismatchException(
+            tr('Checksum of the downloaded file does not match'),
+            bar_msg=bar_msg(tr('Expected {} {}, got {}', expected_algorithm, expected_digest,
+                               hex_digests[expected_algorithm])))
+    return output, hex_digests
+
+
+def _download_to_file(url: str, output_dir: Path, output_name: Optional[str], use_requests: bool,
+                      encoding: str, progress: '_TransferProgress',
+                      digests: Optional['_Digests'] = None) -> Path:
+    with _open_stream(url, {}, use_requests, encoding, feedback=progress.feedback) as response:
+        default_name = _default_name_from_header(response.header(CONTENT_DISPOSITION_HEADER))
+        output = _output_path(url, output_dir, output_name, default_name)
+        progress.set_total(response.content_length)
+        if digests is not None:
+            digests.reset()
+        try:
+            with open(output, 'wb') as f:
+                _copy_stream(response, f, progress, digests)
+        except BaseException:
+            # Do not leave a truncated file behind
+            if output.exists():
+                output.unlink()
+            raise
+    return output
+
+
+class _Digests:
+    """ Group of hashlib hashes updated together """
+
+    def __init__(self, algorithms: Sequence[str]):
+        self.algorithms = list(algorithms)
+        self._hashes: List[Any] = []
+        self.reset()
+
+    def reset(self) -> None:
+        try:
+            self._hashes = [hashlib.new(algorithm) for algorithm in self.algorithms]
+        except ValueError as e:
+            raise QgsPluginNetworkException(tr('Unsupported hash algorithm'), bar_msg=bar_msg(e))
+
+    def update(self, data: bytes) -> None:
+        for hash_ in self._hashes:
+            hash_.update(data)
+
+    def update_from_file(self, path: Path, size: Optional[int] = None) -> None:
+        """ Hashes the first size bytes of the file (whole file if None) """
+        remaining = size if size is not None else -1
+        with open(path, 'rb') as f:
+            while remaining:
+                chunk = f.read(CHUNK_SIZE if remaining < 0 else min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.update(chunk)
+                remaining -= len(chunk) if remaining > 0 else 0
+
+    def hexdigests(self) -> Dict[str, str]:
+        return {algorithm: hash_.hexdigest()
+                for algorithm, hash_ in zip(self.algorithms, self._hashes)}
+
 
-    if use_requests_if_available and requests is not None:
+class _TransferProgress:
+    """ Reports progress of a transfer to QgsFeedback at most every PROGRESS_INTERVAL seconds """
+
+    def __init__(self, feedback: Optional[QgsFeedback] = None, total: Optional[int] = None):
+        self.feedback = feedback
+        self.total = total
+        self.transferred = 0
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+
+    def set_total(self, total: Optional[int], transferred: int = 0) -> None:
+        with self._lock:
+            self.total = total
+            self.transferred = transferred
+
+    def add(self, n_bytes: int) -> None:
+        with self._lock:
+            self.transferred += n_bytes
+            transferred = self.transferred
+        self.update(transferred, self.total or -1)
+
+    def update(self, transferred: int, total: int) -> None:
+        """ Reports the progress. Signature matches downloadProgress signals of Qt """
+        if self.feedback is None or total <= 0:
+            return
+        now = time.monotonic()
+        if now - self._last_report < PROGRESS_INTERVAL and transferred < total:
+            return
+        self._last_report = now
+        self.feedback.setProgress(min(100.0, 100.0 * transferred / total))
+
+    @property
+    def canceled(self) -> bool:
+        return self.feedback is not None and self.feedback.isCanceled()
+
+    def check_canceled(self) -> None:
+        if self.canceled:
+            raise QgsPluginNetworkCancelledException(tr('Request was cancelled'))
+
+
+def _copy_stream(response: '_StreamResponse', f: BinaryIO, progress: _TransferProgress,
+                 digests: Optional[_Digests] = None) -> None:
+    try:
+        for chunk in response.iter_content():
+            progress.check_canceled()
+            f.write(chunk)
+            if digests is not None:
+                digests.update(chunk)
+            progress.add(len(chunk))
+    except QgsPluginNetworkCancelledException:
+        raise
+    except QgsPluginNetworkException:
+        # Qt backend aborts the reply when the feedback is canceled
+        progress.check_canceled()
+        raise
+    progress.check_canceled()
+
+
+class _StreamResponse:
+    """ Response which body is read in chunks. Use as a context manager """
+
+    def __init__(self, status_code: Optional[int], headers: Dict[str, str]):
+        self.status_code = status_code
+        self.headers = {name.lower(): value for name, value in headers.items()}
+        self.metrics: Optional[RequestMetrics] = None
+
+    def header(self, name: str, default: str = '') -> str:
+        return self.headers.get(name.lower(), default)
+
+    @property
+    def content_length(self) -> Optional[int]:
+        """ Length of the body or None if unknown. Encoded bodies are decoded while read """
+        if self.header('Content-Encoding', 'identity').strip().lower() != 'identity':
+            return None
+        length = self.header('Content-Length')
+        return int(length) if length.isdigit() else None
+
+    def iter_content(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        :raises QgsPluginNetworkException: if the connection fails or closes before
+            Content-Length bytes are received
+        """
+        length = 0
+        try:
+            for chunk in self._iter_chunks(chunk_size):
+                length += len(chunk)
+                if self.metrics is not None:
+                    self.metrics.bytes += len(chunk)
+                yield chunk
+            received, expected = self._received_length(length)
+            if expected is not None and received < expected:
+                raise QgsPluginNetworkException(
+                    tr('Request failed'),
+                    bar_msg=bar_msg(tr('Connection closed after {} of {} bytes', received,
+                                       expected)))
+        except QgsPluginNetworkException as e:
+            if self.metrics is not None:
+                self.metrics.error = str(e)
+            raise
+
+    def close(self) -> None:
+        self._close()
+        if self.metrics is not None:
+            self.metrics.finish(self.status_code)
+            REQUEST_METRICS.record(self.metrics)
+            self.metrics = None
+
+    def _iter_chunks(self, chunk_size: int) -> Iterator[bytes]:
+        raise NotImplementedError
+
+    def _received_length(self, length: int) -> Tuple[int, Optional[int]]:
+        """
+        :param length: Length of the body read
+        :return: received and expected length of the body
+        """
+        return length, self.content_length
+
+    def _close(self) -> None:
+        pass
+
+    def __enter__(self) -> '_StreamResponse':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+class _RequestsStreamResponse(_StreamResponse):
+    """
+    Reads requests response in chunks. Canceling the feedback shuts the socket down,
+    which interrupts a read blocked on a stalled server immediately.
+    """
+
+    def __init__(self, r: 'requests.Response', feedback: Optional[QgsFeedback] = None):
+        super().__init__(r.status_code, dict(r.headers))
+        self._r = r
+        self._feedback = feedback
+        if feedback is not None:
+            # Direct connection, since the thread reading the response is blocked
+            feedback.canceled.connect(self._abort, Qt.DirectConnection)
+            if feedback.isCanceled():
+                self._abort()
+
+    def _iter_chunks(self, chunk_size: int) -> Iterator[bytes]:
         # https://stackoverflow.com/a/39217788/10068922
+        try:
+            while True:
+                # Content-Encoding is decoded like in the Qt backend
+                chunk = self._r.raw.read(chunk_size, decode_content=True)
+                if not chunk:
+                    break
+                yield chunk
+        except (RequestException, Urllib3HTTPError) as e:
+            # Reading the raw stream raises urllib3 errors, for example when the connection drops
+            raise QgsPluginNetworkException(tr('Request failed'), bar_msg=bar_msg(e))
+
+    def _received_length(self, length: int) -> Tuple[int, Optional[int]]:
+        # urllib3 1.x does not enforce Content-Length. It is the length of the encoded body, so
+        # the bytes read from the socket are compared
+        expected = self.header('Content-Length')
+        return self._r.raw.tell(), int(expected) if expected.isdigit() else None
+
+    def _abort(self) -> None:
+        connection = getattr(self._r.raw, 'connection', None)
+        sock = getattr(connection, 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _close(self) -> None:
+        if self._feedback is not None:
+            self._feedback.canceled.disconnect(self._abort)
+            self._feedback = None
+        self._r.close()
+
+
+class _QtStreamResponse(_StreamResponse):
+    """
+    Reads QNetworkReply as data arrives. The read buffer of the reply is limited
+    to the chunk size, so the whole body is never held in memory.
+    """
+
+    def __init__(self, reply: QNetworkReply, chunk_size: int,
+                 feedback: Optional[QgsFeedback] = None):
+        self._reply = reply
+        self._reply.setReadBufferSize(chunk_size)
+        self._feedback = feedback
+        if feedback is not None:
+            feedback.canceled.connect(self._reply.abort)
+            if feedback.isCanceled():
+                self._reply.abort()
+        self._loop = QEventLoop()
+        self._reply.metaDataChanged.connect(self._loop.quit)
+        self._reply.readyRead.connect(self._loop.quit)
+        self._reply.finished.connect(self._loop.quit)
+        # Redirects are followed by Qt, so wait for the final response
+        while not self._reply.isFinished() and (
+                self._reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+                or 300) in range(300, 400):
+            self._loop.exec_()
+        headers = {bytes(name).decode(ENCODING): bytes(value).decode(ENCODING)
+                   for name, value in self._reply.rawHeaderPairs()}
+        super().__init__(self._reply.attribute(QNetworkRequest.HttpStatusCodeAttribute), headers)
+
+    @property
+    def error(self) -> int:
+        return self._reply.error()
+
+    @property
+    def error_string(self) -> str:
+        return self._reply.errorString()
+
+    def _iter_chunks(self, chunk_size: int) -> Iterator[bytes]:
+        while True:
+            if self._reply.bytesAvailable():
+                yield bytes(self._reply.read(chunk_size))
+            elif self._reply.isFinished():
+                break
+            else:
+                self._loop.exec_()
+        if self._reply.error() != QNetworkReply.NoError:
+            raise QgsPluginNetworkException(tr('Request failed'),
+                                            bar_msg=bar_msg(self._reply.errorString()))
+
+    def _close(self) -> None:
+        if self._feedback is not None:
+            self._feedback.canceled.disconnect(self._reply.abort)
+        if not self._reply.isFinished():
+            self._reply.abort()
+        self._reply.deleteLater()
 
+
+def _open_stream(url: str, headers: Dict[str, str], use_requests: bool, encoding: str = ENCODING,
+                 allowed_statuses: Tuple[int, ...] = (), chunk_size: int = CHUNK_SIZE,
+                 feedback: Optional[QgsFeedback] = None) -> _StreamResponse:
+    """
+    Sends GET request and returns once the response headers have arrived
+    :param headers: Extra request headers
+    :param allowed_statuses: Error statuses which are returned instead of raising an exception
+    :param chunk_size: Size of the read buffer of the Qt backend
+    :param feedback: Canceling the feedback aborts the Qt reply immediately
+    """
+    RATE_LIMITER.acquire(url)
+    metrics = RequestMetrics(url, "requests" if use_requests else "qt")
+    try:
+        response = _send_stream_request(url, headers, use_requests, encoding, allowed_statuses,
+                                        chunk_size, feedback)
+    except QgsPluginNetworkException as e:
+        metrics.finish(e.status_code, str(e))
+        REQUEST_METRICS.record(metrics)
+        _rate_limited(url, e)
+        raise
+    metrics.response_started()
+    response.metrics = metrics
+    return response
+
+
+def _send_stream_request(url: str, headers: Dict[str, str], use_requests: bool, encoding: str,
+                         allowed_statuses: Tuple[int, ...], chunk_size: int,
+                         feedback: Optional[QgsFeedback]) -> _StreamResponse:
+    if use_requests:
         try:
-            with requests.get(url, stream=True) as r:
-                try:
-                    r.raise_for_status()
-                except Exception:
-                    raise QgsPluginNetworkException(tr('Request failed with status code {}', r.status_code),
-                                                    bar_msg=bar_msg(r.text))
-                default_filename = re.findall("filename=(.+)", r.headers.get(CONTENT_DISPOSITION_HEADER, ''))
-                default_filename = default_filename[0] if len(default_filename) else ''
-                output = get_output(default_filename)
-                with open(output, 'wb') as f:
-                    shutil.copyfileobj(r.raw, f)
+            r = SESSION_POOL.session(url).get(url, headers=headers, stream=True,
+                                              timeout=REQUESTS_TIMEOUT)
         except RequestException as e:
             raise QgsPluginNetworkException(tr('Request failed'), bar_msg=bar_msg(e))
+        if r.status_code not in allowed_statuses:
+            try:
+                _raise_for_status(r)
+            finally:
+                if not r.ok:
+                    r.close()
+        return _RequestsStreamResponse(r, feedback)
+
+    req = _build_request(url, encoding)
+    req.setAttribute(QNetworkRequest.FollowRedirectsAttribute, True)
+    for name, value in headers.items():
+        req.setRawHeader(bytes(name, encoding), bytes(value, encoding))
+    response = _QtStreamResponse(QgsNetworkAccessManager.instance().get(req), chunk_size, feedback)
+    if response.status_code not in allowed_statuses:
+        if (response.status_code or 0) >= 400:
+            response.close()
+            raise QgsPluginNetworkException(
+                tr('Request failed with status code {}', response.status_code),
+                bar_msg=bar_msg(response.error_string), status_code=response.status_code,
+                retry_after=_parse_retry_after(response.header('Retry-After')))
+        if response.error != QNetworkReply.NoError:
+            response.close()
+            raise QgsPluginNetworkException(tr('Request failed'),
+                                            bar_msg=bar_msg(response.error_string))
+    return response
+
+
+def _output_path(url: str, output_dir: Path, output_name: Optional[str],
+                 default_filename: str) -> Path:
+    if output_name is None:
+        if default_filename != '':
+            out_name = default_filename
+        else:
+            out_name = url.replace('http://', '').replace('https://', '')
+            if len(out_name.split('/')[-1]) > 2:
+                out_name = out_name.split('/')[-1]
     else:
-        # Using simple fetch_raw
-        content, default_filename = fetch_raw(url, encoding)
-        output = get_output(default_filename)
-        with open(output, 'wb') as f:
-            f.write(content)
+        out_name = output_name
+    return Path(output_dir, out_name)
+
+
+def _default_name_from_header(header: str) -> str:
+    default_filename = re.findall("filename=(.+)", header)
+    default_filename = default_filename[0] if len(default_filename) else ''
+    if default_filename and default_filename[0] in ['"', "'"]:
+        default_filename = default_filename[1:-1]
+    return default_filename
+
+
+def _raise_for_status(r: 'requests.Response') -> None:
+    try:
+        r.raise_for_status()
+    except Exception:
+        raise QgsPluginNetworkException(tr('Request failed with status code {}', r.status_code),
+                                        bar_msg=bar_msg(r.text), status_code=r.status_code,
+                                        retry_after=_parse_retry_after(
+                                            r.headers.get('Retry-After', '')))
+
+
+def _download_ranged(url: str, output_dir: Path, output_name: Optional[str], use_requests: bool,
+                     encoding: str, resume: bool, segments: int, progress: '_TransferProgress',
+                     outputs: List[Path], digests: Optional[_Digests] = None) -> Path:
+    """
+    Downloads the file into <file>.part using HTTP Range requests and renames it when complete.
+    The part files are left in place on failure.
+    :param outputs: The output path is appended to this list once it is known, so that the
+        caller can remove the part files
+    """
+    size, accepts_ranges, default_filename, validator = _probe(url, use_requests, encoding)
+    output = _output_path(url, output_dir, output_name, default_filename)
+    outputs.append(output)
+    part = output.with_name(output.name + PART_SUFFIX)
+    segments_file = output.with_name(output.name + SEGMENTS_SUFFIX)
+    validator_file = output.with_name(output.name + VALIDATOR_SUFFIX)
+    if resume and part.exists() and (_read_validator(validator_file) or '') != validator:
+        # The resource has changed since the part file was written
+        resume = False
+    if not resume:
+        _remove_part_files(output)
+    if validator:
+        validator_file.write_text(validator, encoding=ENCODING)
+
+    if segments > 1 and accepts_ranges and size:
+        _download_segments(url, part, segments_file, size, segments, use_requests, encoding,
+                           progress, validator)
+        if digests is not None:
+            digests.reset()
+            digests.update_from_file(part)
+    else:
+        if segments_file.exists():
+            # Segmented part file cannot be continued as a single stream
+            for path in (part, segments_file):
+                if path.exists():
+                    path.unlink()
+        _download_resumable(url, part, size, use_requests, encoding, progress, digests,
+                            validator)
+    os.replace(part, output)
+    if validator_file.exists():
+        validator_file.unlink()
     return output
+
+
+def _remove_part_files(output: Path) -> None:
+    for suffix in (PART_SUFFIX, SEGMENTS_SUFFIX, VALIDATOR_SUFFIX):
+        path = output.with_name(output.name + suffix)
+        if path.exists():
+            path.unlink()
+
+
+def _read_validator(validator_file: Path) -> Optional[str]:
+    try:
+        return validator_file.read_text(encoding=ENCODING)
+    except OSError:
+        return None
+
+
+def _probe(url: str, use_requests: bool, encoding: str) -> Tuple[Optional[int], bool, str, str]:
+    """
+    Finds out the size of the resource, whether the server accepts ranges, the default file name
+    and the validator used in If-Range requests (strong ETag or Last-Modified, empty if neither
+    is sent)
+    """
+    RATE_LIMITER.acquire(url)
+    try:
+        headers = _head(url, use_requests, encoding)
+    except QgsPluginNetworkException as e:
+        _rate_limited(url, e)
+        raise
+
+    size = headers.get('content-length', '')
+    size = int(size) if size.isdigit() else None
+    accepts_ranges = headers.get('accept-ranges', '').strip().lower() == 'bytes'
+    etag = headers.get('etag', '').strip()
+    # Weak ETags cannot be used with If-Range
+    if not etag or etag.startswith('W/'):
+        validator = headers.get('last-modified', '').strip()
+    else:
+        validator = etag
+    default_name = _default_name_from_header(headers.get(CONTENT_DISPOSITION_HEADER.lower(), ''))
+    return size, accepts_ranges, default_name, validator
+
+
+def _head(url: str, use_requests: bool, encoding: str) -> Dict[str, str]:
+    """ Sends HEAD request and returns the response headers with lower case names """
+    if use_requests:
+        try:
+            with SESSION_POOL.session(url).head(url, headers=IDENTITY_ENCODING_HEADERS,
+                                                allow_redirects=True,
+                                                timeout=REQUESTS_TIMEOUT) as r:
+                _raise_for_status(r)
+                headers = {name.lower(): value for name, value in r.headers.items()}
+        except RequestException as e:
+            raise QgsPluginNetworkException(tr('Request failed'), bar_msg=bar_msg(e))
+    else:
+        req = _build_request(url, encoding)
+        req.setAttribute(QNetworkRequest.FollowRedirectsAttribute, True)
+        for name, value in IDENTITY_ENCODING_HEADERS.items():
+            req.setRawHeader(bytes(name, encoding), bytes(value, encoding))
+        reply: QNetworkReply = QgsNetworkAccessManager.instance().head(req)
+        if not reply.isFinished():
+            loop = QEventLoop()
+            reply.finished.connect(loop.quit)
+            loop.exec_()
+        try:
+            if reply.error() != QNetworkReply.NoError:
+                retry_after = bytes(reply.rawHeader(QByteArray(b"Retry-After"))).decode(encoding)
+                status_code = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+                raise QgsPluginNetworkException(tr('Request failed'),
+                                                bar_msg=bar_msg(reply.errorString()),
+                                                status_code=status_code,
+                                                retry_after=_parse_retry_after(retry_after))
+            headers = {bytes(name).decode(encoding).lower(): bytes(value).decode(encoding)
+                       for name, value in reply.rawHeaderPairs()}
+        finally:
+            reply.deleteLater()
+    return headers
+
+
+def _download_resumable(url: str, part: Path, size: Optional[int], use_requests: bool,
+                        encoding: str, progress: _TransferProgress,
+                        digests: Optional[_Digests] = None,
+                        validator: str = '') -> None:
+    offset = part.stat().st_size if part.exists() else 0
+    if size is not None and offset > size:
+        offset = 0
+    if digests is not None:
+        digests.reset()
+        if offset:
+            # Bytes from the earlier attempt are hashed before appending
+            digests.update_from_file(part, offset)
+    if size is not None and offset == size:
+        progress.update(size, size)
+        return
+    progress.set_total(size, offset)
+    with open(part, 'ab' if offset else 'wb') as f:
+        status = _write_range(url, f, offset, None, use_requests, encoding, allow_full=True,
+                              progress=progress, digests=digests, validator=validator)
+        if status == 416:
+            # The partial file does not match the resource anymore
+            f.seek(0)
+            f.truncate()
+            progress.set_total(size)
+            if digests is not None:
+                digests.reset()
+            _write_range(url, f, 0, None, use_requests, encoding, allow_full=True,
+                         progress=progress, digests=digests)
+
+
+def _download_segments(url: str, part: Path, segments_file: Path, size: int, segments: int,
+                       use_requests: bool, encoding: str, progress: _TransferProgress,
+                       validator: str = '') -> None:
+    segment_size = -(-size // segments)
+    done = set()
+    if part.exists() and part.stat().st_size == size and segments_file.exists():
+        try:
+            with open(segments_file, encoding=ENCODING) as f:
+                state = json.load(f)
+            if state.get('size') == size and state.get('segment_size') == segment_size:
+                done = set(state.get('done', []))
+        except (OSError, ValueError):
+            done = set()
+    if not done:
+        with open(part, 'wb') as f:
+            f.truncate(size)
+    lock = threading.Lock()
+
+    def save_state() -> None:
+        with open(segments_file, 'w', encoding=ENCODING) as f:
+            json.dump({'size': size, 'segment_size': segment_size, 'done': sorted(done)}, f)
+
+    def fetch_segment(index: int) -> None:
+        start = index * segment_size
+        end = min(start + segment_size, size) - 1
+        with open(part, 'r+b') as f:
+            f.seek(start)
+            _write_range(url, f, start, end, use_requests, encoding, allow_full=False,
+                         progress=progress, validator=validator)
+        with lock:
+            done.add(index)
+            save_state()
+
+    missing = [index for index in range(segments)
+               if index not in done and index * segment_size < size]
+    progress.set_total(size, sum(min(segment_size, size - index * segment_size)
+                                 for index in done))
+    save_state()
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            # Consume the results to raise the first error. Finished segments are kept for resuming
+            list(executor.map(fetch_segment, missing))
+    segments_file.unlink()
+
+
+def _write_range(url: str, f: BinaryIO, start: int, end: Optional[int], use_requests: bool,
+                 encoding: str, allow_full: bool, progress: _TransferProgress,
+                 digests: Optional[_Digests] = None, validator: str = '') -> int:
+    """
+    Writes bytes start-end (inclusive, open ended if None) of the resource to the current
+    position of f
+    :param allow_full: If the server ignores the range and sends the whole content, rewrite f
+        from the beginning
+    :param validator: ETag or Last-Modified of the resource. The server sends the whole content
+        if it has changed
+    :return: HTTP status code
+    """
+    headers = dict(IDENTITY_ENCODING_HEADERS)
+    ranged = bool(start or end is not None)
+    if ranged:
+        headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+        if validator:
+            headers['If-Range'] = validator
+    progress.check_canceled()
+    with _open_stream(url, headers, use_requests, encoding, allowed_statuses=(416,),
+                      feedback=progress.feedback) as response:
+        if response.status_code == 416:
+            return response.status_code
+        if ranged and response.status_code != 206:
+            _handle_full_response(f, allow_full)
+            progress.set_total(response.content_length)
+            if digests is not None:
+                digests.reset()
+        _copy_stream(response, f, progress, digests)
+        return response.status_code
+
+
+def _handle_full_response(f: BinaryIO, allow_full: bool) -> None:
+    if not allow_full:
+        raise QgsPluginNetworkException(tr('Server did not respect the requested byte range'))
+    f.seek(0)
+    f.truncate()
+
+
+def download_and_extract(url: str, output_dir: Path,
+                         member_filter: Optional[Callable[[str], bool]] = None,
+                         use_requests_if_available: bool = True, encoding: str = ENCODING,
+                         retry_policy: Optional['RetryPolicy'] = None,
+                         feedback: Optional[QgsFeedback] = None) -> List[Path]:
+    """
+    Downloads a tar (optionally gzip, bz2 or xz compressed) or zip archive and extracts it while
+    downloading without storing the archive. Tar members are extracted as the bytes arrive. Zip
+    archives are read with range requests starting from the central directory, so only the
+    selected members are downloaded. If the server does not accept ranges, the zip archive is
+    spooled to a temporary file first.
+    :param url: Url of the archive
+    :param output_dir: Path to the output directory
+    :param member_filter: Function which gets the name of the member and returns whether it
+        should be extracted
+    :param use_requests_if_available: Use Python package requests if it is available in the
+        environment
+    :param encoding: Encoding which will be used to decode the bytes
+    :param retry_policy: Retry policy. Defaults to the one set with set_default_retry_policy
+    :param feedback: Feedback to report progress to and to cancel the transfer with
+    :return: Paths to the extracted files
+    """
+    use_requests = use_requests_if_available and requests is not None
+    return _call_with_retries(url, lambda: _download_and_extract(url, output_dir, member_filter,
+                                                                 use_requests, encoding,
+                                                                 _TransferProgress(feedback)),
+                              retry_policy)
+
+
+def _download_and_extract(url: str, output_dir: Path,
+                          member_filter: Optional[Callable[[str], bool]], use_requests: bool,
+                          encoding: str, progress: _TransferProgress) -> List[Path]:
+    if urlparse(url).path.lower().endswith('.zip'):
+        size, accepts_ranges, _, _ = _probe(url, use_requests, encoding)
+        if accepts_ranges and size:
+            with _RangeReader(url, size, use_requests, encoding, progress) as reader:
+                with zipfile.ZipFile(reader) as archive:
+                    return _extract_zip(archive, output_dir, member_filter, progress)
+
+    with _open_stream(url, {}, use_requests, encoding, feedback=progress.feedback) as response:
+        progress.set_total(response.content_length)
+        reader = _StreamReader(response, progress)
+        if reader.peek(len(ZIP_SIGNATURE)) == ZIP_SIGNATURE:
+            with tempfile.TemporaryFile(dir=output_dir) as f:
+                shutil.copyfileobj(reader, f, CHUNK_SIZE)
+                with zipfile.ZipFile(f) as archive:
+                    return _extract_zip(archive, output_dir, member_filter)
+        try:
+            with tarfile.open(fileobj=reader, mode='r|*') as archive:
+                return _extract_tar(archive, output_dir, member_filter, progress)
+        except tarfile.ReadError as e:
+            raise QgsPluginException(tr('Could not extract the archive'), bar_msg=bar_msg(e))
+
+
+def _extract_tar(archive: tarfile.TarFile, output_dir: Path,
+                 member_filter: Optional[Callable[[str], bool]],
+                 progress: _TransferProgress) -> List[Path]:
+    extracted = []
+    # Iterating a stream reads the members in order, the skipped ones are read past
+    for member in archive:
+        progress.check_canceled()
+        if not (member.isfile() or member.isdir()):
+            continue
+        if member_filter is not None and not member_filter(member.name):
+            continue
+        target = _member_path(output_dir, member.name)
+        if target is None:
+            continue
+        if member.isdir():
+            target.mkdir(parents=True, exist_ok=True)
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with archive.extractfile(member) as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        extracted.append(target)
+    return extracted
+
+
+def _extract_zip(archive: zipfile.ZipFile, output_dir: Path,
+                 member_filter: Optional[Callable[[str], bool]],
+                 progress: Optional[_TransferProgress] = None) -> List[Path]:
+    members = [info for info in archive.infolist()
+               if not info.is_dir() and (member_filter is None or member_filter(info.filename))]
+    if progress is not None:
+        progress.set_total(sum(info.compress_size for info in members))
+    extracted = []
+    for info in members:
+        target = _member_path(output_dir, info.filename)
+        if target is None:
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with archive.open(info) as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        extracted.append(target)
+    return extracted
+
+
+def _member_path(output_dir: Path, name: str) -> Optional[Path]:
+    """
+    Returns the output path of the archive member or None if it would be outside of output_dir
+    """
+    root = Path(output_dir).resolve()
+    target = (root / name).resolve()
+    if root not in target.parents:
+        LOGGER.warning(tr('Skipping archive member {} outside of the output directory', name))
+        return None
+    return target
+
+
+class _StreamReader(io.RawIOBase):
+    """ Readable file object of a streaming response body """
+
+    def __init__(self, response: _StreamResponse, progress: _TransferProgress):
+        super().__init__()
+        self._chunks = response.iter_content()
+        self._buffer = b''
+        self._progress = progress
+
+    def readable(self) -> bool:
+        return True
+
+    def peek(self, size: int) -> bytes:
+        while len(self._buffer) < size and self._fill():
+            pass
+        return self._buffer[:size]
+
+    def readinto(self, b) -> int:
+        if not self._buffer and not self._fill():
+            return 0
+        n_bytes = min(len(b), len(self._buffer))
+        b[:n_bytes] = self._buffer[:n_bytes]
+        self._buffer = self._buffer[n_bytes:]
+        return n_bytes
+
+    def _fill(self) -> bool:
+        self._progress.check_canceled()
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        self._progress.add(len(chunk))
+        self._buffer += chunk
+        return True
+
+
+class _RangeReader(io.RawIOBase):
+    """ Seekable file object reading a remote resource with range requests """
+
+    def __init__(self, url: str, size: int, use_requests: bool, encoding: str,
+                 progress: _TransferProgress):
+        super().__init__()
+        self.url = url
+        self.size = size
+        self._use_requests = use_requests
+        self._encoding = encoding
+        self._progress = progress
+        self._position = 0
+        self._block_start = 0
+        self._block = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(offset, 0)
+        return self._position
+
+    def readinto(self, b) -> int:
+        if self._position >= self.size or len(b) == 0:
+            return 0
+        offset = self._position - self._block_start
+        if not 0 <= offset < len(self._block):
+            # Near the end the window is moved back, so the central directory of a zip file is
+            # read at once
+            window = max(len(b), RANGE_READAHEAD)
+            start = max(min(self._position, self.size - window), 0)
+            end = min(start + window, self.size) - 1
+            block = io.BytesIO()
+            _write_range(self.url, block, start, end, self._use_requests, self._encoding,
+                         allow_full=False, progress=self._progress)
+            self._block_start, self._block = start, block.getvalue()
+            offset = self._position - start
+        n_bytes = max(min(len(b), len(self._block) - offset), 0)
+        b[:n_bytes] = self._block[offset:offset + n_bytes]
+        self._position += n_bytes
+        return n_bytes
+
+
+def download_many(urls: Iterable[str], output_dir: Path, max_workers: int = 4,
+                  per_host_limit: int = 2, use_requests_if_available: bool = True,
+                  encoding: str = ENCODING,
+                  retry_policy: Optional['RetryPolicy'] = None,
+                  output_names: Optional[Dict[str, str]] = None) -> Dict[str, DownloadResult]:
+    """
+    Downloads multiple files concurrently with bounded parallelism. Failing downloads
+    do not stop the batch, the error is stored in the result of that url instead.
+    If several urls resolve to the same file name (for example /a/data.bin and /b/data.bin),
+    a short hash of the url is appended to the names of the later ones.
+    :param urls: Urls of the files. Duplicates are downloaded only once
+    :param output_dir: Path to the output directory
+    :param max_workers: Maximum number of simultaneous transfers
+    :param per_host_limit: Maximum number of simultaneous transfers to a single host
+    :param use_requests_if_available: Use Python package requests if it is available in the
+        environment
+    :param encoding: Encoding which will be used to decode the bytes
+    :param retry_policy: Retry policy of each download. Defaults to the one set with
+        set_default_retry_policy
+    :param output_names: File names keyed by url. Other files are named like in download_to_file
+    :return: Results keyed by url in the order of the given urls
+    """
+    urls = list(dict.fromkeys(urls))
+    output_names = output_names or {}
+
+    def download(url: str) -> DownloadResult:
+        # Each url is downloaded to its own directory, so that equally named files do not
+        # collide
+        download_dir = Path(tempfile.mkdtemp(prefix='.download-', dir=str(output_dir)))
+        download_dirs.append(download_dir)
+        try:
+            path = download_to_file(url, download_dir, output_names.get(url),
+                                    use_requests_if_available=use_requests_if_available,
+                                    encoding=encoding, retry_policy=retry_policy)
+            return DownloadResult(url, path=path)
+        except Exception as e:
+            LOGGER.warning(tr('Download of {} failed: {}', url, e))
+            return DownloadResult(url, error=e)
+
+    results: Dict[str, DownloadResult] = {}
+    if not urls:
+        return results
+    download_dirs: List[Path] = []
+    try:
+        finished = _download_per_host(urls, download, max(min(max_workers, len(urls)), 1),
+                                      max(per_host_limit, 1))
+        results = {url: finished[url] for url in urls}
+
+        # Files are moved in the order of the urls, so the names are deterministic
+        claimed_names = set()
+        for url, result in results.items():
+            if not result.ok:
+                continue
+            name = result.path.name
+            if name in claimed_names:
+                url_hash = hashlib.sha1(url.encode(ENCODING)).hexdigest()[:8]
+                name = f"{result.path.stem}_{url_hash}{result.path.suffix}"
+            claimed_names.add(name)
+            output = Path(output_dir, name)
+            os.replace(result.path, output)
+            result.path = output
+    finally:
+        for download_dir in download_dirs:
+            shutil.rmtree(download_dir, ignore_errors=True)
+    return results
+
+
+def _download_per_host(urls: List[str], download: Callable[[str], DownloadResult],
+                       max_workers: int, per_host_limit: int) -> Dict[str, DownloadResult]:
+    """
+    Runs the downloads in a thread pool. A url is submitted only when its host has a free slot,
+    so that the workers never wait for a busy host while the urls of other hosts are queued.
+    """
+    waiting: Dict[str, Deque[str]] = OrderedDict()
+    for url in urls:
+        waiting.setdefault(urlparse(url).netloc, deque()).append(url)
+    running = {host: 0 for host in waiting}
+    results: Dict[str, DownloadResult] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures: Dict[Future, str] = {}
+
+        def submit_ready() -> None:
+            for host, host_urls in waiting.items():
+                while host_urls and running[host] < per_host_limit and len(futures) < max_workers:
+                    running[host] += 1
+                    url = host_urls.popleft()
+                    futures[executor.submit(download, url)] = url
+
+        submit_ready()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = futures.pop(future)
+                running[urlparse(url).netloc] -= 1
+                results[url] = future.result()
+            submit_ready()
+    return results
+
+
+def fetch_pages(url: str, next_page: Optional[Callable[[Any, str], Optional[str]]] = None,
+                prefetch: int = 2, parse: Callable[[bytes], Any] = json.loads,
+                max_pages: Optional[int] = None, encoding: str = ENCODING,
+                retry_policy: Optional[RetryPolicy] = None) -> Iterator[Any]:
+    """
+    Iterates over pages of a paginated API by following next links. Next pages are fetched in
+    a background thread while the caller processes the current one. At most prefetch pages are
+    held in memory and consumed pages are discarded.
+    :param url: Url of the first page
+    :param next_page: Function returning the url of the next page from a parsed page and its url
+        or None on the last page. Defaults to OGC API style link with rel "next"
+    :param prefetch: Number of pages fetched ahead
+    :param parse: Function to parse the body of a page
+    :param max_pages: Maximum number of pages to fetch
+    :param encoding: Encoding which will be used to decode the bytes
+    :param retry_policy: Retry policy of each page. Defaults to the one set with
+        set_default_retry_policy
+    :return: Iterator of the parsed pages
+    """
+    next_page = next_page or next_link
+    pages: 'queue.Queue[Any]' = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        page_url: Optional[str] = url
+        count = 0
+        try:
+            while (page_url is not None and not stop.is_set()
+                   and (max_pages is None or count < max_pages)):
+                content, _ = fetch_raw(page_url, encoding, retry_policy=retry_policy)
+                page = parse(content)
+                del content
+                count += 1
+                next_url = next_page(page, page_url)
+                if not put(page):
+                    return
+                page_url = next_url
+            put(_PAGE_END)
+        except Exception as e:
+            put(_PageError(e))
+
+    producer = threading.Thread(target=produce, name="fetch_pages", daemon=True)
+    producer.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is _PAGE_END:
+                return
+            if isinstance(page, _PageError):
+                raise page.error
+            yield page
+            del page
+    finally:
+        stop.set()
+
+
+def fetch_offset_pages(url: str, page_size: int, offset_param: str = "offset",
+                       limit_param: str = "limit",
+                       items: Callable[[Any], list] = lambda page: page.get("features", []),
+                       prefetch: int = 2, parse: Callable[[bytes], Any] = json.loads,
+                       start: int = 0, max_pages: Optional[int] = None, encoding: str = ENCODING,
+                       retry_policy: Optional[RetryPolicy] = None) -> Iterator[Any]:
+    """
+    Iterates over pages of an API paginated with offset and limit query parameters. Since the
+    urls of the next pages are known in advance, prefetch pages are fetched concurrently while
+    the caller processes the current one. Iteration ends on a page with fewer than page_size
+    items or with ArcGIS REST "exceededTransferLimit": false. For ArcGIS REST use
+    offset_param="resultOffset" and limit_param="resultRecordCount".
+    :param url: Url of the resource, may contain other query parameters
+    :param page_size: Number of items per page
+    :param offset_param: Name of the offset query parameter
+    :param limit_param: Name of the page size query parameter
+    :param items: Function returning the items of a parsed page
+    :param prefetch: Number of pages fetched ahead
+    :param parse: Function to parse the body of a page
+    :param start: Offset of the first page
+    :param max_pages: Maximum number of pages to fetch
+    :param encoding: Encoding which will be used to decode the bytes
+    :param retry_policy: Retry policy of each page. Defaults to the one set with
+        set_default_retry_policy
+    :return: Iterator of the parsed pages
+    """
+
+    def fetch_page(page_number: int) -> Any:
+        page_url = _with_query(url, {offset_param: start + page_number * page_size,
+                                     limit_param: page_size})
+        content, _ = fetch_raw(page_url, encoding, retry_policy=retry_policy)
+        return parse(content)
+
+    def is_last(page: Any) -> bool:
+        if isinstance(page, dict) and page.get("exceededTransferLimit") is False:
+            return True
+        return len(items(page)) < page_size
+
+    submitted = 0
+    pending: Deque[Any] = deque()
+    with ThreadPoolExecutor(max_workers=max(prefetch, 0) + 1) as executor:
+        try:
+            while True:
+                while len(pending) <= prefetch and (max_pages is None or submitted < max_pages):
+                    pending.append(executor.submit(fetch_page, submitted))
+                    submitted += 1
+                if not pending:
+                    return
+                page = pending.popleft().result()
+                last = is_last(page)
+                yield page
+                del page
+                if last:
+                    return
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def next_link(page: Any, url: str) -> Optional[str]:
+    """ Returns the href of the link with rel "next" in OGC API style page or None """
+    if isinstance(page, dict):
+        for link in page.get("links", []):
+            if isinstance(link, dict) and link.get("rel") == "next" and link.get("href"):
+                return urljoin(url, link["href"])
+    return None
+
+
+class _PageError:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+_PAGE_END = object()
+
+
+def _with_query(url: str, params: Dict[str, Any]) -> str:
+    parts = urlparse(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+             if key not in params]
+    query.extend((key, str(value)) for key, value in params.items())
+    return urlunparse(parts._replace(query=urlencode(query)))
@@ -0,0 +1,232 @@
+__copyright__ = "Copyright 2020, Gispo Ltd"
+__license__ = "GPL version 3"
+__email__ = "info@gispo.fi"
+__revision__ = "$Format:%H$"
+
+import json
+from contextlib import contextmanager
+from typing import Dict, Optional, Any, Iterator
+from urllib.parse import urlencode, parse_qs, unquote
+
+from osgeo import gdal
+from qgis.core import QgsRasterLayer
+
+from .custom_logging import bar_msg
+from .exceptions import QgsPluginException
+from .i18n import tr
+
+VSICURL_PREFIX = "/vsicurl/"
+
+
+class RemoteRasterPolicy:
+    """
+    GDAL block cache and /vsicurl/ HTTP cache settings used when reading remote rasters
+    (for example Cloud Optimized GeoTIFFs) with range requests. The cache and HTTP settings
+    are process wide and are applied only by apply() or set_remote_raster_policy. The settings
+    affecting how a dataset is opened are scoped to open_remote_raster calls.
+    """
+
+    def __init__(self, gdal_cache_max_mb: Optional[int] = None, curl_cache_size_mb: int = 64,
+                 chunk_size_kb: int = 16, merge_consecutive_ranges: bool = True,
+                 multi_range: bool = True,
+                 allowed_extensions: Optional[str] = ".tif,.tiff,.ovr,.vrt",
+                 collect_network_stats: bool = True, disable_read_dir: bool = True):
+        """
+        :param gdal_cache_max_mb: Size of the GDAL raster block cache (GDAL_CACHEMAX). None keeps
+            the current size
+        :param curl_cache_size_mb: Size of the global LRU cache of downloaded /vsicurl/ chunks
+            (CPL_VSIL_CURL_CACHE_SIZE)
+        :param chunk_size_kb: Size of the chunks requested by /vsicurl/ (CPL_VSIL_CURL_CHUNK_SIZE)
+        :param merge_consecutive_ranges: Merge consecutive ranges of a multi range request into one
+            (GDAL_HTTP_MERGE_CONSECUTIVE_RANGES)
+        :param multi_range: Request non consecutive ranges in parallel (GDAL_HTTP_MULTIRANGE)
+        :param allowed_extensions: Only files with these extensions are probed when the raster is
+            opened, which avoids requesting sidecar files like .aux.xml
+            (CPL_VSIL_CURL_ALLOWED_EXTENSIONS). None allows all
+        :param collect_network_stats: Collect the statistics used by remote_read_stats
+            (CPL_VSIL_NETWORK_STATS_ENABLED, GDAL >= 3.2)
+        :param disable_read_dir: Do not list the remote directory when the raster is opened
+            (GDAL_DISABLE_READDIR_ON_OPEN)
+        """
+        self.gdal_cache_max_mb = gdal_cache_max_mb
+        self.curl_cache_size_mb = curl_cache_size_mb
+        self.chunk_size_kb = chunk_size_kb
+        self.merge_consecutive_ranges = merge_consecutive_ranges
+        self.multi_range = multi_range
+        self.allowed_extensions = allowed_extensions
+        self.collect_network_stats = collect_network_stats
+        self.disable_read_dir = disable_read_dir
+
+    def config_options(self) -> Dict[str, str]:
+        """
+        :return: process wide GDAL configuration options of the policy. These only affect
+            /vsicurl/
+        """
+        return {
+            "CPL_VSIL_CURL_CACHE_SIZE": str(self.curl_cache_size_mb * 1024 * 1024),
+            "CPL_VSIL_CURL_CHUNK_SIZE": str(self.chunk_size_kb * 1024),
+            "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES" if self.merge_consecutive_ranges else "NO",
+            "GDAL_HTTP_MULTIRANGE": "YES" if self.multi_range else "SERIAL",
+            "CPL_VSIL_NETWORK_STATS_ENABLED": "YES" if self.collect_network_stats else "NO",
+        }
+
+    def open_options(self) -> Dict[str, str]:
+        """
+        :return: GDAL configuration options set only in the opening thread while a raster is
+            opened
+        """
+        options = {}
+        if self.disable_read_dir:
+            options["GDAL_DISABLE_READDIR_ON_OPEN"] = "EMPTY_DIR"
+        if self.allowed_extensions is not None:
+            options["CPL_VSIL_CURL_ALLOWED_EXTENSIONS"] = self.allowed_extensions
+        return options
+
+    def apply(self) -> None:
+        """ Sets the process wide configuration options and the block cache size to GDAL """
+        for key, value in self.config_options().items():
+            gdal.SetConfigOption(key, value)
+        if self.gdal_cache_max_mb is not None:
+            gdal.SetCacheMax(self.gdal_cache_max_mb * 1024 * 1024)
+
+
+class RemoteReadStats:
+    """ Amount of data read of a remote file """
+
+    def __init__(self, url: str, bytes_fetched: Optional[int], file_size: Optional[int],
+                 requests: Optional[int]):
+        self.url = url
+        self.bytes_fetched = bytes_fetched
+        self.file_size = file_size
+        self.requests = requests
+
+    @property
+    def fraction(self) -> Optional[float]:
+        """ :return: fetched bytes per file size or None if either is unknown """
+        if self.bytes_fetched is None or not self.file_size:
+            return None
+        return self.bytes_fetched / self.file_size
+
+    def __repr__(self) -> str:
+        return f"RemoteReadStats({self.url}, fetched={self.bytes_fetched}, size={self.file_size})"
+
+
+_POLICY: Optional[RemoteRasterPolicy] = None
+
+
+def set_remote_raster_policy(policy: RemoteRasterPolicy) -> None:
+    """ Applies the policy and uses it in open_remote_raster """
+    global _POLICY
+    _POLICY = policy
+    policy.apply()
+
+
+def vsicurl_uri(url: str, max_retry: Optional[int] = None, retry_delay: Optional[float] = None,
+                use_head: bool = True, list_dir: Optional[bool] = None) -> str:
+    """
+    Builds GDAL /vsicurl/ uri of the url
+    :param url: http(s) url of the file
+    :param max_retry: Number of retries of failed requests
+    :param retry_delay: Initial delay between the retries in seconds
+    :param use_head: Use HEAD request to get the file size. Set False if the server does not
+        support HEAD
+    :param list_dir: List the directory of the file for sidecar files. None uses the GDAL
+        default, which lists the directory
+    :return: /vsicurl/ uri which can be used as the source of QgsRasterLayer
+    """
+    if url.startswith(VSICURL_PREFIX) or url.startswith("/vsicurl?"):
+        return url
+    options: Dict[str, Any] = {}
+    if max_retry is not None:
+        options["max_retry"] = max_retry
+    if retry_delay is not None:
+        options["retry_delay"] = retry_delay
+    if not use_head:
+        options["use_head"] = "no"
+    if list_dir is not None:
+        options["list_dir"] = "yes" if list_dir else "no"
+    if not options:
+        return VSICURL_PREFIX + url
+    options["url"] = url
+    return "/vsicurl?" + urlencode(options)
+
+
+def open_remote_raster(url: str, layer_name: Optional[str] = None, max_retry: Optional[int] = 3,
+                       retry_delay: Optional[float] = None, use_head: bool = True,
+                       policy: Optional[RemoteRasterPolicy] = None) -> QgsRasterLayer:
+    """
+    Opens remote raster as a layer that reads only the blocks it needs with HTTP range requests.
+    The open options of the policy apply only while this raster is opened. Directory listing
+    is also disabled in the uri, so that it stays disabled when GDAL reopens the raster in other
+    threads. The process wide settings are not changed, use set_remote_raster_policy for them.
+    :param url: http(s) url of the raster, preferably a Cloud Optimized GeoTIFF
+    :param layer_name: Name of the layer. Defaults to the file name
+    :param max_retry: Number of retries of failed requests
+    :param retry_delay: Initial delay between the retries in seconds
+    :param use_head: Use HEAD request to get the file size
+    :param policy: Policy whose open options are used. Defaults to the one set with
+        set_remote_raster_policy
+    :return: raster layer
+    """
+    policy = policy or _POLICY or RemoteRasterPolicy()
+    uri = vsicurl_uri(url, max_retry, retry_delay, use_head, list_dir=not policy.disable_read_dir)
+    with _thread_local_config_options(policy.open_options()):
+        name = layer_name or url.split("?")[0].rstrip("/").split("/")[-1]
+        layer = QgsRasterLayer(uri, name, "gdal")
+    if not layer.isValid():
+        raise QgsPluginException(tr('Could not open the remote raster {}', url),
+                                 bar_msg=bar_msg(layer.error().summary()))
+    return layer
+
+
+@contextmanager
+def _thread_local_config_options(options: Dict[str, str]) -> Iterator[None]:
+    """ Sets GDAL configuration options for the current thread only and restores the old values """
+    old_values = {key: gdal.GetThreadLocalConfigOption(key, None) for key in options}
+    for key, value in options.items():
+        gdal.SetThreadLocalConfigOption(key, value)
+    try:
+        yield
+    finally:
+        for key, value in old_values.items():
+            gdal.SetThreadLocalConfigOption(key, value)
+
+
+def remote_read_stats(uri: str) -> RemoteReadStats:
+    """
+    Reports how much of the remote file has been fetched since the statistics were reset.
+    The statistics are collected only if CPL_VSIL_NETWORK_STATS_ENABLED is set, for example with
+    set_remote_raster_policy, before the file is opened.
+    :param uri: Url or /vsicurl/ uri of the file
+    :return: fetched bytes and the file size. Fetched bytes are None if GDAL does not collect them
+    """
+    uri = vsicurl_uri(uri)
+    if uri.startswith(VSICURL_PREFIX):
+        url = uri[len(VSICURL_PREFIX):]
+    else:
+        url = parse_qs(uri[len("/vsicurl?"):])["url"][0]
+    stat = gdal.VSIStatL(uri)
+    file_size = stat.size if stat is not None else None
+
+    bytes_fetched = requests = None
+    if hasattr(gdal, "NetworkStatsGetAsSerializedJSON") and _network_stats_enabled():
+        stats = json.loads(gdal.NetworkStatsGetAsSerializedJSON() or "{}")
+        files = stats.get("handlers", {}).get("vsicurl", {}).get("files", {})
+        bytes_fetched = requests = 0
+        for name, file_stats in files.items():
+            if name == uri or unquote(name).endswith(url):
+                for method in file_stats.get("methods", {}).values():
+                    bytes_fetched += method.get("downloaded_bytes", 0)
+                    requests += method.get("count", 0)
+    return RemoteReadStats(url, bytes_fetched, file_size, requests)
+
+
+def _network_stats_enabled() -> bool:
+    value = gdal.GetConfigOption("CPL_VSIL_NETWORK_STATS_ENABLED") or "NO"
+    return value.strip().upper() in ("YES", "ON", "TRUE", "1")
+
+
+def reset_remote_read_stats() -> None:
+    """ Resets the statistics used by remote_read_stats """
+    if hasattr(gdal, "NetworkStatsReset"):
+        gdal.NetworkStatsReset()